@@ -76,6 +76,7 @@ setup(
         'zope.index',
         'zope.interface',
         'zope.intid',
+        'zope.lifecycleevent',
         'zope.location',
     ],
     extras_require={'test': tests_require},
@@ -23,5 +23,6 @@ from hurry.query.query import Le
 from hurry.query.query import NotEq
 from hurry.query.query import Objects
 from hurry.query.query import Or
+from hurry.query.query import Parameter
 from hurry.query.query import Text
 from hurry.query.query import no_results
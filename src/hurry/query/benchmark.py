@@ -0,0 +1,357 @@
+##############################################################################
+#
+# Copyright (c) 2005-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Benchmarks of term evaluation and result post-processing
+
+Generate a catalog of a given size and time a set of queries on it::
+
+  python -m hurry.query.benchmark --size 100000 --output new.json
+
+Results are written as JSON. Pass a previous run with `--compare` to
+report the cases that got slower, the command then exits with an error
+status.
+"""
+import argparse
+import fnmatch
+import itertools
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+import zope.component
+from BTrees.IOBTree import IOBTree
+from zc.catalog.catalogindex import SetIndex
+from zc.catalog.catalogindex import ValueIndex
+from zope.catalog.catalog import Catalog
+from zope.catalog.field import FieldIndex
+from zope.catalog.interfaces import ICatalog
+from zope.catalog.text import TextIndex
+from zope.interface import Attribute
+from zope.interface import Interface
+from zope.interface import implementer
+from zope.intid.interfaces import IIntIds
+
+from hurry.query import query
+from hurry.query import set as set_query
+from hurry.query import value as value_query
+from hurry.query.interfaces import IQuery
+
+
+FORMAT = 1
+CATALOG = 'benchmark'
+FIELD = (CATALOG, 'field')
+VALUE = (CATALOG, 'value')
+TAGS = (CATALOG, 'tags')
+TEXT = (CATALOG, 'text')
+
+
+class IDocument(Interface):
+    field = Attribute('An integer, in a FieldIndex')
+    value = Attribute('A string, in a ValueIndex')
+    tags = Attribute('A set of strings, in a SetIndex')
+    text = Attribute('Words, in a TextIndex')
+
+
+@implementer(IDocument)
+class Document:
+
+    def __init__(self, field, value, tags, text):
+        self.field = field
+        self.value = value
+        self.tags = tags
+        self.text = text
+
+
+@implementer(IIntIds)
+class IntIds:
+    """Just enough of an IntIds utility to query documents kept in
+    memory.
+    """
+
+    def __init__(self):
+        self.refs = IOBTree()
+
+    def register(self, obj):
+        uid = len(self.refs) + 1
+        self.refs[uid] = obj
+        return uid
+
+    def getObject(self, uid):
+        return self.refs[uid]
+
+    def __iter__(self):
+        return iter(self.refs)
+
+    def __len__(self):
+        return len(self.refs)
+
+
+class Distribution:
+    """Draw ranks in `range(cardinality)` following a Zipf law: the
+    frequency of a rank is proportional to `1 / (rank + 1) ** skew`.
+    A skew of 0 gives a uniform distribution.
+    """
+
+    def __init__(self, rng, cardinality, skew):
+        self.rng = rng
+        self.ranks = range(cardinality)
+        self.weights = list(itertools.accumulate(
+            1 / (rank + 1) ** skew for rank in self.ranks))
+
+    def draw(self, k=1):
+        return self.rng.choices(self.ranks, cum_weights=self.weights, k=k)
+
+
+def build(size, cardinality=100, skew=1.0, seed=0):
+    """Create a catalog of `size` documents and register it with an
+    IntIds and a Query utility.
+
+    The most frequent value of each index is the rank 0: `0` for
+    `field`, `'v0'` for `value`, `'t0'` for `tags` and `'w0'` for
+    `text`.
+    """
+    rng = random.Random(seed)
+    values = Distribution(rng, cardinality, skew)
+    words = Distribution(rng, max(cardinality, 1000), skew)
+
+    intids = IntIds()
+    catalog = Catalog()
+    catalog['field'] = FieldIndex('field', IDocument)
+    catalog['value'] = ValueIndex('value', IDocument)
+    catalog['tags'] = SetIndex('tags', IDocument)
+    catalog['text'] = TextIndex('text', IDocument)
+    zope.component.provideUtility(intids, IIntIds)
+    zope.component.provideUtility(catalog, ICatalog, CATALOG)
+    zope.component.provideUtility(query.Query(), IQuery)
+
+    for _ in range(size):
+        field, value = values.draw(2)
+        document = Document(
+            field,
+            f'v{value}',
+            {f't{tag}' for tag in values.draw(rng.randint(1, 3))},
+            ' '.join(f'w{word}' for word in words.draw(5)))
+        catalog.index_doc(intids.register(document), document)
+    return catalog
+
+
+def search(term, **kw):
+    return zope.component.getUtility(IQuery).searchResults(term, **kw)
+
+
+def search_many(terms, **kw):
+    return zope.component.getUtility(IQuery).searchResultsMany(terms, **kw)
+
+
+def cases(cardinality=100):
+    """Return the benchmarks, as a dictionary of names to functions
+    that do a search and return its number of results.
+    """
+    last = cardinality - 1
+    some = range(0, cardinality, max(1, cardinality // 10))
+
+    def count(term, **kw):
+        return lambda: len(search(term, **kw))
+
+    def only(method, term):
+        return lambda: int(getattr(
+            zope.component.getUtility(IQuery), method)(term))
+
+    def page():
+        first = search(query.All(FIELD), sort_field=FIELD, limit=20)
+        return len(search(
+            query.All(FIELD), sort_field=FIELD, limit=20,
+            after=first.continuation))
+
+    def iterate():
+        return len(list(search(query.Eq(FIELD, 1))))
+
+    return {
+        'field.eq.common': count(query.Eq(FIELD, 0)),
+        'field.eq.rare': count(query.Eq(FIELD, last)),
+        'field.in': count(query.In(FIELD, some)),
+        'field.noteq': count(query.NotEq(FIELD, 0)),
+        'field.between': count(query.Between(FIELD, 1, cardinality // 2)),
+        'value.in': count(value_query.In(VALUE, [f'v{v}' for v in some])),
+        'value.noteq': count(value_query.NotEq(VALUE, 'v0')),
+        'set.anyof': count(set_query.AnyOf(TAGS, ['t1', 't2'])),
+        'set.allof': count(set_query.AllOf(TAGS, ['t0', 't1'])),
+        'text': count(query.Text(TEXT, 'w1')),
+        'text.ranked': count(
+            query.Or(query.Text(TEXT, 'w1'), query.Text(TEXT, 'w2'),
+                     weighted=True),
+            ranked=True, limit=20),
+        'text.ranked.and': count(
+            query.And(query.Text(TEXT, 'w1'), query.NotEq(FIELD, 0),
+                      weighted=True),
+            ranked=True, limit=20),
+        'and': count(query.And(
+            query.Eq(FIELD, 1), value_query.Eq(VALUE, 'v1'))),
+        'and.rare': count(query.And(
+            query.Eq(FIELD, 0), value_query.Eq(VALUE, f'v{last}'))),
+        'and.not': count(query.And(
+            query.Eq(FIELD, 1), query.Not(value_query.Eq(VALUE, 'v0')))),
+        'and.noteq': count(query.And(
+            query.Eq(FIELD, 1), query.NotEq(FIELD, 0))),
+        'or': count(query.Or(
+            query.Eq(FIELD, 1), query.Eq(FIELD, 2),
+            value_query.Eq(VALUE, 'v3'))),
+        'difference': count(query.Difference(
+            query.All(FIELD), query.Eq(FIELD, 0))),
+        'not': count(query.Not(query.Eq(FIELD, 0))),
+        'sort.limit': count(query.All(FIELD), sort_field=FIELD, limit=20),
+        'sort.reverse': count(
+            query.All(FIELD), sort_field=FIELD, limit=20, reverse=True),
+        'sort.multiple': count(
+            query.Eq(FIELD, 1), sort_field=[(VALUE, True), FIELD],
+            limit=20),
+        'sort.page': page,
+        'results.iterate': iterate,
+        'many': lambda: sum(len(results) for results in search_many([
+            query.And(query.Eq(FIELD, 0), value_query.Eq(VALUE, f'v{v}'))
+            for v in range(5)])),
+        'count.noteq': only('count', query.NotEq(FIELD, 0)),
+        'count.and': only('count', query.And(
+            query.Eq(FIELD, 1), value_query.Eq(VALUE, 'v1'))),
+        'exists.and': only('exists', query.And(
+            query.Eq(FIELD, 0), value_query.Eq(VALUE, 'v0'))),
+        'exists.or': only('exists', query.Or(
+            query.Eq(FIELD, 0), query.Eq(FIELD, 1))),
+        'facets': lambda: len(zope.component.getUtility(IQuery).facets(
+            query.Text(TEXT, 'w1'), [FIELD, VALUE, TAGS], limit=10)),
+    }
+
+
+def measure(function, repeat=5):
+    """Call `function` `repeat` times and return statistics about its
+    duration, in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = function()
+        durations.append(time.perf_counter() - start)
+    return {
+        'results': results,
+        'repeat': repeat,
+        'min': min(durations),
+        'median': statistics.median(durations),
+        'mean': statistics.mean(durations),
+    }
+
+
+def run(size, cardinality=100, skew=1.0, seed=0, repeat=5, patterns=()):
+    """Build a catalog and time the cases matching any of the
+    `patterns` (all of them by default).
+    """
+    start = time.perf_counter()
+    build(size, cardinality=cardinality, skew=skew, seed=seed)
+    indexing = time.perf_counter() - start
+    report = {
+        'format': FORMAT,
+        'parameters': {
+            'size': size,
+            'cardinality': cardinality,
+            'skew': skew,
+            'seed': seed,
+        },
+        'python': platform.python_implementation(),
+        'python_version': platform.python_version(),
+        'indexing': indexing,
+        'cases': {},
+    }
+    for name, function in cases(cardinality).items():
+        if patterns and not any(
+                fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        report['cases'][name] = measure(function, repeat=repeat)
+    return report
+
+
+def compare(baseline, report, threshold=1.2):
+    """Return the cases of `report` whose median is `threshold` times
+    slower than in `baseline`, as `(name, before, after)` tuples.
+    """
+    regressions = []
+    before = baseline['cases']
+    for name, stats in sorted(report['cases'].items()):
+        if name not in before:
+            continue
+        if stats['median'] > before[name]['median'] * threshold:
+            regressions.append(
+                (name, before[name]['median'], stats['median']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m hurry.query.benchmark', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--size', type=int, default=10000,
+        help='number of documents (default: %(default)s)')
+    parser.add_argument(
+        '--cardinality', type=int, default=100,
+        help='number of distinct values per index (default: %(default)s)')
+    parser.add_argument(
+        '--skew', type=float, default=1.0,
+        help='exponent of the Zipf distribution of the values, '
+        '0 for uniform (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='number of runs of each case (default: %(default)s)')
+    parser.add_argument(
+        '--case', action='append', default=[], dest='patterns',
+        help='only run the cases matching this glob pattern')
+    parser.add_argument(
+        '--output', help='write the results to this file, '
+        'instead of the standard output')
+    parser.add_argument(
+        '--compare', metavar='BASELINE',
+        help='report the cases slower than in this previous output')
+    parser.add_argument(
+        '--threshold', type=float, default=1.2,
+        help='slowdown ratio reported by --compare (default: %(default)s)')
+    options = parser.parse_args(argv)
+
+    report = run(
+        options.size, cardinality=options.cardinality, skew=options.skew,
+        seed=options.seed, repeat=options.repeat, patterns=options.patterns)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as stream:
+            baseline = json.load(stream)
+        if baseline['parameters'] != report['parameters']:
+            print('Warning: the baseline was run with other parameters.',
+                  file=sys.stderr)
+        regressions = compare(baseline, report, options.threshold)
+        for name, before, after in regressions:
+            print(f'{name}: {before * 1000:.3f}ms -> {after * 1000:.3f}ms '
+                  f'({after / before:.2f}x)', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
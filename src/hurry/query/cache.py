@@ -0,0 +1,391 @@
+##############################################################################
+#
+# Copyright (c) 2005-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Caches for term results
+
+Term results are cached by `Term.key()`. A cache is any object that
+provides `get(key)` and `__setitem__(key, value)`.
+"""
+import collections
+import threading
+import weakref
+
+import transaction
+from transaction.interfaces import ISynchronizer
+from zope.catalog.interfaces import ICatalog
+from zope.catalog.interfaces import INoAutoReindex
+from zope.component import adapter
+from zope.component import getUtilitiesFor
+from zope.interface import implementer
+from zope.intid.interfaces import IIntIdEvent
+from zope.lifecycleevent.interfaces import IAttributes
+from zope.lifecycleevent.interfaces import IObjectModifiedEvent
+
+
+COMMITTED = 'Committed'
+
+
+@implementer(ISynchronizer)
+class CacheSynchronizer:
+    """Clear a cache at transaction boundaries.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def beforeCompletion(self, transaction):
+        pass
+
+    def afterCompletion(self, transaction):
+        self.cache.clear()
+
+    def newTransaction(self, transaction):
+        self.cache.clear()
+
+
+class TransactionCache(threading.local):
+    """Cache term results for all the queries done by a thread during
+    a transaction.
+
+    The cache is emptied when the transaction is committed or aborted.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.synchronizer = CacheSynchronizer(self)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if not self.data:
+            # Registering is idempotent. Doing it each time the cache
+            # starts to be filled ensures it will be emptied even if
+            # the synchronizers of the transaction manager got cleared.
+            transaction.manager.registerSynch(self.synchronizer)
+        self.data[key] = value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        self.data.clear()
+
+    def snapshot(self):
+        """Return a copy of the results of the current thread, to be
+        read by another thread.
+        """
+        return dict(self.data)
+
+
+transaction_cache = TransactionCache()
+
+
+def dependencies(key):
+    """Return the `(catalog name, index name)` of the index terms found
+    in a term key, or None if there are none.
+
+    Keys of index terms start with a kind, the catalog name and the
+    index name. Keys of other terms contain the keys of their terms.
+    """
+    found = set()
+    keys = [key]
+    while keys:
+        key = keys.pop()
+        if not isinstance(key, tuple):
+            continue
+        if len(key) >= 3 and all(isinstance(part, str) for part in key[:3]):
+            found.add(key[1:3])
+        keys.extend(key)
+    return frozenset(found) or None
+
+
+def weight(value):
+    try:
+        return 1 + len(value)
+    except TypeError:
+        return 1
+
+
+@implementer(ISynchronizer)
+class SharedCacheSynchronizer:
+    """Apply the changes of a transaction to a shared cache once it is
+    committed.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def beforeCompletion(self, transaction):
+        pass
+
+    def afterCompletion(self, transaction):
+        self.cache.completed(transaction.status == COMMITTED)
+
+    def newTransaction(self, transaction):
+        self.cache.completed(False)
+
+
+class SharedCacheState(threading.local):
+
+    def __init__(self, cache):
+        self.synchronizer = SharedCacheSynchronizer(cache)
+        self.start = None
+        self.changed = set()
+        self.everything = False
+
+
+class SharedCacheSnapshot:
+    """Read a shared cache from another thread, as the transaction of
+    the thread that took the snapshot sees it.
+    """
+
+    def __init__(self, cache, state):
+        self.cache = cache
+        self.start = state.start
+        self.changed = frozenset(state.changed)
+        self.everything = state.everything
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default, state=self)
+
+
+caches = weakref.WeakSet()
+
+
+class SharedCache:
+    """Cache term results for all the threads and the transactions.
+
+    The cache holds up to `size` document ids: the least recently used
+    results are evicted first. Results must not be modified.
+
+    Results are invalidated per index when the transactions that index
+    or unindex documents are committed, see `invalidateIdSubscriber` and
+    `invalidateModifiedSubscriber`. Until then, the transaction doing
+    the changes does not use the cache for these indexes. Transactions
+    started before an invalidation do not use the cache for the
+    invalidated indexes either, as their view of the indexes is older
+    than what the cache could contain.
+
+    Only the changes done in this process are seen: with several ZEO
+    clients each client must have its own cache and it will miss the
+    changes done by the others.
+    """
+
+    def __init__(self, size=1000000):
+        self.size = size
+        self.used = 0
+        self.data = collections.OrderedDict()
+        self.keys = collections.defaultdict(set)
+        self.generation = 0
+        self.generations = {}
+        self.cleared = 0
+        self.lock = threading.Lock()
+        self.local = SharedCacheState(self)
+        caches.add(self)
+
+    def register(self):
+        state = self.local
+        if state.start is None:
+            # This starts tracking the current transaction, if any.
+            transaction.manager.registerSynch(state.synchronizer)
+            if state.start is None:
+                state.start = self.generation
+        return state
+
+    def usable(self, indexes, state=None):
+        # Must be called with the lock.
+        if state is None:
+            state = self.local
+        if state.everything:
+            return False
+        if indexes is None:
+            return not state.changed and self.generation <= state.start
+        if not indexes.isdisjoint(state.changed):
+            return False
+        generations = self.generations
+        return max(
+            self.cleared, *(generations.get(index, 0) for index in indexes)
+        ) <= state.start
+
+    def get(self, key, default=None, state=None):
+        indexes = dependencies(key)
+        if state is None:
+            self.register()
+        with self.lock:
+            if not self.usable(indexes, state):
+                return default
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            self.data.move_to_end(key)
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        indexes = dependencies(key)
+        size = weight(value)
+        self.register()
+        with self.lock:
+            if size > self.size or not self.usable(indexes):
+                return
+            if key in self.data:
+                self.remove(key)
+            self.data[key] = (value, indexes, size)
+            self.used += size
+            for index in indexes or (None,):
+                self.keys[index].add(key)
+            while self.used > self.size:
+                self.remove(next(iter(self.data)))
+
+    def remove(self, key):
+        # Must be called with the lock.
+        value, indexes, size = self.data.pop(key)
+        self.used -= size
+        for index in indexes or (None,):
+            keys = self.keys[index]
+            keys.discard(key)
+            if not keys:
+                del self.keys[index]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def snapshot(self):
+        """Return a view of the cache to be read by another thread, as
+        the current transaction sees it.
+        """
+        return SharedCacheSnapshot(self, self.register())
+
+    def changed(self, indexes=None):
+        """Tell that the current transaction changed `indexes`, as
+        `(catalog name, index name)`, or anything if None. A None in
+        `indexes` stands for the results of terms using no index.
+        """
+        state = self.register()
+        with self.lock:
+            if indexes is None:
+                state.everything = True
+            else:
+                state.changed.update(indexes)
+
+    def completed(self, committed):
+        state = self.local
+        if committed and state.everything:
+            self.invalidate()
+        elif committed and state.changed:
+            self.invalidate(state.changed)
+        with self.lock:
+            state.changed = set()
+            state.everything = False
+            state.start = self.generation
+
+    def invalidate(self, indexes=None):
+        """Remove the results of terms that use `indexes`, as `(catalog
+        name, index name)`, or all results if None.
+        """
+        with self.lock:
+            self.generation += 1
+            if indexes is None:
+                self.cleared = self.generation
+                self.data.clear()
+                self.keys.clear()
+                self.used = 0
+                return
+            keys = set(self.keys.get(None, ()))
+            for index in indexes:
+                self.generations[index] = self.generation
+                keys.update(self.keys.get(index, ()))
+            for key in keys:
+                self.remove(key)
+
+    def clear(self):
+        self.invalidate()
+
+
+def changed(indexes=None):
+    for cache in list(caches):
+        cache.changed(indexes)
+
+
+def modified_attributes(descriptions):
+    attributes = set()
+    for description in descriptions:
+        if not IAttributes.providedBy(description):
+            return None
+        attributes.update(description.attributes)
+    return attributes or None
+
+
+def affected(index, obj, attributes=None):
+    """Tell whether reindexing `obj` could change `index`, if only
+    `attributes` were modified (any of them if None).
+    """
+    field_name = getattr(index, 'field_name', None)
+    if field_name is None:
+        return True
+    interface = getattr(index, 'interface', None)
+    if interface is not None:
+        adapted = interface(obj, None)
+        if adapted is None:
+            return False
+        if adapted is not obj:
+            # An adapter can compute its value from any attribute.
+            return True
+    if attributes is None or getattr(index, 'field_callable', False):
+        return True
+    return field_name in attributes
+
+
+@adapter(IIntIdEvent)
+def invalidateIdSubscriber(event):
+    """Invalidate the indexes that can index or unindex a document in
+    all the shared caches when it is added or removed, and the results
+    of the terms using no index, like `Universe`.
+    """
+    obj = event.object
+    if not caches:
+        return
+    # None stands for the results without indexes.
+    indexes = {None}
+    for catalog_name, catalog in getUtilitiesFor(ICatalog, context=obj):
+        for index_name, index in catalog.items():
+            if affected(index, obj):
+                indexes.add((catalog_name, index_name))
+    changed(indexes)
+
+
+@adapter(IObjectModifiedEvent)
+def invalidateModifiedSubscriber(event):
+    """Invalidate the indexes of the modified attributes of a document
+    in all the shared caches.
+    """
+    obj = event.object
+    if not caches or INoAutoReindex.providedBy(obj):
+        return
+    attributes = modified_attributes(event.descriptions)
+    indexes = set()
+    for catalog_name, catalog in getUtilitiesFor(ICatalog, context=obj):
+        for index_name, index in catalog.items():
+            if affected(index, obj, attributes):
+                indexes.add((catalog_name, index_name))
+    if indexes:
+        changed(indexes)
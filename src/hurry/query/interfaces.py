@@ -20,9 +20,16 @@ from zope.interface import Interface
 
 class IQuery(Interface):
 
+    recorder = Attribute(
+        'An `IProfileSink` with a `sampled()` method, like a '
+        '`SlowQueryRecorder`, recording the profiles of the sampled '
+        'queries done without a `profile`, or None')
+
     def searchResults(
             query, context=None, sort_field=None, limit=None, reverse=False,
-            start=0, caching=False):
+            start=0, caching=False, batch_size=100, after=None,
+            profile=None, executor=None, parameters=None, stream=False,
+            compact=False, ranked=False):
         """Query indexes.
 
         The query argument is a query composed of terms. Optionally
@@ -32,11 +39,20 @@ class IQuery(Interface):
         index used to sort the result set with. This index is required
         to provide IIndexSort.
 
+        `sort_field` can also be a list of them, to sort on several
+        indexes one after the other. Each of them can be given as a
+        `(sort_field, descending)` pair to sort on it in descending
+        order. Values are then read from the reverse index of the
+        indexes, without loading any object. A single pair sorts on
+        its index only.
+
         Optionally provide a `limit` parameter to limit the result set
         to the given size.
 
         Optionally provide a `reverse` parameter to reverse the order
-        of the result set.
+        of the result set. Sorted results with the same value stay
+        ordered on their document id, so that limited pages are slices
+        of the results sorted without a limit.
 
         Optionally provide a `start` parameter to ignore the first
         result in set to the given start position.
@@ -52,6 +68,142 @@ class IQuery(Interface):
 
             Or a `dict`-like object where invalidation is handled by the
             caller of the multiple `searchResults()` call.
+
+            A `hurry.query.cache.SharedCache` caches results across
+            threads and transactions, invalidated when indexes change.
+
+        Optionally provide a `batch_size` parameter, the number of
+        objects loaded from the database at once while iterating over
+        the results.
+
+        Optionally provide an `after` parameter, the `continuation` of
+        the results of a previous page, to get the page following it
+        without sorting the results that were before. It requires a
+        `sort_field` and a `limit`.
+
+        Optionally provide a `profile` parameter, `True` to set the
+        timings of the query as `profile` on the results, or an
+        `IProfileSink` to record them as well.
+
+        Optionally provide an `executor` parameter, a
+        `concurrent.futures.Executor` on which the terms of `And`, `Or`
+        and `Difference` are evaluated at the same time. It defaults to
+        a thread pool of `HURRY_QUERY_THREADS` threads if this
+        environment variable is set, `False` disables it. Results are
+        the same as when terms are evaluated one after the other. Terms
+        are not evaluated at the same time when timing or profiling.
+
+        The worker threads use the indexes found with `context` by the
+        thread doing the query, and load them with its ZODB connection,
+        while ZODB connections are not meant to be used by several
+        threads at once. Only use an executor if the indexes are
+        already loaded, for example as they are kept in the connection
+        cache, or if the terms evaluated at the same time open their
+        own connection or use an other engine than the ZODB.
+
+        The query can be a plan returned by `compile`, executed with
+        the values of its parameters given as a `parameters` mapping.
+
+        Results that are reversed, limited or started further without a
+        `sort_field` are read from the results of the query while
+        iterating over them, they are never copied in a list. Optionally
+        provide a `stream` parameter to sort them on a single
+        `sort_field` without a `limit` in the same way: the index is
+        walked in order while iterating, in constant memory, instead of
+        sorting all the results first. Results are then iterated again
+        each time they are used.
+
+        Optionally provide a `compact` parameter to only keep the
+        selected results, as an array of ids, instead of all the
+        results of the query, for results kept for a long time. They
+        cannot count facets then.
+
+        Optionally provide a `ranked` parameter, instead of a
+        `sort_field`, to order the results from the best score to the
+        worst. Scores come from `Text` terms: a weighted `And` adds the
+        scores of a document in all its terms and a weighted `Or` in
+        the terms it matches, other terms count as 1. A `Difference`
+        keeps the scores of its first term, `And` and `Or` that are
+        not weighted do not keep them. With a `limit`, only the best
+        documents are selected, without sorting all of them. Results
+        of a query without scores are not ranked.
+        """
+
+    def searchResultsMany(queries, context=None, caching=False, **kw):
+        """Query indexes with each of the queries and return a list of
+        their results.
+
+        The terms the queries have in common, with the same key, are
+        evaluated once and the indexes are looked up once for all of
+        them, even without `caching`. The common terms that would only
+        be evaluated for the results of other terms are evaluated for
+        all the documents first, to be cached. Other arguments are the ones of
+        `searchResults`, used for all the queries.
+        """
+
+    async def asearchResults(
+            query, context=None, caching=False, async_executor=None, **kw):
+        """Query indexes without blocking the event loop of asyncio.
+
+        The query is done by a thread of `async_executor`, a pool of
+        `HURRY_QUERY_ASYNC_THREADS` threads by default, in the site of
+        the caller. The objects of the database are loaded by this
+        thread with the connection of the caller, which must not be
+        used by other tasks in the meantime. With `caching`, the thread
+        reads a snapshot of the cache taken by the caller, and the cache
+        is given the results of the terms once the query is done, as it
+        can be bound to the thread of the caller. Other arguments are
+        the ones of `searchResults`.
+        """
+
+    def explain(query, context=None, caching=False, parameters=None):
+        """Evaluate a query and return how, as an `Explanation` of its
+        term with the ones of its terms as `children`.
+
+        For each term, it tells the set `operation` combining the
+        results of its terms, the `estimate` of its cardinality from the
+        statistics of the indexes and the actual `cardinality`, the
+        time `elapsed`, whether it was `evaluated` or `cached`, and
+        whether it could stop before evaluating all its terms
+        (`short_circuit`). Terms are listed in the order they were
+        evaluated, followed by the ones that were not.
+        """
+
+    def count(query, context=None, caching=False, parameters=None):
+        """Return the number of results of a query.
+
+        Terms are counted from the statistics of their index when
+        possible, without computing their results.
+        """
+
+    def exists(query, context=None, caching=False, parameters=None):
+        """Tell whether a query has any results.
+
+        `Or` stops at the first of its terms with results, `And` and
+        `Difference` look for a document in the results of their terms
+        without computing the intersection or the difference.
+        """
+
+    def facets(query, fields, context=None, limit=None, caching=False,
+               parameters=None):
+        """Return, for each of the `fields`, how many results of the
+        query have each value of its index.
+
+        Fields are given as `(catalog name, index name)` tuples or as
+        indexes, from zope.index's `FieldIndex` or zc.catalog's
+        `ValueIndex` and `SetIndex`. Each of them gets a mapping of
+        values to their number of results, the most frequent first.
+        Optionally provide a `limit` to only get that many of the most
+        frequent values.
+        """
+
+    def compile(query):
+        """Return a plan for a query to be done many times, with a
+        `Parameter` for each of the values that change.
+
+        The indexes of the terms of the query are looked up once per
+        site, the keys of the terms without parameters computed once,
+        and the terms are evaluated in the order planned the first time.
         """
 
 
@@ -61,13 +213,50 @@ class ITerm(Interface):
         """Return a unique key for this term.
         """
 
-    def apply(cache, context=None):
+    use_candidates = Attribute(
+        'True if `apply` accepts a `candidates` argument')
+
+    def apply(cache, context=None, candidates=None):
         """Search and return the results for this term as an IFSet or
         something compatible with it.
+
+        Optionally, if `use_candidates` is true, `candidates` is an IFSet
+        of the only document ids the caller is interested in. Results
+        must then be correct for those candidates only: they can omit
+        the ids outside of the candidates, as well as contain them.
         """
 
-    def cached_apply(cache, context=None):
+    def cached_apply(cache, context=None, candidates=None):
         """Look up in the cache and return results or apply the term if needed.
+
+        Results computed for `candidates` are not cached.
+        """
+
+    def count(cache, context=None):
+        """Return the number of results of this term, if possible
+        without computing them.
+        """
+
+    def exists(cache, context=None):
+        """Tell whether this term has any results, if possible without
+        computing all of them.
+        """
+
+    def estimate(context=None):
+        """Return a cheap estimation of the number of results of this
+        term, or None if it cannot be estimated.
+
+        Estimations are used to decide in which order terms are
+        evaluated.
+        """
+
+    operation = Attribute(
+        'Name of the set operation combining the results of the terms '
+        'of this term, or None')
+
+    def children(context=None):
+        """Return the terms of this term, in the order they are
+        evaluated.
         """
 
 
@@ -79,10 +268,29 @@ class IResults(Interface):
     count = Attribute(
         'Number of results (with start/limit restrictions)')
 
+    continuation = Attribute(
+        'Opaque position of the last result, to pass as `after` to get '
+        'the next page, or None')
+
+    profile = Attribute(
+        'Timings of the query if it was profiled, or None')
+
     def first():
         """Return only the first result of the query or None.
         """
 
+    def facets(fields, limit=None):
+        """Return, for each of the `fields`, how many results have each
+        value of its index, regardless of start/limit restrictions.
+
+        See `IQuery.facets`.
+        """
+
+    def score(uid):
+        """Return the score of a document of the results, or None if
+        the results of the query have no scores.
+        """
+
     def __len__():
         """Return the number of results (with start/limit restrictions), that
         is the same than count.
@@ -90,4 +298,27 @@ class IResults(Interface):
 
     def __iter__():
         """Iterate over the matching objects.
+
+        Objects are loaded from the database in batches.
+        """
+
+    def __aiter__():
+        """Asynchronously iterate over the matching objects.
+
+        Batches of objects are loaded by the threads used by
+        `IQuery.asearchResults`, letting other tasks run in between.
+        """
+
+    def __getitem__(index):
+        """Return the matching object at the given index, or a list
+        of the matching objects for a slice.
+
+        Only the objects in the slice are loaded from the database.
+        """
+
+
+class IProfileSink(Interface):
+
+    def record(profile):
+        """Record the profile of a query.
         """
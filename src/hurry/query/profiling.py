@@ -0,0 +1,317 @@
+##############################################################################
+#
+# Copyright (c) 2005-2009 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Query profiles and sinks to record them
+
+Pass `profile=True` to `searchResults` to get a profile on the
+results, or an `IProfileSink` to record it as well. `Query.explain`
+returns an `Explanation` of how a query is evaluated.
+"""
+import collections
+import math
+import random
+import threading
+
+from zope.interface import implementer
+
+from hurry.query import interfaces
+
+
+def metric_name(key):
+    """Return a name for the kind of term of a key, without its values.
+
+    Index terms are named after their index.
+    """
+    if not isinstance(key, tuple) or not key or not isinstance(key[0], str):
+        return 'unknown'
+    parts = [key[0]]
+    if len(key) >= 3 and isinstance(key[1], str) and isinstance(key[2], str):
+        parts.extend(key[1:3])
+    return '.'.join(
+        (part or '_').replace(' ', '_').replace('.', '_') for part in parts)
+
+
+def fingerprint(key):
+    """Return the shape of a term key, its values replaced by `'?'`.
+
+    Keys of index terms keep their kind and index, keys of other terms
+    their kind and the shapes of their terms.
+    """
+    if not isinstance(key, tuple) or not key or not isinstance(key[0], str):
+        return '?'
+    if len(key) >= 3 and isinstance(key[1], str) and isinstance(key[2], str):
+        return key[:3] + ('?',) * (len(key) > 3)
+    return key[:1] + tuple(fingerprint(part) for part in key[1:])
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted values.
+    """
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class Profile:
+    """Timings of the terms of a query and of the post-processing of
+    its results.
+
+    `terms` is a list of `Timing` with the `key`, `total` time,
+    `cardinality` of the results, whether they were `cached` and the
+    `children` terms of each evaluated term.
+    """
+
+    def __init__(self, terms, post=None):
+        self.terms = terms
+        self.post = None if post is None else post.total
+
+    @property
+    def total(self):
+        total = sum(timing.total or 0 for timing in self.terms)
+        return total + (self.post or 0)
+
+    @property
+    def cardinality(self):
+        if self.terms:
+            return self.terms[0].cardinality
+        return None
+
+    def walk(self):
+        """Iterate over the timings of all the terms, depth first.
+        """
+        stack = list(reversed(self.terms))
+        while stack:
+            timing = stack.pop()
+            yield timing
+            stack.extend(reversed(timing.children))
+
+    def as_dict(self):
+
+        def term(timing):
+            return {
+                'key': timing.key,
+                'elapsed': timing.total,
+                'cardinality': timing.cardinality,
+                'cached': timing.cached,
+                'children': [term(child) for child in timing.children]}
+
+        return {
+            'elapsed': self.total,
+            'post': self.post,
+            'terms': [term(timing) for timing in self.terms]}
+
+
+class Explanation:
+    """How a term of a query was evaluated.
+
+    `estimate` is the cardinality expected from the statistics of the
+    indexes, `cardinality` the actual one. `children` are the terms of
+    the term in the order they were evaluated, followed by the ones that
+    were not: `short_circuit` tells that the term did not need them.
+    """
+    __slots__ = (
+        'key', 'operation', 'estimate', 'cardinality', 'elapsed',
+        'evaluated', 'cached', 'short_circuit', 'children')
+
+    def __init__(self, key=None, children=()):
+        self.key = key
+        self.operation = None
+        self.estimate = None
+        self.cardinality = None
+        self.elapsed = None
+        self.evaluated = False
+        self.cached = False
+        self.short_circuit = False
+        self.children = list(children)
+
+    def walk(self):
+        """Iterate over this explanation and the ones of all its terms,
+        depth first.
+        """
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def as_dict(self):
+        return {
+            'key': self.key,
+            'operation': self.operation,
+            'estimate': self.estimate,
+            'cardinality': self.cardinality,
+            'elapsed': self.elapsed,
+            'evaluated': self.evaluated,
+            'cached': self.cached,
+            'short_circuit': self.short_circuit,
+            'children': [child.as_dict() for child in self.children]}
+
+    def format(self, indent=0):
+        """Return the explanation as text, a line per term.
+        """
+        details = [f'estimate {self.estimate}']
+        if self.evaluated:
+            details.append(f'actual {self.cardinality}')
+            if self.elapsed is not None:
+                details.append(f'{self.elapsed * 1000:.3f}ms')
+        else:
+            details.append('not evaluated')
+        if self.cached:
+            details.append('cached')
+        if self.short_circuit:
+            details.append('short-circuited')
+        if self.operation is not None:
+            name = f'{metric_name(self.key)} ({self.operation})'
+        else:
+            name = repr(self.key)
+        lines = [' ' * indent + f'{name}: {", ".join(details)}']
+        lines.extend(child.format(indent + 2) for child in self.children)
+        return '\n'.join(lines)
+
+
+@implementer(interfaces.IProfileSink)
+class ProfileCollector:
+    """Keep the last profiles in memory.
+    """
+
+    def __init__(self, size=None):
+        self.profiles = collections.deque(maxlen=size)
+
+    def record(self, profile):
+        self.profiles.append(profile)
+
+    def clear(self):
+        self.profiles.clear()
+
+
+class QueryShape:
+    """Statistics of the queries of a same shape.
+    """
+    __slots__ = ('count', 'total', 'results', 'durations')
+
+    def __init__(self, window):
+        self.count = 0
+        self.total = 0
+        self.results = 0
+        self.durations = collections.deque(maxlen=window)
+
+    def add(self, duration, cardinality):
+        self.count += 1
+        self.total += duration
+        self.results += cardinality or 0
+        self.durations.append(duration)
+
+    def as_dict(self):
+        durations = sorted(self.durations)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'p50': percentile(durations, .5),
+            'p95': percentile(durations, .95),
+            'p99': percentile(durations, .99),
+            'mean_results': self.results / self.count,
+        }
+
+
+@implementer(interfaces.IProfileSink)
+class SlowQueryRecorder:
+    """Aggregate the profiles of the queries slower than `threshold`
+    seconds by shape, for the `size` most recently seen shapes.
+
+    Percentiles are computed on the last `window` queries of each
+    shape. Set it as the `recorder` of a `Query` utility to profile a
+    `sample` fraction of the queries done without a `profile`.
+    """
+
+    def __init__(self, threshold=0.0, size=1000, window=1000, sample=1.0):
+        self.threshold = threshold
+        self.size = size
+        self.window = window
+        self.sample = sample
+        self.lock = threading.Lock()
+        self.shapes = collections.OrderedDict()
+
+    def sampled(self):
+        """Tell whether the next query should be profiled.
+        """
+        return self.sample >= 1 or random.random() < self.sample
+
+    def record(self, profile):
+        total = profile.total
+        if total < self.threshold or not profile.terms:
+            return
+        if len(profile.terms) == 1:
+            shape = fingerprint(profile.terms[0].key)
+        else:
+            # The query has no key, only its terms have.
+            shape = tuple(fingerprint(t.key) for t in profile.terms)
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = self.shapes[shape] = QueryShape(self.window)
+                if len(self.shapes) > self.size:
+                    self.shapes.popitem(last=False)
+            else:
+                self.shapes.move_to_end(shape)
+            stats.add(total, profile.cardinality)
+
+    def dump(self):
+        """Return the statistics of each shape, the ones that took the
+        most time first.
+        """
+        with self.lock:
+            shapes = [
+                dict(stats.as_dict(), shape=shape)
+                for shape, stats in self.shapes.items()]
+        shapes.sort(key=lambda stats: -stats['total'])
+        return shapes
+
+    def reset(self):
+        with self.lock:
+            self.shapes.clear()
+
+
+@implementer(interfaces.IProfileSink)
+class CallbackSink:
+    """Call a function with each profile.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, profile):
+        self.callback(profile)
+
+
+@implementer(interfaces.IProfileSink)
+class StatsSink:
+    """Send profiles to a statsd-like client, with `timing(name,
+    milliseconds)` and `incr(name)` methods.
+
+    Terms are named after their kind and index, not their values.
+    """
+
+    def __init__(self, client, prefix='hurry.query'):
+        self.client = client
+        self.prefix = prefix
+
+    def record(self, profile):
+        client = self.client
+        prefix = self.prefix
+        client.timing(f'{prefix}.total', profile.total * 1000)
+        if profile.post is not None:
+            client.timing(f'{prefix}.post', profile.post * 1000)
+        for timing in profile.walk():
+            name = metric_name(timing.key)
+            if timing.cached:
+                client.incr(f'{prefix}.hit.{name}')
+                continue
+            client.incr(f'{prefix}.miss.{name}')
+            if timing.total is not None:
+                client.timing(f'{prefix}.term.{name}', timing.total * 1000)
@@ -17,16 +17,31 @@ This module contains an IQuery utility implementation, basic query term
 implementations and concrete term implementations for zope.catalog indexes.
 
 """
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import functools
+import heapq
 import itertools
 import logging
 import os
+import threading
 import time
+import weakref
+from array import array
 
+from BTrees.IFBTree import IFBTree
+from BTrees.IFBTree import IFBucket
 from BTrees.IFBTree import IFSet
 from BTrees.IFBTree import difference
 from BTrees.IFBTree import intersection
 from BTrees.IFBTree import multiunion
 from BTrees.IFBTree import weightedIntersection
+from BTrees.IFBTree import weightedUnion
+from zc.catalog.interfaces import ISetIndex
 from zope.cachedescriptors.property import Lazy
 from zope.catalog.field import IFieldIndex
 from zope.catalog.interfaces import ICatalog
@@ -42,6 +57,9 @@ from zope.location.location import LocationProxy
 from zope.location.location import located
 
 from hurry.query import interfaces
+from hurry.query.cache import transaction_cache
+from hurry.query.profiling import Explanation
+from hurry.query.profiling import Profile
 
 
 logger = logging.getLogger('hurry.query')
@@ -52,7 +70,514 @@ if 'HURRY_QUERY_TIMING' in os.environ:
     except (ValueError, TypeError):
         pass
 
+HURRY_QUERY_THREADS = 0  # evaluate terms on a pool of that many threads
+if 'HURRY_QUERY_THREADS' in os.environ:
+    try:
+        HURRY_QUERY_THREADS = int(os.environ['HURRY_QUERY_THREADS'])
+    except (ValueError, TypeError):
+        pass
+
+# asearchResults evaluates queries on a pool of that many threads
+HURRY_QUERY_ASYNC_THREADS = 4
+if 'HURRY_QUERY_ASYNC_THREADS' in os.environ:
+    try:
+        HURRY_QUERY_ASYNC_THREADS = int(
+            os.environ['HURRY_QUERY_ASYNC_THREADS'])
+    except (ValueError, TypeError):
+        pass
+
 _perf_counter = time.perf_counter
+_executor = None
+_async_executor = None
+_executor_lock = threading.Lock()
+# The context of the searchResults call evaluating terms, and the
+# indexes looked up by them.
+_indexes = contextvars.ContextVar('hurry.query.indexes', default=None)
+
+# Number of objects loaded at once when iterating over results.
+BATCH_SIZE = 100
+
+# Terms evaluated with candidates only restrict their work to them when
+# there are at least that many times more documents in their index than
+# candidates, as checking candidates one by one is done in Python.
+CANDIDATES_RATIO = 16
+
+# Looking up the documents of several values in a forward index walks
+# the keys between them while there are no more than that many times
+# more keys than values, as walking a key is cheaper than a lookup.
+WALK_RATIO = 4
+
+
+@contextlib.contextmanager
+def indexes_scope(context):
+    """Look up each index once while evaluating terms in `context`,
+    or in the scope already opened for it.
+    """
+    scope = _indexes.get()
+    if scope is not None and scope[0] is context:
+        yield
+        return
+    token = _indexes.set((context, {}))
+    try:
+        yield
+    finally:
+        _indexes.reset(token)
+
+
+def lookup_index(catalog_name, index_name, context, interface=None):
+    """Return an index of a catalog, looked up once in the scope of
+    the query.
+    """
+    key = (catalog_name, index_name)
+    scope = _indexes.get()
+    if scope is not None and scope[0] is context:
+        indexes = scope[1]
+        index = indexes.get(key)
+        if index is not None:
+            return index
+    catalog = getUtility(ICatalog, catalog_name, context)
+    index = catalog[index_name]
+    if interface is not None:
+        assert interface.providedBy(index)
+    if scope is not None and scope[0] is context:
+        indexes[key] = index
+    return index
+
+
+def use_candidates(candidates, index):
+    """Tell if it is worth to restrict the work on index to the given
+    candidates.
+    """
+    if candidates is None:
+        return False
+    return len(candidates) * CANDIDATES_RATIO < index.documentCount()
+
+
+def candidate_ids(candidates):
+    """Return the ids of candidates, without the scores they have in a
+    weighted ``And``: other terms than the ones of text indexes count
+    as 1 and must not add these scores again.
+    """
+    if isinstance(candidates, (IFBucket, IFBTree)):
+        return IFSet(candidates.keys())
+    return candidates
+
+
+def bucket_size(tree, value):
+    """Return the number of documents indexed under value in the
+    forward index tree of an index.
+    """
+    try:
+        documents = tree.get(value)
+    except TypeError:
+        return 0
+    if documents is None:
+        return 0
+    return len(documents)
+
+
+def default_executor():
+    """Return the thread pool evaluating terms by default, if
+    `HURRY_QUERY_THREADS` is set.
+    """
+    global _executor
+    if HURRY_QUERY_THREADS <= 0:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                HURRY_QUERY_THREADS, thread_name_prefix='hurry.query')
+    return _executor
+
+
+def default_async_executor():
+    """Return the thread pool of `HURRY_QUERY_ASYNC_THREADS` threads
+    running the queries and loading the results of asyncio tasks.
+    """
+    global _async_executor
+    with _executor_lock:
+        if _async_executor is None:
+            _async_executor = concurrent.futures.ThreadPoolExecutor(
+                max(HURRY_QUERY_ASYNC_THREADS, 1),
+                thread_name_prefix='hurry.query.async')
+    return _async_executor
+
+
+def shutdown_async_executor():
+    """Stop the threads of the default pool of `default_async_executor`,
+    once its work is done. A new pool is created when needed again.
+    """
+    global _async_executor
+    with _executor_lock:
+        executor, _async_executor = _async_executor, None
+    if executor is not None:
+        executor.shutdown()
+
+
+def concurrent_results(cache, terms, context=None, candidates=None):
+    """Evaluate terms at the same time if the cache has an executor.
+
+    Return their results by term id, or an empty dictionary if they
+    should be evaluated one after the other.
+    """
+    apply_terms = getattr(cache, 'apply_terms', None)
+    if apply_terms is None or len(terms) < 2:
+        return {}
+    results = apply_terms(terms, context, candidates)
+    if results is None:
+        return {}
+    return {id(term): result for term, result in zip(terms, results)}
+
+
+def lookup_documents(tree, values):
+    """Return the document sets indexed under the given values in the
+    forward index tree of an index, looking them up one by one.
+    """
+    found = []
+    for value in values:
+        try:
+            documents = tree.get(value)
+        except TypeError:
+            continue
+        if documents is not None:
+            found.append(documents)
+    return found
+
+
+def forward_documents(tree, values):
+    """Return the document sets indexed under the given values in the
+    forward index tree of an index.
+
+    The tree is walked once in order along with the sorted values. The
+    values left once `WALK_RATIO` times more keys than values have been
+    walked are looked up one by one, as they are sparse.
+    """
+    try:
+        values = sorted(set(values))
+    except TypeError:
+        return lookup_documents(tree, values)
+    if not values:
+        return []
+    found = []
+    position = 0
+    budget = len(values) * WALK_RATIO
+    try:
+        walked = tree.items(values[0], values[-1])
+        for count, (value, documents) in enumerate(walked):
+            if count >= budget:
+                break
+            while values[position] < value:
+                position += 1
+            if values[position] == value:
+                found.append(documents)
+                position += 1
+    except TypeError:
+        return lookup_documents(tree, values)
+    return found + lookup_documents(tree, values[position:])
+
+
+def other_documents(tree, value):
+    """Return the document sets indexed under any other value than the
+    given one in the forward index tree of an index.
+    """
+    try:
+        return list(itertools.chain(
+            tree.values(None, value, excludemax=True),
+            tree.values(value, None, excludemin=True)))
+    except TypeError:
+        return list(tree.values())
+
+
+def range_size(index, tree, minimum=None, maximum=None,
+               excludemin=False, excludemax=False):
+    """Estimate the number of documents indexed with a value in the
+    given range, assuming documents are evenly spread over the values.
+    """
+    words = index.wordCount()
+    if not words:
+        return 0
+    try:
+        keys = len(tree.keys(minimum, maximum, excludemin, excludemax))
+    except TypeError:
+        return 0
+    documents = index.documentCount()
+    return min(documents, documents * keys // words)
+
+
+def range_count(tree, minimum=None, maximum=None,
+                excludemin=False, excludemax=False):
+    """Return the number of documents indexed with a value in the
+    given range in the forward index tree of an index, without merging
+    their sets.
+    """
+    try:
+        return sum(
+            len(documents) for documents in
+            tree.values(minimum, maximum, excludemin, excludemax))
+    except TypeError:
+        return 0
+
+
+def prefetch(objects):
+    """Ask the database connections of the given persistent objects to
+    load the ones that are still ghosts, at once if the storage
+    supports it.
+    """
+    ghosts = {}
+    for obj in objects:
+        jar = getattr(obj, '_p_jar', None)
+        if jar is not None and getattr(obj, '_p_changed', False) is None:
+            ghosts.setdefault(jar, []).append(obj)
+    for jar, objs in ghosts.items():
+        # Connection.prefetch is only available in ZODB 5.
+        jar_prefetch = getattr(jar, 'prefetch', None)
+        if jar_prefetch is not None:
+            jar_prefetch(objs)
+
+
+def sort_mappings(index):
+    """Return the value to documents and document to value BTrees of
+    a sort index using zope.index's sorting mixin, or None.
+    """
+    forward = getattr(
+        index, getattr(index, '_sorting_fwd_index_attr', '_fwd_index'), None)
+    backward = getattr(
+        index, getattr(index, '_sorting_rev_index_attr', '_rev_index'), None)
+    if forward is None or backward is None:
+        return None
+    return forward, backward
+
+
+def facet_mappings(index):
+    """Return the value to documents and document to values BTrees of
+    an index, and whether documents can have several values, or None.
+    """
+    forward = getattr(index, 'values_to_documents', None)
+    backward = getattr(index, 'documents_to_values', None)
+    if forward is not None and backward is not None:
+        # zc.catalog's ValueIndex and SetIndex.
+        return forward, backward, ISetIndex.providedBy(index)
+    mappings = sort_mappings(index)
+    if mappings is None:
+        return None
+    return mappings + (False,)
+
+
+def facet_index(field, context):
+    """Return the index of a facet, given as an index or a `(catalog
+    name, index name)` tuple.
+    """
+    index = field
+    if isinstance(field, tuple):
+        catalog_name, index_name = field
+        index = getUtility(ICatalog, catalog_name, context)[index_name]
+    if facet_mappings(index) is None:
+        raise ValueError(f'Index {field} does not support facets.')
+    return index
+
+
+def facet_counts(index, docids, limit=None):
+    """Return how many of the docids are indexed under each value of
+    the index, the most frequent values first, or only the `limit`
+    most frequent ones.
+    """
+    forward, backward, multiple = facet_mappings(index)
+    if use_candidates(docids, index):
+        # Few documents, read their values.
+        counts = {}
+        for uid in docids:
+            values = backward.get(uid)
+            if values is None:
+                continue
+            if not multiple:
+                values = (values,)
+            for value in values:
+                counts[value] = counts.get(value, 0) + 1
+        counts = sorted(counts.items())
+    else:
+        # Count the documents of each value in one walk of the index.
+        counts = []
+        for value, documents in forward.items():
+            count = len(intersection(docids, documents))
+            if count:
+                counts.append((value, count))
+    if limit:
+        counts = heapq.nsmallest(limit, counts, key=lambda item: -item[1])
+    else:
+        counts.sort(key=lambda item: -item[1])
+    return dict(counts)
+
+
+def keyset_sort(index, docids, limit, reverse=False, after=None):
+    """Iterate over at most limit docids sorted on their value in the
+    index, then on their id.
+
+    With `reverse` the values are in descending order, while documents
+    with the same value stay ordered on their id, like `IIndexSort`
+    sorts all the documents. Optionally start after the `(value,
+    docid)` position given by `after`. Documents that are not in the
+    index are skipped.
+    """
+    forward, backward = sort_mappings(index)
+    if limit * index.documentCount() < len(docids) ** 2:
+        # The documents are dense enough in the index to find the
+        # first ones quickly walking the index in order.
+        sorted_docids = _walk_sort(forward, docids, reverse, after)
+    else:
+        marker = object()
+        entries = (
+            (backward.get(uid, marker), uid) for uid in docids)
+        entries = (entry for entry in entries if entry[0] is not marker)
+        if reverse:
+            def key(entry):
+                return (Descending(entry[0]), entry[1])
+        else:
+            def key(entry):
+                return entry
+        if after is not None:
+            after = key(tuple(after))
+            entries = (entry for entry in entries if key(entry) > after)
+        sorted_docids = (
+            e[1] for e in heapq.nsmallest(limit, entries, key=key))
+    return itertools.islice(sorted_docids, limit)
+
+
+def rank(scores, limit=None, reverse=False):
+    """Return the ids of the documents of `scores`, a mapping of
+    document ids to scores, from the best score to the worst, or the
+    `limit` best ones. Equal scores are ordered on the document id.
+    """
+    def key(item):
+        return (item[1], -item[0])
+
+    if limit:
+        select = heapq.nsmallest if reverse else heapq.nlargest
+        items = select(limit, scores.items(), key=key)
+    else:
+        items = sorted(scores.items(), key=key, reverse=not reverse)
+    return [uid for uid, _ in items]
+
+
+def _select(docids, start, stop, reverse):
+    if reverse:
+        docids = reversed(docids)
+    return itertools.islice(docids, start, stop)
+
+
+def _walk_sort(forward, docids, reverse, after):
+    if after is None:
+        buckets = forward.values()
+        if reverse:
+            buckets = reversed(buckets)
+    else:
+        value, last = after
+        ties = forward.get(value)
+        if ties is not None:
+            # Documents with the same value are sorted on their id,
+            # in both directions.
+            for uid in ties.keys(last, None, excludemin=True):
+                if uid in docids:
+                    yield uid
+        if reverse:
+            buckets = reversed(forward.values(None, value, excludemax=True))
+        else:
+            buckets = forward.values(value, None, excludemin=True)
+    for bucket in buckets:
+        for uid in bucket:
+            if uid in docids:
+                yield uid
+
+
+@functools.total_ordering
+class Descending:
+    """Wrap a value to sort it in descending order.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class SortOrder:
+    """Sort documents on their values in several indexes, each in
+    ascending or descending order, then on their id.
+
+    Documents not in the first index are skipped, documents without a
+    value in the other ones come last for those.
+    """
+
+    def __init__(self, fields, reverse=False):
+        # fields is a sequence of (index, descending) pairs.
+        self.fields = []
+        for index, descending in fields:
+            mappings = sort_mappings(index)
+            if mappings is None:
+                raise ValueError(
+                    'Sorting on several fields requires indexes with a '
+                    'reverse index, not {!r}.'.format(index))
+            self.fields.append((mappings[1], descending != reverse))
+
+    def values(self, uid):
+        return tuple(backward.get(uid) for backward, _ in self.fields)
+
+    def key(self, values, uid):
+        key = []
+        for value, (_, descending) in zip(values, self.fields):
+            if value is None:
+                key.append((1,))
+            elif descending:
+                key.append((0, Descending(value)))
+            else:
+                key.append((0, value))
+        # Like with one index, equal values are ordered on the id.
+        key.append(uid)
+        return tuple(key)
+
+    def sort(self, docids, limit=None, after=None):
+        """Return the sorted docids, at most limit of them, optionally
+        after the `(values, docid)` position given by `after`.
+        """
+        first = self.fields[0][0]
+        entries = (
+            (self.key(self.values(uid), uid), uid)
+            for uid in docids if uid in first)
+        if after is not None:
+            values, last = after
+            after_key = self.key(values, last)
+            entries = (entry for entry in entries if entry[0] > after_key)
+        if limit:
+            # Only keep the limit first entries in a heap.
+            entries = heapq.nsmallest(limit, entries)
+        else:
+            entries = sorted(entries)
+        return [uid for _, uid in entries]
+
+
+class Stream:
+    """Selected results iterated again from `iterate()` each time they
+    are needed, instead of being copied in a list.
+
+    `count()` returns their number, it is only called if needed.
+    """
+
+    def __init__(self, iterate, count):
+        self.iterate = iterate
+        self.count = count
+
+    @Lazy
+    def length(self):
+        return self.count()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return self.iterate()
 
 
 class Locator:
@@ -69,27 +594,109 @@ class Locator:
 
 @implementer(interfaces.IResults)
 class Results:
+    """Results of a query.
+
+    Selected document ids kept in a list are stored as an array. With
+    `compact`, the results of the query are not kept: selected ids are
+    stored as an array unless they are all of them.
+    """
+    __slots__ = (
+        'context', 'locate_to', 'wrapper', 'batch_size', 'continuation',
+        'profile', 'total', '__all', '__selected')
 
     def __init__(self, context, all_results, selected_results,
-                 wrapper=None, locate_to=None):
+                 wrapper=None, locate_to=None, batch_size=BATCH_SIZE,
+                 continuation=None, compact=False):
         self.context = context
         self.locate_to = locate_to
         self.wrapper = wrapper
-        self.__all = all_results
+        self.batch_size = batch_size
+        self.continuation = continuation
+        self.profile = None
+        self.total = len(all_results)
+        if isinstance(selected_results, list) or (
+                compact and selected_results is not all_results):
+            selected_results = array('i', selected_results)
+        self.__all = None if compact else all_results
         self.__selected = selected_results
 
-    @Lazy
-    def get(self):
-        get = getUtility(IIntIds, '', self.context).getObject
-        if self.wrapper is not None:
-            get = (lambda get: lambda id: self.wrapper(get(id)))(get)
-        if self.locate_to is not None:
-            return Locator(self.locate_to, get)
-        return get
+    @property
+    def getObject(self):
+        return getUtility(IIntIds, '', self.context).getObject
 
     @property
-    def total(self):
-        return len(self.__all)
+    def wrap(self):
+        wrap = self.wrapper
+        if self.locate_to is not None:
+            wrap = Locator(self.locate_to, wrap or (lambda obj: obj))
+        return wrap
+
+    def get(self, uid):
+        obj = self.getObject(uid)
+        wrap = self.wrap
+        if wrap is not None:
+            return wrap(obj)
+        return obj
+
+    def load(self, uids):
+        """Return the objects for the given uids, loading them from the
+        database at once.
+        """
+        get = self.getObject
+        objects = [get(uid) for uid in uids]
+        prefetch(objects)
+        wrap = self.wrap
+        if wrap is not None:
+            objects = [wrap(obj) for obj in objects]
+        return objects
+
+    def batches(self):
+        """Iterate over the matching objects, by lists of `batch_size`
+        objects loaded at once.
+        """
+        uids = iter(self.__selected)
+        while True:
+            batch = list(itertools.islice(uids, self.batch_size))
+            if not batch:
+                return
+            yield self.load(batch)
+
+    async def abatches(self, executor=None):
+        """Asynchronously iterate over the batches of matching objects,
+        each of them loaded by a thread of the executor.
+        """
+        if executor is None:
+            executor = default_async_executor()
+        loop = asyncio.get_running_loop()
+        batches = self.batches()
+        while True:
+            batch = await loop.run_in_executor(executor, next, batches, None)
+            if batch is None:
+                return
+            yield batch
+
+    async def __aiter__(self):
+        async for batch in self.abatches():
+            for obj in batch:
+                yield obj
+
+    def score(self, uid):
+        """Return the score of a document of ranked results, or None
+        if the results of the query have no scores.
+        """
+        if self.__all is None:
+            raise ValueError('Compact results do not keep scores.')
+        if not hasattr(self.__all, 'items'):
+            return None
+        return self.__all[uid]
+
+    def facets(self, fields, limit=None):
+        if self.__all is None:
+            raise ValueError('Compact results cannot count facets.')
+        return {
+            field: facet_counts(
+                facet_index(field, self.context), self.__all, limit)
+            for field in fields}
 
     @property
     def count(self):
@@ -103,8 +710,25 @@ class Results:
         return len(self.__selected)
 
     def __iter__(self):
-        for uid in self.__selected:
-            yield self.get(uid)
+        for batch in self.batches():
+            yield from batch
+
+    def __getitem__(self, index):
+        selected = self.__selected
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(selected))
+            if step > 0:
+                uids = itertools.islice(selected, start, stop, step)
+            else:
+                uids = list(selected)[index]
+            # Only the objects in the slice are loaded.
+            return self.load(uids)
+        if index < 0:
+            index += len(selected)
+        if index >= 0:
+            for uid in itertools.islice(selected, index, None):
+                return self.get(uid)
+        raise IndexError(index)
 
 
 @implementer(interfaces.IResults)
@@ -112,21 +736,41 @@ class NoResults:
 
     count = 0
     total = 0
+    continuation = None
+    profile = None
 
     def first(self):
         return None
 
+    def score(self, uid):
+        return None
+
+    def facets(self, fields, limit=None):
+        return {field: {} for field in fields}
+
     def __len__(self):
         return 0
 
     def __iter__(self):
         return iter([])
 
+    async def __aiter__(self):
+        return
+        yield
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return []
+        raise IndexError(index)
+
 
 no_results = NoResults()
 
 
 class Timing:
+    __slots__ = (
+        'key', 'start', 'start_order', 'end', 'end_order', 'cardinality',
+        'cached', 'children')
 
     def __init__(self, key=None, order=0):
         self.key = key
@@ -134,10 +778,15 @@ class Timing:
         self.start_order = order
         self.end = None
         self.end_order = None
+        self.cardinality = None
+        self.cached = False
+        self.children = []
 
-    def done(self, order=0):
+    def done(self, order=0, result=None):
         self.end = _perf_counter()
         self.end_order = order
+        if result is not None:
+            self.cardinality = len(result)
 
     @property
     def total(self):
@@ -153,6 +802,9 @@ class TimingAwareCache:
         self.timing = {}
         self.count = 0
         self.post = None
+        # Tree of the timings of evaluated and cached terms.
+        self.terms = []
+        self.stack = []
 
     def start_post(self):
         self.post = Timing()
@@ -162,16 +814,29 @@ class TimingAwareCache:
 
     def __setitem__(self, key, value):
         self.cache[key] = value
+        self.uncached(key, value)
+
+    def uncached(self, key, value):
+        # Called by terms for results they do not cache.
         timing = self.timing.get(key)
         if timing is not None:
-            timing.done(self.count)
+            timing.done(self.count, value)
             self.count += 1
+            if timing in self.stack:
+                del self.stack[self.stack.index(timing):]
 
     def get(self, key):
         value = self.cache.get(key)
+        siblings = self.stack[-1].children if self.stack else self.terms
         if value is None:
-            self.timing[key] = Timing(key, self.count)
+            timing = self.timing[key] = Timing(key, self.count)
             self.count += 1
+            self.stack.append(timing)
+        else:
+            timing = Timing(key)
+            timing.cached = True
+            timing.done(result=value)
+        siblings.append(timing)
         return value
 
     def report(self, over=0):
@@ -201,106 +866,791 @@ class TimingAwareCache:
                 order.pop()
 
 
+class ConcurrentCache:
+    """Let the threads of an executor evaluate the terms of a query.
+
+    Results computed by the workers are kept with a lock, then given to
+    the wrapped cache by the thread of the query once they are done, as
+    this cache can be thread-local or bound to the transaction of the
+    thread. Workers do not read the wrapped cache either.
+    """
+
+    def __init__(self, cache, executor):
+        self.cache = cache
+        self.executor = executor
+        self.owner = threading.get_ident()
+        self.lock = threading.Lock()
+        self.results = {}
+        self.pending = []
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+        if threading.get_ident() == self.owner:
+            value = self.cache.get(key)
+            if value is not None:
+                return value
+        return default
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.results[key] = value
+            if threading.get_ident() != self.owner:
+                self.pending.append(key)
+                return
+        self.cache[key] = value
+
+    def apply_terms(self, terms, context=None, candidates=None):
+        """Evaluate terms at the same time and return their results in
+        the same order, or None when they should be evaluated in turn.
+
+        Only the thread of the query submits terms: the terms of the
+        terms evaluated by a worker are evaluated by this worker.
+        """
+        if threading.get_ident() != self.owner:
+            return None
+        # Only the terms missing from the cache are given to workers,
+        # that share the indexes looked up by this thread.
+        pending = [self.lookup(term, context) for term in terms[1:]]
+        pending = [
+            self.executor.submit(
+                contextvars.copy_context().run,
+                term.cached_apply, self, context, candidates)
+            if result is None else result
+            for term, result in zip(terms[1:], pending)]
+        futures = [
+            future for future in pending
+            if isinstance(future, concurrent.futures.Future)]
+        try:
+            results = [terms[0].cached_apply(self, context, candidates)]
+            results.extend(
+                future.result()
+                if isinstance(future, concurrent.futures.Future) else future
+                for future in pending)
+        finally:
+            for future in futures:
+                future.cancel()
+            self.flush()
+        return results
+
+    def lookup(self, term, context=None):
+        """Return the cached results of a term, or None.
+        """
+        try:
+            key = term.cached_key(context)
+        except NotImplementedError:
+            return None
+        return self.get(key)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            results = [(key, self.results[key]) for key in pending]
+        for key, value in results:
+            self.cache[key] = value
+
+
+class DeferredCache:
+    """Cache of a query evaluated by another thread.
+
+    Results are kept, then given to the wrapped cache by the thread of
+    the query once it is done, as this cache can be thread-local or
+    bound to the transaction of the thread. The other thread reads a
+    snapshot of the wrapped cache taken by the thread of the query, if
+    the cache can make one, or a copy of it if it is a dictionary.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.results = {}
+        snapshot = getattr(cache, 'snapshot', None)
+        if snapshot is not None:
+            self.cached = snapshot()
+        elif isinstance(cache, dict):
+            self.cached = dict(cache)
+        else:
+            self.cached = {}
+
+    def get(self, key, default=None):
+        if key in self.results:
+            return self.results[key]
+        return self.cached.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.results[key] = value
+
+    def flush(self):
+        for key, value in self.results.items():
+            self.cache[key] = value
+
+
+class Parameter:
+    """A placeholder for a value of a term of a compiled query, given
+    when it is executed.
+
+    Lists and sets are given to terms as tuples, to be part of keys.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def bind(self, parameters):
+        try:
+            value = parameters[self.name]
+        except KeyError:
+            raise KeyError(f'Missing query parameter {self.name!r}')
+        if isinstance(value, (list, set, frozenset)):
+            value = tuple(value)
+        return value
+
+    def __repr__(self):
+        return f'<Parameter {self.name!r}>'
+
+
+def compile_value(value, context):
+    """Compile the terms found in an attribute of a term, return the
+    compiled value and if it contains parameters.
+    """
+    if isinstance(value, Parameter):
+        return value, True
+    if isinstance(value, Term):
+        return compile_term(value, context)
+    if isinstance(value, tuple):
+        compiled = [compile_value(item, context) for item in value]
+        return (tuple(item for item, _ in compiled),
+                any(parametrized for _, parametrized in compiled))
+    return value, False
+
+
+def term_attributes(term):
+    """Return the attributes of a term by name, from its slots and its
+    dictionary.
+    """
+    attributes = {}
+    for cls in reversed(type(term).__mro__):
+        slots = cls.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name not in ('__dict__', '__weakref__') and hasattr(term, name):
+                attributes[name] = getattr(term, name)
+    attributes.update(getattr(term, '__dict__', {}))
+    return attributes
+
+
+def compile_term(term, context):
+    compiled = copy.copy(term)
+    parametrized = False
+    for name, value in term_attributes(term).items():
+        value, has_parameters = compile_value(value, context)
+        setattr(compiled, name, value)
+        parametrized = parametrized or has_parameters
+    if isinstance(compiled, IndexTerm):
+        compiled.compiled_index = compiled.getIndex(context)
+    if isinstance(compiled, And):
+        # Filled once the first time the terms are planned, and shared
+        # with the copies binding parameters.
+        compiled.compiled_order = []
+    # The key of a term with parameters is only known once bound.
+    compiled.compiled_key = None if parametrized else compiled.key(context)
+    return compiled, parametrized
+
+
+def bind_value(value, parameters, context):
+    if isinstance(value, Parameter):
+        return value.bind(parameters)
+    if isinstance(value, Term):
+        return bind_term(value, parameters, context)
+    if isinstance(value, tuple):
+        return tuple(bind_value(item, parameters, context) for item in value)
+    return value
+
+
+def bind_term(term, parameters, context):
+    if term.compiled_key is not None:
+        # Nothing to bind in this term.
+        return term
+    bound = copy.copy(term)
+    for name, value in term_attributes(term).items():
+        setattr(bound, name, bind_value(value, parameters, context))
+    bound.compiled_key = bound.key(context)
+    return bound
+
+
+class Plan:
+    """A query compiled to be executed many times with different
+    parameters.
+
+    The indexes of the terms are looked up once per site, the keys of
+    the terms without parameters computed once, and the terms of `And`
+    evaluated in the order planned the first time.
+
+    Indexes are kept until `clear` is called, which must be done if
+    they are replaced in their catalogs.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.sites = weakref.WeakKeyDictionary()
+
+    def compile(self, context):
+        compiled = self.sites.get(context)
+        if compiled is None:
+            compiled, _ = compile_term(
+                self.query.normalize(context), context)
+            self.sites[context] = compiled
+        return compiled
+
+    def bind(self, context, parameters):
+        """Return the compiled query for the site of context, with the
+        given parameters.
+        """
+        return bind_term(self.compile(context), parameters, context)
+
+    def clear(self):
+        self.sites.clear()
+
+
+def term_key(term, context=None):
+    try:
+        return term.cached_key(context)
+    except NotImplementedError:
+        return None
+
+
+def explain_term(term, timing, context=None):
+    """Return the explanation of a term, evaluated with a
+    `TimingAwareCache` that gave its `timing`.
+
+    Its terms are listed in the order they were evaluated, followed by
+    the ones that were not evaluated.
+    """
+    planned = list(term.children(context)) if term is not None else []
+    terms = {}
+    for child in planned:
+        terms.setdefault(term_key(child, context), child)
+    children = []
+    evaluated = set()
+    for child_timing in (timing.children if timing is not None else ()):
+        evaluated.add(child_timing.key)
+        children.append(explain_term(
+            terms.get(child_timing.key), child_timing, context))
+    for child in planned:
+        if term_key(child, context) not in evaluated:
+            children.append(explain_term(child, None, context))
+    explanation = Explanation(
+        key=timing.key if timing is not None else term_key(term, context),
+        children=children)
+    if term is not None:
+        explanation.estimate = term.estimate(context)
+        explanation.operation = term.operation
+    if timing is not None:
+        explanation.evaluated = True
+        explanation.elapsed = timing.total
+        explanation.cardinality = timing.cardinality
+        explanation.cached = timing.cached
+        explanation.short_circuit = not timing.cached and any(
+            not child.evaluated for child in children)
+    return explanation
+
+
 @implementer(interfaces.IQuery)
 class Query:
+    # Sink recording the profiles of queries done without a profile.
+    recorder = None
 
     def searchResults(
             self, query, context=None, sort_field=None, limit=None,
             reverse=False, start=0, caching=None, timing=HURRY_QUERY_TIMING,
-            wrapper=None, locate_to=None):
+            wrapper=None, locate_to=None, batch_size=BATCH_SIZE,
+            after=None, profile=None, executor=None, parameters=None,
+            stream=False, compact=False, ranked=False):
 
-        if context is None:
-            context = getSiteManager()
-        else:
-            context = IComponentLookup(context)
+        query, context, cache = self.prepare(
+            query, context, caching, parameters)
 
-        if caching in (True, False, None):
-            cache = {}
-        else:
-            # A custom cache object was injected, use it.
-            cache = caching
+        recorder = None
+        if (not profile and self.recorder is not None and
+                self.recorder.sampled()):
+            # Profiled only to be recorded, results are left as is.
+            recorder = self.recorder
+
+        if executor is None:
+            executor = default_executor()
 
         timer = None
-        if timing:
+        if timing or profile or recorder:
+            # Terms are evaluated in turn to time them.
             timer = cache = TimingAwareCache(cache)
-        all_results = query.cached_apply(cache, context)
+        elif executor:
+            cache = ConcurrentCache(cache, executor)
+        # Indexes are looked up once while evaluating the terms.
+        with indexes_scope(context):
+            all_results = query.cached_apply(cache, context)
         if not all_results:
             if timer is not None:
-                timer.report(over=timing)
+                if timing:
+                    timer.report(over=timing)
+                if recorder:
+                    self.profile(timer, recorder)
+                if profile:
+                    results = NoResults()
+                    results.profile = self.profile(timer, profile)
+                    return results
             return no_results
 
         if timer is not None:
             timer.start_post()
 
         is_iterator = False
-        if sort_field is not None:
-            # Like in zope.catalog's searchResults we require the given
-            # index to sort on to provide IIndexSort. We bail out if
-            # the index does not.
-            if not IIndexSort.providedBy(sort_field):
-                assert isinstance(sort_field, tuple) and len(sort_field) == 2
-                catalog_name, index_name = sort_field
-                catalog = getUtility(ICatalog, catalog_name, context)
-                sort_field = catalog[index_name]
-                if not IIndexSort.providedBy(sort_field):
-                    raise ValueError(
-                        'Index {} in catalog {} does not support '
-                        'sorting.'.format(index_name, catalog_name))
+        continuation = None
+        if ranked and sort_field is not None:
+            raise ValueError(
+                'Results are either ranked or sorted on a field.')
+        if (isinstance(sort_field, tuple) and len(sort_field) == 2 and
+                isinstance(sort_field[1], bool) and
+                self.isSortField(sort_field[0])):
+            # One sort field with its direction.
+            sort_field = [sort_field]
+        if sort_field is not None and not self.isSortField(sort_field):
+            # Several sort fields, with an optional direction each.
+            if after is not None and not limit:
+                raise ValueError(
+                    'Continuing after a previous page requires a limit.')
+            fields = []
+            for field in sort_field:
+                descending = False
+                if (isinstance(field, tuple) and len(field) == 2 and
+                        isinstance(field[1], bool)):
+                    field, descending = field
+                fields.append((self.getSortIndex(field, context), descending))
+            order = SortOrder(fields, reverse)
+            sort_limit = limit and start + limit or None
+            selected_results = order.sort(all_results, sort_limit, after)
+            if start:
+                selected_results = selected_results[start:]
+            if selected_results:
+                last = selected_results[-1]
+                continuation = (order.values(last), last)
+        elif sort_field is not None:
+            sort_field = self.getSortIndex(sort_field, context)
             sort_limit = None
             if limit:
                 sort_limit = limit
                 if start:
                     sort_limit += start
-            selected_results = sort_field.sort(
-                all_results,
-                limit=sort_limit,
-                reverse=reverse)
-            if start:
-                selected_results = itertools.islice(
-                    selected_results, start, None)
-            is_iterator = True
+            mappings = sort_mappings(sort_field)
+            if sort_limit and mappings is not None:
+                # Pages are sorted on the value then on the document
+                # id, to be able to continue after the last one.
+                selected_results = list(itertools.islice(keyset_sort(
+                    sort_field, all_results, sort_limit, reverse, after),
+                    start, None))
+                if selected_results:
+                    last = selected_results[-1]
+                    continuation = (mappings[1][last], last)
+            elif after is not None:
+                raise ValueError(
+                    'Continuing after a previous page requires a limit '
+                    'and a sort field using a forward and a reverse '
+                    'index.')
+            elif stream and mappings is not None:
+                # Walk the index in order: documents are never sorted
+                # nor kept in memory.
+                forward, backward = mappings
+
+                def iterate():
+                    return itertools.islice(
+                        _walk_sort(forward, all_results, reverse, None),
+                        start, None)
+
+                def count():
+                    # Documents without a value are not in the results.
+                    found = sum(1 for uid in all_results if uid in backward)
+                    return max(found - start, 0)
+
+                selected_results = Stream(iterate, count)
+            else:
+                selected_results = sort_field.sort(
+                    all_results,
+                    limit=sort_limit,
+                    reverse=reverse)
+                if start:
+                    selected_results = itertools.islice(
+                        selected_results, start, None)
+                is_iterator = True
         else:
+            if after is not None:
+                raise ValueError(
+                    'Continuing after a previous page requires a sort field.')
             # There's no sort_field given. We still allow to reverse
             # and/or limit the resultset. This mimics zope.catalog's
             # searchResults semantics.
             selected_results = all_results
-            if reverse:
-                selected_results = reversed(selected_results)
-                is_iterator = True
-            if limit or start:
-                slice_end = limit and start + limit or None
-                selected_results = itertools.islice(
-                    selected_results, start, slice_end)
-                is_iterator = True
+            if ranked and hasattr(all_results, 'items'):
+                # Only the best documents are sorted on their score.
+                rank_limit = limit and start + limit or None
+                selected_results = rank(all_results, rank_limit, reverse)
+                if start:
+                    selected_results = selected_results[start:]
+            elif reverse or limit or start:
+                # The selected results are read from all the results
+                # when iterating over them, and counted without it.
+                size = len(all_results)
+                stop = min(start + limit, size) if limit else size
+                count = max(stop - start, 0)
+                selected_results = Stream(
+                    functools.partial(
+                        _select, all_results, start, stop, reverse),
+                    lambda: count)
 
         if is_iterator:
             selected_results = list(selected_results)
 
+        results = Results(
+            context, all_results, selected_results, wrapper, locate_to,
+            batch_size, continuation, compact)
+
         if timer is not None:
             timer.end_post()
-            timer.report(over=timing)
+            if timing:
+                timer.report(over=timing)
+            if recorder:
+                self.profile(timer, recorder)
+            if profile:
+                results.profile = self.profile(timer, profile)
+
+        return results
+
+    def count(self, query, context=None, caching=None, parameters=None):
+        query, context, cache = self.prepare(
+            query, context, caching, parameters)
+        with indexes_scope(context):
+            return query.count(cache, context)
+
+    def exists(self, query, context=None, caching=None, parameters=None):
+        query, context, cache = self.prepare(
+            query, context, caching, parameters)
+        with indexes_scope(context):
+            return query.exists(cache, context)
+
+    def facets(self, query, fields, context=None, limit=None,
+               caching=None, parameters=None):
+        query, context, cache = self.prepare(
+            query, context, caching, parameters)
+        with indexes_scope(context):
+            results = query.cached_apply(cache, context)
+        return {
+            field: facet_counts(facet_index(field, context), results, limit)
+            for field in fields}
+
+    def searchResultsMany(self, queries, context=None, caching=None, **kw):
+        context = self.lookupContext(context)
+        if caching is None or caching is False:
+            # The terms shared by the queries are evaluated once.
+            caching = {}
+        prepared = [
+            self.prepare(query, context, caching, kw.get('parameters'))[0]
+            for query in queries]
+        # Indexes, including the sort ones, are looked up once for all
+        # the queries.
+        with indexes_scope(context):
+            cache = self.lookupCache(caching)
+            for term in shared_terms(prepared, context):
+                # Evaluated without candidates to be cached for all the
+                # queries using it.
+                term.cached_apply(cache, context)
+            return [
+                self.searchResults(query, context, caching=caching, **kw)
+                for query in prepared]
+
+    async def asearchResults(
+            self, query, context=None, caching=None, async_executor=None,
+            **kw):
+        # The site and the cache are the ones of the calling thread.
+        context = self.lookupContext(context)
+        cache = DeferredCache(self.lookupCache(caching))
+        if async_executor is None:
+            async_executor = default_async_executor()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                async_executor, contextvars.copy_context().run,
+                functools.partial(
+                    self.searchResults, query, context, caching=cache,
+                    **kw))
+        finally:
+            cache.flush()
+
+    def lookupContext(self, context):
+        if context is None:
+            return getSiteManager()
+        return IComponentLookup(context)
+
+    def explain(self, query, context=None, caching=None, parameters=None):
+        query, context, cache = self.prepare(
+            query, context, caching, parameters)
+        timer = TimingAwareCache(cache)
+        # Terms without a key are not timed.
+        root = Timing(None)
+        with indexes_scope(context):
+            result = query.cached_apply(timer, context)
+        root.done(result=result)
+        key = term_key(query, context)
+        if key is not None and timer.terms and timer.terms[0].key == key:
+            root = timer.terms[0]
+        else:
+            root.children = timer.terms
+        return explain_term(query, root, context)
 
-        return Results(
-            context, all_results, selected_results, wrapper, locate_to)
+    def prepare(self, query, context, caching, parameters):
+        context = self.lookupContext(context)
+
+        if isinstance(query, Plan):
+            query = query.bind(context, parameters or {})
+        else:
+            query = query.normalize(context)
+
+        return query, context, self.lookupCache(caching)
+
+    def lookupCache(self, caching):
+        if caching is True:
+            return transaction_cache
+        if caching is False or caching is None:
+            return {}
+        # A custom cache object was injected, use it.
+        return caching
+
+    def compile(self, query):
+        return Plan(query)
+
+    def profile(self, timer, sink):
+        result = Profile(timer.terms, timer.post)
+        if sink is not True:
+            sink.record(result)
+        return result
+
+    def isSortField(self, sort_field):
+        """Tell if sort_field is one index, not a sequence of them.
+        """
+        if IIndexSort.providedBy(sort_field):
+            return True
+        return (
+            isinstance(sort_field, tuple) and len(sort_field) == 2 and
+            isinstance(sort_field[0], str) and isinstance(sort_field[1], str))
+
+    def getSortIndex(self, sort_field, context):
+        # Like in zope.catalog's searchResults we require the given
+        # index to sort on to provide IIndexSort. We bail out if
+        # the index does not.
+        if not IIndexSort.providedBy(sort_field):
+            if not self.isSortField(sort_field):
+                raise ValueError(
+                    'Sort field {!r} is neither an index nor a (catalog '
+                    'name, index name) pair. Several sort fields are '
+                    'given as a list, each of them optionally as a '
+                    '(sort_field, descending) pair.'.format(sort_field))
+            catalog_name, index_name = sort_field
+            sort_field = lookup_index(catalog_name, index_name, context)
+            if not IIndexSort.providedBy(sort_field):
+                raise ValueError(
+                    'Index {} in catalog {} does not support '
+                    'sorting.'.format(index_name, catalog_name))
+        return sort_field
+
+
+def unique_terms(terms, context=None):
+    """Return the terms without the ones with the same key as a
+    previous one.
+    """
+    unique = []
+    keys = set()
+    for term in terms:
+        try:
+            key = term.cached_key(context)
+            if key in keys:
+                continue
+            keys.add(key)
+        except (NotImplementedError, TypeError):
+            # Without a key, or a key that cannot be hashed.
+            pass
+        unique.append(term)
+    return unique
+
+
+def shared_terms(terms, context=None):
+    """Return the terms using candidates found in more than one of the
+    terms, in the order they are found.
+
+    Evaluated with candidates, their results are not cached, so they
+    would be evaluated again by each term using them.
+    """
+    found = {}
+    counts = collections.Counter()
+    for term in terms:
+        keys = set()
+        remaining = [term]
+        while remaining:
+            term = remaining.pop()
+            remaining.extend(reversed(term.children(context)))
+            if not term.use_candidates:
+                continue
+            try:
+                key = term.cached_key(context)
+                if key not in keys:
+                    keys.add(key)
+                    found.setdefault(key, term)
+            except (NotImplementedError, TypeError):
+                # Without a key, or a key that cannot be hashed.
+                pass
+        counts.update(keys)
+    return [found[key] for key, count in counts.items() if count > 1]
+
+
+def same_terms(terms, others):
+    """Tell if two sequences of terms are the same instances.
+    """
+    return len(terms) == len(others) and all(
+        term is other for term, other in zip(terms, others))
+
+
+def merge_terms(terms, union=False):
+    """Return the terms with the ones that can be merged together, like
+    the ranges of the same index, replaced by a single term matching
+    the documents of all of them, or any of them if `union`.
+    """
+    merged = []
+    for term in terms:
+        for position, other in enumerate(merged):
+            merge = getattr(other, 'merge', None)
+            combined = merge(term, union) if merge is not None else None
+            if combined is not None:
+                merged[position] = combined
+                break
+        else:
+            merged.append(term)
+    return merged
+
+
+def _bound(one, other, tighter, upper):
+    # Choose between two (value, excluded) bounds of ranges, None
+    # values being unbounded.
+    (value1, excluded1), (value2, excluded2) = one, other
+    if value1 is None or value2 is None:
+        if tighter:
+            return other if value1 is None else one
+        return None, False
+    if value1 == value2:
+        if tighter:
+            return value1, excluded1 or excluded2
+        return value1, excluded1 and excluded2
+    first = value1 < value2 if upper else value1 > value2
+    return one if first == tighter else other
+
+
+def _before(maximum, exclude_max, minimum, exclude_min):
+    # Tell if a range ending at maximum stops before one starting at
+    # minimum, without any value between them being known.
+    if maximum is None or minimum is None:
+        return False
+    if maximum == minimum:
+        return exclude_max and exclude_min
+    return maximum < minimum
+
+
+def merge_ranges(first, second, union=False):
+    """Return the intersection of two `(minimum, maximum, exclude_min,
+    exclude_max)` ranges, or their union if `union`.
+
+    Return None if the union is not a range, or if values cannot be
+    compared.
+    """
+    if any(isinstance(value, Parameter) for value in first + second):
+        return None
+    min1, max1, exclude_min1, exclude_max1 = first
+    min2, max2, exclude_min2, exclude_max2 = second
+    try:
+        if union and (
+                _before(max1, exclude_max1, min2, exclude_min2) or
+                _before(max2, exclude_max2, min1, exclude_min1)):
+            return None
+        minimum = _bound(
+            (min1, exclude_min1), (min2, exclude_min2), not union, False)
+        maximum = _bound(
+            (max1, exclude_max1), (max2, exclude_max2), not union, True)
+    except TypeError:
+        return None
+    return minimum[0], maximum[0], minimum[1], maximum[1]
 
 
 @implementer(interfaces.ITerm)
 class Term:
+    __slots__ = ('_compiled_key',)
+    # Set to True if apply accepts a candidates argument.
+    use_candidates = False
+    # Set operation combining the results of the terms of this term.
+    operation = None
+
+    @property
+    def compiled_key(self):
+        # Key of the term, once computed by a compiled query or by
+        # cached_key.
+        return getattr(self, '_compiled_key', None)
+
+    @compiled_key.setter
+    def compiled_key(self, key):
+        self._compiled_key = key
 
     def key(self, context=None):
         raise NotImplementedError()
 
+    def cached_key(self, context=None):
+        """Return the key of the term, computed only once.
+        """
+        key = self.compiled_key
+        if key is None:
+            key = self.compiled_key = self.key(context)
+        return key
+
     def apply(self, cache, context=None):
         raise NotImplementedError()
 
-    def cached_apply(self, cache, context=None):
+    def normalize(self, context=None):
+        return self
+
+    def children(self, context=None):
+        return ()
+
+    def estimate(self, context=None):
+        return None
+
+    def count(self, cache, context=None):
+        return len(self.cached_apply(cache, context))
+
+    def exists(self, cache, context=None):
+        return self.count(cache, context) > 0
+
+    def cached_apply(self, cache, context=None, candidates=None):
+        if not self.use_candidates:
+            candidates = None
         try:
-            key = self.key(context)
+            key = self.cached_key(context)
         except NotImplementedError:
-            return self.apply(cache, context)
+            if candidates is None:
+                return self.apply(cache, context)
+            return self.apply(cache, context, candidates)
         cached = cache.get(key)
         if cached is not None:
             return cached
+        if candidates is not None:
+            # Results restricted to candidates are incomplete and
+            # cannot be cached.
+            result = self.apply(cache, context, candidates)
+            uncached = getattr(cache, 'uncached', None)
+            if uncached is not None:
+                uncached(key, result)
+            return result
         result = self.apply(cache, context)
         cache[key] = result
         return result
@@ -322,30 +1672,74 @@ class Term:
 
 
 class And(Term):
+    __slots__ = ('terms', 'weighted', '_compiled_order')
+    use_candidates = True
+
+    @property
+    def compiled_order(self):
+        # Order of the terms, once planned by a compiled query.
+        return getattr(self, '_compiled_order', None)
+
+    @compiled_order.setter
+    def compiled_order(self, order):
+        self._compiled_order = order
 
     def __init__(self, *terms, **kwargs):
         self.terms = terms
         self.weighted = kwargs.get('weighted', False)
 
-    def apply(self, cache, context=None):
-        results = []
-        for term in self.terms:
-            result = term.cached_apply(cache, context)
-            if not result:
+    @property
+    def operation(self):
+        if self.weighted:
+            return 'weighted intersection'
+        return 'intersection'
+
+    def children(self, context=None):
+        return self.plan(context)
+
+    def plan(self, context=None):
+        """Return the terms in the order they should be evaluated:
+        the ones expected to return the fewest results first, the ones
+        we cannot estimate last.
+
+        ``Not`` terms always come at the end: evaluated with what
+        already matched as candidates, they are only a difference and
+        never need their universe.
+        """
+        if self.compiled_order:
+            return [self.terms[i] for i in self.compiled_order]
+        estimates = [term.estimate(context) for term in self.terms]
+        order = sorted(
+            range(len(self.terms)),
+            key=lambda i: (
+                isinstance(self.terms[i], Not),
+                estimates[i] is None,
+                estimates[i] or 0))
+        if self.compiled_order is not None:
+            self.compiled_order[:] = order
+        return [self.terms[i] for i in order]
+
+    def apply(self, cache, context=None, candidates=None):
+        result = None
+        terms = self.plan(context)
+        # Terms that do not use what already matched can be evaluated
+        # at the same time.
+        done = concurrent_results(
+            cache, [term for term in terms if not term.use_candidates],
+            context)
+        for term in terms:
+            r = done.get(id(term))
+            if r is None:
+                # Terms only need to produce results that are in what
+                # already matched.
+                r = term.cached_apply(
+                    cache, context, candidates if result is None else result)
+            if not r:
                 # Empty results
-                return result
-            results.append(result)
-
-        if len(results) == 1:
-            return results[0]
-
-        # Sort results to have the smallest set first to optimize the
-        # set operation.
-        results.sort(key=lambda r: len(r))
-
-        result = results.pop(0)
-        for r in results:
-            if self.weighted:
+                return r
+            if result is None:
+                result = r
+            elif self.weighted:
                 _, result = weightedIntersection(result, r)
             else:
                 result = intersection(result, r)
@@ -353,21 +1747,83 @@ class And(Term):
                 # Empty results
                 return result
 
+        if result is None:
+            return IFSet()
         return result
 
+    def normalize(self, context=None):
+        terms = []
+        for term in self.terms:
+            term = term.normalize(context)
+            if type(term) is type(self) and term.weighted == self.weighted:
+                terms.extend(term.terms)
+            else:
+                terms.append(term)
+        if not self.weighted:
+            # Repeated terms add to the scores of weighted terms.
+            terms = merge_terms(unique_terms(terms, context))
+            terms = [term.normalize(context) for term in terms]
+        if same_terms(terms, self.terms):
+            return self
+        return type(self)(*terms, weighted=self.weighted)
+
+    def exists(self, cache, context=None):
+        results = []
+        for term in self.plan(context):
+            # Terms only need to produce results that are in the first
+            # ones, expected to be the smallest.
+            r = term.cached_apply(
+                cache, context, results[0] if results else None)
+            if not r:
+                return False
+            results.append(r)
+        if not results:
+            return False
+        # Look for a document of the smallest results in the others,
+        # instead of computing the whole intersection.
+        results.sort(key=len)
+        smallest, others = results[0], results[1:]
+        return any(
+            all(uid in other for other in others) for uid in smallest)
+
+    def estimate(self, context=None):
+        estimates = [
+            e for e in (term.estimate(context) for term in self.terms)
+            if e is not None]
+        if not estimates:
+            return None
+        return min(estimates)
+
     def key(self, context=None):
-        return ('and',) + tuple(term.key(context) for term in self.terms)
+        kind = 'weighted and' if self.weighted else 'and'
+        return (kind,) + tuple(
+            term.cached_key(context) for term in self.terms)
 
 
 class Or(Term):
+    __slots__ = ('terms', 'weighted')
+    use_candidates = True
 
-    def __init__(self, *terms):
+    def __init__(self, *terms, **kwargs):
         self.terms = terms
+        self.weighted = kwargs.get('weighted', False)
 
-    def apply(self, cache, context=None):
+    @property
+    def operation(self):
+        if self.weighted:
+            return 'weighted union'
+        return 'union'
+
+    def children(self, context=None):
+        return self.terms
+
+    def apply(self, cache, context=None, candidates=None):
         results = []
+        done = concurrent_results(cache, self.terms, context, candidates)
         for term in self.terms:
-            result = term.cached_apply(cache, context)
+            result = done.get(id(term))
+            if result is None:
+                result = term.cached_apply(cache, context, candidates)
             # empty results
             if not result:
                 continue
@@ -377,63 +1833,190 @@ class Or(Term):
             return IFSet()
         if len(results) == 1:
             return results[0]
+        if self.weighted:
+            # The scores of a document in each results are added.
+            result = results[0]
+            for r in results[1:]:
+                _, result = weightedUnion(result, r)
+            return result
 
         return multiunion(results)
 
+    def normalize(self, context=None):
+        terms = []
+        for term in self.terms:
+            term = term.normalize(context)
+            if type(term) is type(self) and term.weighted == self.weighted:
+                terms.extend(term.terms)
+            else:
+                terms.append(term)
+        if not self.weighted:
+            terms = merge_terms(unique_terms(terms, context), union=True)
+            terms = [term.normalize(context) for term in terms]
+        if same_terms(terms, self.terms):
+            return self
+        return type(self)(*terms, weighted=self.weighted)
+
+    def exists(self, cache, context=None):
+        # Stop at the first term with results.
+        return any(term.exists(cache, context) for term in self.terms)
+
+    def estimate(self, context=None):
+        total = 0
+        for term in self.terms:
+            estimate = term.estimate(context)
+            if estimate is None:
+                return None
+            total += estimate
+        return total
+
     def key(self, context=None):
-        return ('or',) + tuple(term.key(context) for term in self.terms)
+        kind = 'weighted or' if self.weighted else 'or'
+        return (kind,) + tuple(
+            term.cached_key(context) for term in self.terms)
 
 
 class Difference(Term):
+    __slots__ = ('terms',)
+    use_candidates = True
+    operation = 'difference'
 
     def __init__(self, *terms):
         self.terms = terms
 
-    def apply(self, cache, context=None):
-        results = []
-
-        for index, term in enumerate(self.terms):
-            result = term.cached_apply(cache, context)
-            # If we do not have any results for the first index, just
-            # return an empty set and stop here.
-            if not result:
-                if not index:
-                    return IFSet()
-                continue  # pragma: no cover (peephole optimizer interferes)
-            results.append(result)
+    def children(self, context=None):
+        return self.terms
+
+    def apply(self, cache, context=None, candidates=None):
+        first = self.terms[0]
+        # Terms that do not use what is still in the result can be
+        # evaluated at the same time as the first one.
+        done = concurrent_results(
+            cache,
+            [first] + [
+                term for term in self.terms[1:] if not term.use_candidates],
+            context, candidates)
+        result = done.get(id(first))
+        if result is None:
+            result = first.cached_apply(cache, context, candidates)
+        # If we do not have any results for the first term, just
+        # return an empty set and stop here.
+        if not result:
+            return IFSet()
 
-        result = results.pop(0)
-        for other in results:
+        for term in self.terms[1:]:
+            other = done.get(id(term))
+            if other is None:
+                # Only what is still in the result needs to be removed.
+                other = term.cached_apply(cache, context, result)
+            if not other:
+                continue
             result = difference(result, other)
             if not result:
-                # Empty results
+                # Empty results, the remaining terms do not need to
+                # be evaluated.
                 return result
         return result
 
+    def normalize(self, context=None):
+        first, *others = [term.normalize(context) for term in self.terms]
+        if type(first) is type(self):
+            # What the first terms removes is removed as well.
+            first, *removed = first.terms
+            others = removed + others
+        terms = [first] + unique_terms(others, context)
+        if same_terms(terms, self.terms):
+            return self
+        return type(self)(*terms)
+
+    def exists(self, cache, context=None):
+        first = self.terms[0].cached_apply(cache, context)
+        if not first:
+            return False
+        others = [
+            term.cached_apply(cache, context, first)
+            for term in self.terms[1:]]
+        # Look for a document of the first results in none of the
+        # others, instead of computing the whole difference.
+        return any(
+            not any(uid in other for other in others) for uid in first)
+
+    def estimate(self, context=None):
+        return self.terms[0].estimate(context)
+
     def key(self, context=None):
         return ('difference',) + tuple(
-            term.key(context) for term in self.terms)
+            term.cached_key(context) for term in self.terms)
 
 
-class Not(Term):
-    # XXX This term will load all the intids of your application
-    # resulting in major and heavy performance issues. It is advised
-    # not to use it.
-
-    def __init__(self, term):
-        self.term = term
+class Universe(Term):
+    """All the ids of the IntIds utility.
+    """
+    __slots__ = ()
 
     def apply(self, cache, context=None):
-        return difference(self._all(), self.term.cached_apply(cache, context))
+        intids = getUtility(IIntIds, '', context)
+        refs = getattr(intids, 'refs', None)
+        if refs is not None:
+            # zope.intid's utility, copy the keys of its BTree in C.
+            return IFSet(refs.keys())
+        return IFSet(iter(intids))
+
+    def key(self, context=None):
+        return ('universe',)
 
-    def _all(self):
-        return IFSet(uid for uid in getUtility(IIntIds))
+
+class Not(Term):
+    """Everything in universe that is not matched by term.
+
+    The universe defaults to all the ids of the IntIds utility, that
+    must be loaded unless the term is combined with others in an
+    ``And``. An other universe, like ``All`` on an index that indexes
+    every object, can be given instead.
+    """
+    __slots__ = ('term', 'universe')
+    use_candidates = True
+    operation = 'difference'
+
+    def __init__(self, term, universe=None):
+        self.term = term
+        self.universe = universe
+
+    def children(self, context=None):
+        if self.universe is not None:
+            return (self.universe, self.term)
+        return (self.term,)
+
+    def normalize(self, context=None):
+        term = self.term.normalize(context)
+        universe = self.universe
+        if universe is not None:
+            universe = universe.normalize(context)
+        if term is self.term and universe is self.universe:
+            return self
+        return type(self)(term, universe)
+
+    def apply(self, cache, context=None, candidates=None):
+        if candidates is not None:
+            # Within the candidates, we do not need the whole universe.
+            if self.universe is not None:
+                candidates = intersection(
+                    candidates, self.universe.cached_apply(cache, context))
+            return difference(
+                candidate_ids(candidates),
+                self.term.cached_apply(cache, context, candidates))
+        universe = (self.universe or Universe()).cached_apply(cache, context)
+        return difference(universe, self.term.cached_apply(cache, context))
 
     def key(self, context=None):
-        return ('not', self.term.key(context))
+        if self.universe is not None:
+            return ('not', self.term.cached_key(context),
+                    self.universe.cached_key(context))
+        return ('not', self.term.cached_key(context))
 
 
 class Objects(Term):
+    __slots__ = ('objects', '_ids')
 
     def __init__(self, objects):
         self.objects = objects
@@ -448,11 +2031,15 @@ class Objects(Term):
     def apply(self, cache, context=None):
         return IFSet(self.ids(context))
 
+    def estimate(self, context=None):
+        return len(self.objects)
+
     def key(self, context=None):
         return ('objects', self.ids(context))
 
 
 class Ids(Term):
+    __slots__ = ('ids',)
 
     def __init__(self, *ids):
         self.ids = ids
@@ -460,33 +2047,47 @@ class Ids(Term):
     def apply(self, cache, context=None):
         return IFSet(self.ids)
 
+    def estimate(self, context=None):
+        return len(self.ids)
+
     def key(self, context=None):
         return ('ids', self.ids)
 
 
 class IndexTerm(Term):
+    __slots__ = ('catalog_name', 'index_name', '_compiled_index')
+    # Interface the index must provide, checked when it is looked up.
+    index_interface = None
+
+    @property
+    def compiled_index(self):
+        # Index of the term, looked up by a compiled query.
+        return getattr(self, '_compiled_index', None)
+
+    @compiled_index.setter
+    def compiled_index(self, index):
+        self._compiled_index = index
 
     def __init__(self, catalog_name__and__index_name):
         self.catalog_name = catalog_name__and__index_name[0]
         self.index_name = catalog_name__and__index_name[1]
 
     def getIndex(self, context):
-        catalog = getUtility(ICatalog, self.catalog_name, context)
-        index = catalog[self.index_name]
-        return index
+        if self.compiled_index is not None:
+            return self.compiled_index
+        return lookup_index(
+            self.catalog_name, self.index_name, context,
+            self.index_interface)
 
 
 class Text(IndexTerm):
+    __slots__ = ('text',)
+    index_interface = ITextIndex
 
     def __init__(self, index_id, text):
         super().__init__(index_id)
         self.text = text
 
-    def getIndex(self, context):
-        index = super().getIndex(context)
-        assert ITextIndex.providedBy(index)
-        return index
-
     def apply(self, cache, context=None):
         index = self.getIndex(context)
         try:
@@ -501,88 +2102,331 @@ class Text(IndexTerm):
 
 
 class FieldTerm(IndexTerm):
+    __slots__ = ()
+    index_interface = IFieldIndex
 
-    def getIndex(self, context):
-        index = super().getIndex(context)
-        assert IFieldIndex.providedBy(index)
-        return index
+    def getForwardIndex(self, index):
+        # The value to documents BTree of zope.index's FieldIndex, if
+        # available, used for estimations.
+        return getattr(index, '_fwd_index', None)
+
+    def getReverseIndex(self, index):
+        # The document to value BTree of zope.index's FieldIndex, if
+        # available, used to check candidates.
+        return getattr(index, '_rev_index', None)
+
+
+class ZcIndexTerm(IndexTerm):
+    """Term of zc.catalog's ValueIndex or SetIndex."""
+    __slots__ = ()
+
+    def getForwardIndex(self, index):
+        # The value to documents BTree of zc.catalog's indexes, if
+        # available, used for estimations.
+        return getattr(index, 'values_to_documents', None)
+
+    def getReverseIndex(self, index):
+        # The document to values BTree of zc.catalog's indexes, if
+        # available, used to check candidates.
+        return getattr(index, 'documents_to_values', None)
+
+
+class ExtentAnyTerm(ZcIndexTerm):
+    """Base of the `ExtentAny` terms of the set and value modules."""
+    __slots__ = ('extent',)
+    use_candidates = True
+
+    def __init__(self, index_id, extent):
+        super().__init__(index_id)
+        self.extent = extent
+
+    def apply(self, cache, context=None, candidates=None):
+        index = self.getIndex(context)
+        indexed = self.getReverseIndex(index)
+        if indexed is not None and use_candidates(candidates, index):
+            extent = self.extent
+            return IFSet(
+                uid for uid in candidates
+                if uid in indexed and (extent is None or uid in extent))
+        return index.apply({'any': self.extent})
+
+
+class ExtentNoneTerm(ZcIndexTerm):
+    """Base of the `ExtentNone` terms of the set and value modules."""
+    __slots__ = ('extent',)
+    use_candidates = True
+
+    def __init__(self, index_id, extent):
+        super().__init__(index_id)
+        self.extent = extent
+
+    def apply(self, cache, context=None, candidates=None):
+        index = self.getIndex(context)
+        indexed = self.getReverseIndex(index)
+        if indexed is not None and use_candidates(candidates, index):
+            return IFSet(
+                uid for uid in candidates
+                if uid in self.extent and uid not in indexed)
+        return index.apply({'none': self.extent})
 
 
-class Eq(FieldTerm):
+class EqTerm(IndexTerm):
+    """Base of the `Eq` terms of the query and value modules."""
+    __slots__ = ('value',)
 
     def __init__(self, index_id, value):
         assert value is not None
         super().__init__(index_id)
         self.value = value
 
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply((self.value, self.value))
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return None
+        return bucket_size(tree, self.value)
+
+    def count(self, cache, context=None):
+        tree = self.getForwardIndex(self.getIndex(context))
+        if tree is None:
+            return super().count(cache, context)
+        return bucket_size(tree, self.value)
 
     def key(self, context=None):
         return ('equal', self.catalog_name, self.index_name, self.value)
 
 
-class NotEq(FieldTerm):
+class NotEqTerm(IndexTerm):
+    """Base of the `NotEq` terms of the query and value modules."""
+    __slots__ = ('value',)
+    use_candidates = True
 
     def __init__(self, index_id, value):
         super().__init__(index_id)
         self.value = value
 
-    def apply(self, cache, context=None):
+    def getComplementTerms(self):
+        """Return the terms of all the documents of the index and of
+        the ones equal to the value, used without a forward index.
+        """
+        raise NotImplementedError()
+
+    def apply(self, cache, context=None, candidates=None):
         index = self.getIndex(context)
-        values = index.apply((None, None))
-        matches = index.apply((self.value, self.value))
+        reverse = self.getReverseIndex(index)
+        if reverse is not None and use_candidates(candidates, index):
+            # Documents not in the index are taken as equal, to be
+            # excluded.
+            return IFSet(
+                uid for uid in candidates
+                if reverse.get(uid, self.value) != self.value)
+        tree = self.getForwardIndex(index)
+        if tree is not None:
+            return multiunion(other_documents(tree, self.value))
+        # Both sets are cached to be shared with other queries and terms.
+        values, matches = (
+            term.cached_apply(cache, context)
+            for term in self.getComplementTerms())
         return difference(values, matches)
 
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return None
+        return index.documentCount() - bucket_size(tree, self.value)
+
+    def count(self, cache, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return super().count(cache, context)
+        return index.documentCount() - bucket_size(tree, self.value)
+
     def key(self, context=None):
         return ('not equal', self.catalog_name, self.index_name, self.value)
 
 
-class All(FieldTerm):
+class AllTerm(IndexTerm):
+    """Base of the `All` terms of the query, set and value modules."""
+    __slots__ = ()
 
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply((None, None))
+    def estimate(self, context=None):
+        return self.getIndex(context).documentCount()
+
+    def count(self, cache, context=None):
+        return self.getIndex(context).documentCount()
 
     def key(self, context=None):
         return ('all', self.catalog_name, self.index_name)
 
 
-class Between(FieldTerm):
+class BetweenTerm(IndexTerm):
+    """Base of the `Between` terms of the query and value modules, with
+    the range as `options`.
+    """
+    __slots__ = ('options',)
+
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return None
+        return range_size(index, tree, *self.options)
+
+    def count(self, cache, context=None):
+        tree = self.getForwardIndex(self.getIndex(context))
+        if tree is None:
+            return super().count(cache, context)
+        return range_count(tree, *self.options)
+
+    def key(self, context=None):
+        return ('between', self.catalog_name, self.index_name, self.options)
+
+
+class InTerm(IndexTerm):
+    """Base of the `In` terms of the query and value modules."""
+    __slots__ = ('values',)
+
+    def __init__(self, index_id, values):
+        super().__init__(index_id)
+        if isinstance(values, Parameter):
+            self.values = values
+        else:
+            assert None not in values
+            self.values = tuple(values)
+
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return None
+        return sum(bucket_size(tree, value) for value in self.values)
+
+    def count(self, cache, context=None):
+        tree = self.getForwardIndex(self.getIndex(context))
+        if tree is None:
+            return super().count(cache, context)
+        # A document is indexed under one value only.
+        return sum(
+            len(documents)
+            for documents in forward_documents(tree, self.values))
+
+    def key(self, context=None):
+        return ('in', self.catalog_name, self.index_name, self.values)
+
+
+class Eq(FieldTerm, EqTerm):
+    __slots__ = ()
+
+    def apply(self, cache, context=None):
+        return self.getIndex(context).apply((self.value, self.value))
+
+
+class NotEq(FieldTerm, NotEqTerm):
+    __slots__ = ()
+
+    def getComplementTerms(self):
+        index_id = (self.catalog_name, self.index_name)
+        return All(index_id), Eq(index_id, self.value)
+
+    def apply(self, cache, context=None, candidates=None):
+        if self.value is None:
+            # Like for the index, a (None, None) range matches all.
+            return IFSet()
+        return super().apply(cache, context, candidates)
+
+    def count(self, cache, context=None):
+        if self.value is None:
+            return 0
+        return super().count(cache, context)
+
+
+class All(FieldTerm, AllTerm):
+    __slots__ = ()
+
+    def apply(self, cache, context=None):
+        return self.getIndex(context).apply((None, None))
+
+
+class Between(FieldTerm, BetweenTerm):
+    __slots__ = ()
+    use_candidates = True
 
     def __init__(self, index_id,
                  minimum=None, maximum=None):
         super().__init__(index_id)
         self.options = (minimum, maximum)
 
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply(self.options)
-
-    def key(self, context=None):
-        return ('between', self.catalog_name, self.index_name, self.options)
+    def apply(self, cache, context=None, candidates=None):
+        index = self.getIndex(context)
+        reverse = self.getReverseIndex(index)
+        if reverse is not None and use_candidates(candidates, index):
+            return IFSet(
+                uid for uid in candidates
+                if self.match(reverse.get(uid)))
+        return index.apply(self.options)
+
+    def normalize(self, context=None):
+        if self.options == (None, None):
+            # Like for the index, a (None, None) range matches all.
+            return All((self.catalog_name, self.index_name))
+        return self
+
+    def merge(self, other, union=False):
+        """Return a range matching the documents of this term and the
+        other one, or of any of them if `union`, or None.
+        """
+        if not isinstance(other, Between) or (
+                other.catalog_name, other.index_name) != (
+                    self.catalog_name, self.index_name):
+            return None
+        merged = merge_ranges(
+            self.options + (False, False), other.options + (False, False),
+            union)
+        if merged is None:
+            return None
+        return Between((self.catalog_name, self.index_name), *merged[:2])
+
+    def match(self, value):
+        if value is None:
+            return False
+        minimum, maximum = self.options
+        if minimum is not None and value < minimum:
+            return False
+        if maximum is not None and value > maximum:
+            return False
+        return True
 
 
 class Ge(Between):
+    __slots__ = ()
 
     def __init__(self, index_id, min_value):
         super().__init__(index_id, min_value, None)
 
 
 class Le(Between):
+    __slots__ = ()
 
     def __init__(self, index_id, max_value):
         super().__init__(index_id, None, max_value)
 
 
-class In(FieldTerm):
+class In(FieldTerm, InTerm):
+    __slots__ = ()
 
-    def __init__(self, index_id, values):
-        assert None not in values
-        super().__init__(index_id)
-        self.values = tuple(values)
+    def normalize(self, context=None):
+        if not isinstance(self.values, Parameter) and len(self.values) == 1:
+            return Eq((self.catalog_name, self.index_name), self.values[0])
+        return self
 
     def apply(self, cache, context=None):
-        results = []
         index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is not None:
+            return multiunion(forward_documents(tree, self.values))
+        results = []
         for value in self.values:
             r = index.apply((value, value))
             # empty results
@@ -596,6 +2440,3 @@ class In(FieldTerm):
             return results[0]
 
         return multiunion(results)
-
-    def key(self, context=None):
-        return ('in', self.catalog_name, self.index_name, self.values)
@@ -20,50 +20,71 @@ from zc.catalog.interfaces import ISetIndex
 from hurry.query import query
 
 
-class SetTerm(query.IndexTerm):
+class SetTerm(query.ZcIndexTerm):
+    __slots__ = ()
+    index_interface = ISetIndex
 
-    def getIndex(self, context):
-        index = super().getIndex(context)
-        assert ISetIndex.providedBy(index)
-        return index
 
-
-class All(SetTerm):
+class All(SetTerm, query.AllTerm):
+    __slots__ = ()
 
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'any': None})
 
-    def key(self, context=None):
-        return ('all', self.catalog_name, self.index_name)
-
 
 class AnyOf(SetTerm):
+    __slots__ = ('values',)
 
     def __init__(self, index_id, values):
         super().__init__(index_id)
-        self.values = tuple(values)
+        if isinstance(values, query.Parameter):
+            self.values = values
+        else:
+            self.values = tuple(values)
 
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'any_of': self.values})
 
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return None
+        # Documents can have more than one of the values.
+        return min(
+            index.documentCount(),
+            sum(query.bucket_size(tree, value) for value in self.values))
+
     def key(self, context=None):
         return ('any of', self.catalog_name, self.index_name, self.values)
 
 
 class AllOf(SetTerm):
+    __slots__ = ('values',)
 
     def __init__(self, index_id, values):
         super().__init__(index_id)
-        self.values = tuple(values)
+        if isinstance(values, query.Parameter):
+            self.values = values
+        else:
+            self.values = tuple(values)
 
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'all_of': self.values})
 
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None or not self.values:
+            return None
+        return min(query.bucket_size(tree, value) for value in self.values)
+
     def key(self, context=None):
         return ('all of', self.catalog_name, self.index_name, self.values)
 
 
 class SetBetween(SetTerm):
+    __slots__ = ('options',)
 
     def __init__(self, index_id,
                  minimum=None, maximum=None,
@@ -74,27 +95,22 @@ class SetBetween(SetTerm):
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'between': self.options})
 
+    def estimate(self, context=None):
+        index = self.getIndex(context)
+        tree = self.getForwardIndex(index)
+        if tree is None:
+            return None
+        return query.range_size(index, tree, *self.options)
+
     def key(self, context=None):
         return ('between', self.catalog_name, self.index_name, self.options)
 
 
-class ExtentAny(SetTerm):
+class ExtentAny(SetTerm, query.ExtentAnyTerm):
     """Any ids in the extent that are indexed by this index."""
-
-    def __init__(self, index_id, extent):
-        super().__init__(index_id)
-        self.extent = extent
-
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply({'any': self.extent})
+    __slots__ = ()
 
 
-class ExtentNone(SetTerm):
+class ExtentNone(SetTerm, query.ExtentNoneTerm):
     """Any ids in the extent that are not indexed by this index."""
-
-    def __init__(self, index_id, extent):
-        super().__init__(index_id)
-        self.extent = extent
-
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply({'none': self.extent})
+    __slots__ = ()
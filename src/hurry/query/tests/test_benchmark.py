@@ -0,0 +1,94 @@
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import zope.component.testing
+
+from hurry.query import benchmark
+
+
+class DistributionTest(unittest.TestCase):
+
+    def test_skew(self):
+        values = benchmark.Distribution(random.Random(0), 10, 2).draw(1000)
+        self.assertTrue(all(0 <= value < 10 for value in values))
+        self.assertGreater(values.count(0), values.count(9) * 10)
+
+    def test_uniform(self):
+        values = benchmark.Distribution(random.Random(0), 2, 0).draw(1000)
+        self.assertLess(abs(values.count(0) - values.count(1)), 200)
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    tearDown = zope.component.testing.tearDown
+
+    def test_build(self):
+        catalog = benchmark.build(50, cardinality=5)
+        self.assertEqual(catalog['field'].documentCount(), 50)
+        self.assertEqual(catalog['text'].documentCount(), 50)
+
+    def test_run(self):
+        report = benchmark.run(50, cardinality=5, repeat=2)
+        self.assertEqual(report['format'], benchmark.FORMAT)
+        self.assertEqual(report['parameters']['size'], 50)
+        self.assertEqual(
+            sorted(report['cases']), sorted(benchmark.cases()))
+        stats = report['cases']['field.eq.common']
+        self.assertEqual(stats['repeat'], 2)
+        self.assertGreater(stats['results'], 0)
+        self.assertLessEqual(stats['min'], stats['median'])
+        self.assertEqual(report['cases']['sort.page']['results'], 20)
+
+    def test_run_patterns(self):
+        report = benchmark.run(
+            20, cardinality=5, repeat=1, patterns=['sort.*', 'not'])
+        self.assertEqual(sorted(report['cases']), [
+            'not', 'sort.limit', 'sort.multiple', 'sort.page',
+            'sort.reverse'])
+
+    def test_compare(self):
+
+        def report(**medians):
+            return {'cases': {
+                name: {'median': median}
+                for name, median in medians.items()}}
+
+        self.assertEqual(
+            benchmark.compare(
+                report(a=1.0, b=1.0, c=1.0),
+                report(a=1.1, b=1.5, d=9.0)),
+            [('b', 1.0, 1.5)])
+        self.assertEqual(
+            benchmark.compare(
+                report(a=1.0), report(a=1.1), threshold=1.05),
+            [('a', 1.0, 1.1)])
+
+    def test_main(self):
+        stderr = io.StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'output.json')
+            argv = ['--size', '20', '--cardinality', '5', '--repeat', '1',
+                    '--case', 'field.*', '--output', output]
+            self.assertEqual(benchmark.main(argv), 0)
+            with open(output) as stream:
+                baseline = json.load(stream)
+            self.assertIn('field.eq.common', baseline['cases'])
+
+            for stats in baseline['cases'].values():
+                stats['median'] = 1e-9
+            baseline['parameters']['size'] = 10
+            with open(output, 'w') as stream:
+                json.dump(baseline, stream)
+            with contextlib.redirect_stdout(io.StringIO()) as stdout, \
+                    contextlib.redirect_stderr(stderr):
+                self.assertEqual(benchmark.main(
+                    argv[:-2] + ['--compare', output]), 1)
+        self.assertEqual(
+            json.loads(stdout.getvalue())['parameters']['size'], 20)
+        self.assertIn('other parameters', stderr.getvalue())
+        self.assertIn('field.eq.common: 0.000ms', stderr.getvalue())
@@ -0,0 +1,294 @@
+import unittest
+
+import transaction
+from BTrees.IFBTree import IFSet
+from zope.component import getGlobalSiteManager
+from zope.component import provideAdapter
+from zope.component import provideHandler
+from zope.container.contained import Contained
+from zope.event import notify
+from zope.interface import Interface
+from zope.interface.interfaces import IComponentLookup
+from zope.intid.interfaces import IntIdAddedEvent
+from zope.lifecycleevent import Attributes
+from zope.lifecycleevent import ObjectModifiedEvent
+from zope.lifecycleevent import Sequence
+
+from hurry.query import query
+from hurry.query.cache import SharedCache
+from hurry.query.cache import affected
+from hurry.query.cache import dependencies
+from hurry.query.cache import invalidateIdSubscriber
+from hurry.query.cache import invalidateModifiedSubscriber
+from hurry.query.cache import modified_attributes
+from hurry.query.tests.test_query import Content
+from hurry.query.tests.test_query import IContent
+from hurry.query.tests.test_query import QueryTestBase
+from hurry.query.tests.test_query import f1
+from hurry.query.tests.test_query import f2
+
+
+class DependenciesTest(unittest.TestCase):
+
+    def test_index(self):
+        self.assertEqual(
+            dependencies(('equal', 'catalog1', 'f1', 'a')),
+            {('catalog1', 'f1')})
+
+    def test_composite(self):
+        self.assertEqual(
+            dependencies(('and', ('equal', 'catalog1', 'f1', 'a'),
+                          ('not', ('all', 'catalog1', 'f2')))),
+            {('catalog1', 'f1'), ('catalog1', 'f2')})
+
+    def test_none(self):
+        self.assertEqual(dependencies(('universe',)), None)
+        self.assertEqual(dependencies(('ids', (1, 2))), None)
+        self.assertEqual(dependencies('foo'), None)
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        transaction.begin()
+        self.cache = SharedCache(size=10)
+        self.cache.register()
+
+    def tearDown(self):
+        transaction.abort()
+
+    def test_get(self):
+        self.assertEqual(self.cache.get(('universe',)), None)
+        self.assertEqual(self.cache.get(('universe',), 42), 42)
+        self.cache[('universe',)] = IFSet([1, 2])
+        self.assertEqual(list(self.cache.get(('universe',))), [1, 2])
+        self.assertIn(('universe',), self.cache)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.used, 3)
+
+    def test_replace(self):
+        self.cache[('universe',)] = IFSet([1, 2])
+        self.cache[('universe',)] = IFSet([1])
+        self.assertEqual(list(self.cache.get(('universe',))), [1])
+        self.assertEqual(self.cache.used, 2)
+
+    def test_evict_least_recently_used(self):
+        for uid in range(3):
+            self.cache[('ids', uid)] = IFSet(range(3))
+        self.assertEqual(len(self.cache), 2)
+        self.assertNotIn(('ids', 0), self.cache)
+        self.cache.get(('ids', 1))
+        self.cache[('ids', 3)] = IFSet([1, 2])
+        self.assertEqual(
+            list(self.cache.data), [('ids', 1), ('ids', 3)])
+        self.assertEqual(self.cache.used, 7)
+
+    def test_weight(self):
+        self.cache[('ids', 0)] = []
+        self.cache[('ids', 1)] = 42
+        self.assertEqual(self.cache.used, 2)
+
+    def test_register_without_transaction(self):
+        transaction.abort()
+        cache = SharedCache()
+        cache.invalidate()
+        cache[('ids', 0)] = IFSet([1])
+        self.assertEqual(cache.local.start, 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_too_large(self):
+        self.cache[('ids', 0)] = IFSet(range(10))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate(self):
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.cache[('all', 'c', 'f2')] = IFSet([1])
+        self.cache[('universe',)] = IFSet([1])
+        self.cache.invalidate({('c', 'f1')})
+        self.assertEqual(list(self.cache.data), [('all', 'c', 'f2')])
+        self.assertEqual(self.cache.used, 2)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.used, 0)
+
+    def test_invalidate_older_transaction(self):
+        # This transaction started before the invalidation: it could
+        # store results computed on indexes older than the change.
+        self.cache.invalidate({('c', 'f1')})
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.cache[('all', 'c', 'f2')] = IFSet([1])
+        self.cache[('universe',)] = IFSet([1])
+        self.assertEqual(list(self.cache.data), [('all', 'c', 'f2')])
+        transaction.begin()
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.assertEqual(
+            list(self.cache.get(('all', 'c', 'f1'))), [1])
+
+    def test_cleared_older_transaction(self):
+        self.cache.clear()
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_changed_commit(self):
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.cache[('all', 'c', 'f2')] = IFSet([1])
+        self.cache.changed({('c', 'f1')})
+        # Not used by the transaction that changed the index.
+        self.assertEqual(self.cache.get(('all', 'c', 'f1')), None)
+        self.assertEqual(self.cache.get(('universe',)), None)
+        self.cache[('equal', 'c', 'f1', 1)] = IFSet([1])
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(list(self.cache.get(('all', 'c', 'f2'))), [1])
+        transaction.commit()
+        self.assertEqual(list(self.cache.data), [('all', 'c', 'f2')])
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.assertIsNotNone(self.cache.get(('all', 'c', 'f1')))
+
+    def test_changed_abort(self):
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.cache.changed({('c', 'f1')})
+        transaction.abort()
+        self.assertIsNotNone(self.cache.get(('all', 'c', 'f1')))
+
+    def test_changed_everything(self):
+        self.cache[('all', 'c', 'f1')] = IFSet([1])
+        self.cache.changed()
+        self.assertEqual(self.cache.get(('all', 'c', 'f2')), None)
+        transaction.commit()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_changed_first(self):
+        cache = SharedCache()
+        cache.changed({('c', 'f1')})
+        transaction.commit()
+        self.assertEqual(cache.generations, {('c', 'f1'): 1})
+
+
+class AffectedTest(QueryTestBase):
+
+    def test_attributes(self):
+        content = Content(1)
+        index = self.catalog['f1']
+        self.assertTrue(affected(index, content))
+        self.assertTrue(affected(index, content, {'f1', 'f2'}))
+        self.assertFalse(affected(index, content, {'f2'}))
+
+    def test_interface(self):
+        self.assertFalse(affected(self.catalog['f1'], object()))
+
+    def test_adapter(self):
+        index = self.catalog['f1']
+        index.interface = lambda obj, default: obj.__dict__
+        self.assertTrue(affected(index, Content(1), {'f2'}))
+
+    def test_no_interface(self):
+        index = self.catalog['f1']
+        index.interface = None
+        self.assertFalse(affected(index, object(), {'f2'}))
+
+    def test_callable(self):
+        index = self.catalog['f1']
+        index.field_callable = True
+        self.assertTrue(affected(index, Content(1), {'f2'}))
+
+    def test_no_field(self):
+        self.assertTrue(affected(object(), Content(1), {'f2'}))
+
+    def test_modified_attributes(self):
+        self.assertEqual(modified_attributes(()), None)
+        self.assertEqual(
+            modified_attributes(
+                [Attributes(IContent, 'f1'), Attributes(IContent, 'f2')]),
+            {'f1', 'f2'})
+        self.assertEqual(
+            modified_attributes(
+                [Attributes(IContent, 'f1'), Sequence(IContent, [1])]),
+            None)
+
+
+class SharedCacheQueryTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        transaction.begin()
+        self.cache = SharedCache()
+        self.content = self.intid.getObject(1)
+        provideHandler(invalidateIdSubscriber)
+        provideHandler(invalidateModifiedSubscriber)
+        # Like the site manager adapter of zope.site.
+        provideAdapter(
+            lambda obj: getGlobalSiteManager(), (IContent,), IComponentLookup)
+
+    def tearDown(self):
+        transaction.abort()
+        super().tearDown()
+
+    def modify(self, *attributes):
+        self.content.f1 = 'b'
+        self.catalog.index_doc(1, self.content)
+        notify(ObjectModifiedEvent(
+            self.content, Attributes(IContent, *attributes)))
+
+    def test_across_transactions(self):
+        term = query.Eq(f1, 'a')
+        self.searchResults(term, caching=self.cache)
+        transaction.commit()
+        self.assertIn(term.key(), self.cache)
+        results = self.searchResults(term, caching=self.cache)
+        self.assertEqual(len(results), 3)
+
+    def test_modified(self):
+        eq1 = query.Eq(f1, 'a')
+        eq2 = query.Eq(f2, 'b')
+        self.searchResults(query.Or(eq1, eq2), caching=self.cache)
+        transaction.commit()
+        self.assertEqual(len(self.cache), 3)
+        self.modify('f1')
+        self.assertEqual(
+            len(self.searchResults(eq1, caching=self.cache)), 2)
+        transaction.commit()
+        self.assertEqual(list(self.cache.data), [eq2.key()])
+        self.assertEqual(
+            len(self.searchResults(eq1, caching=self.cache)), 2)
+
+    def test_modified_other(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=self.cache)
+        self.modify('f3')
+        transaction.commit()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_modified_not_indexed(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=self.cache)
+        self.modify('id')
+        self.assertEqual(self.cache.local.changed, set())
+
+    def test_modified_no_reindex(self):
+        from zope.catalog.interfaces import INoAutoReindex
+        from zope.interface import alsoProvides
+        self.searchResults(query.Eq(f1, 'a'), caching=self.cache)
+        alsoProvides(self.content, INoAutoReindex)
+        self.modify('f1')
+        transaction.commit()
+        self.assertEqual(len(self.cache), 1)
+
+    def test_added(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=self.cache)
+        self.searchResults(query.Eq(f1, 'X'), caching=self.cache)
+        notify(IntIdAddedEvent(Content(7), None))
+        self.assertIn(('catalog1', 'f1'), self.cache.local.changed)
+        transaction.commit()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_added_not_indexed(self):
+        provideAdapter(
+            lambda obj: getGlobalSiteManager(), (Interface,),
+            IComponentLookup)
+        eq = query.Eq(f1, 'a')
+        self.searchResults(eq, caching=self.cache)
+        self.searchResults(query.Universe(), caching=self.cache)
+        transaction.commit()
+        self.assertEqual(len(self.cache), 2)
+        notify(IntIdAddedEvent(Contained(), None))
+        transaction.commit()
+        # Only the results that do not use an index are invalidated.
+        self.assertEqual(list(self.cache.data), [eq.key()])
@@ -1,5 +1,12 @@
 import doctest
 
+from hurry.query import query
+
+
+def tearDown(test):
+    # Stop the threads of asearchResults.
+    query.shutdown_async_executor()
+
 
 def test_suite():
-    return doctest.DocFileSuite('../query.rst')
+    return doctest.DocFileSuite('../query.rst', tearDown=tearDown)
@@ -0,0 +1,421 @@
+import unittest
+from unittest import mock
+
+from BTrees.IFBTree import IFSet
+from testfixtures import LogCapture
+
+from hurry.query import query
+from hurry.query import value as value_query
+from hurry.query.profiling import CallbackSink
+from hurry.query.profiling import Explanation
+from hurry.query.profiling import Profile
+from hurry.query.profiling import ProfileCollector
+from hurry.query.profiling import SlowQueryRecorder
+from hurry.query.profiling import StatsSink
+from hurry.query.profiling import fingerprint
+from hurry.query.profiling import metric_name
+from hurry.query.profiling import percentile
+from hurry.query.query import no_results
+from hurry.query.tests.test_query import QueryTestBase
+from hurry.query.tests.test_query import f1
+from hurry.query.tests.test_query import f2
+from hurry.query.tests.test_query import f3
+
+
+class FakeStatsClient:
+
+    def __init__(self):
+        self.timings = []
+        self.counters = []
+
+    def timing(self, name, value):
+        self.timings.append(name)
+
+    def incr(self, name):
+        self.counters.append(name)
+
+
+class ProfileTest(QueryTestBase):
+
+    def test_no_profile(self):
+        results = self.searchResults(query.All(f1))
+        self.assertEqual(results.profile, None)
+
+    def test_profile(self):
+        results = self.searchResults(
+            query.And(query.Eq(f1, 'a'), query.Eq(f2, 'b')), profile=True)
+        profile = results.profile
+        self.assertIsInstance(profile, Profile)
+        self.assertGreater(profile.total, 0)
+        self.assertGreaterEqual(profile.post, 0)
+        self.assertEqual(profile.cardinality, 2)
+        [term] = profile.terms
+        self.assertEqual(term.key[0], 'and')
+        self.assertEqual(term.cardinality, 2)
+        self.assertFalse(term.cached)
+        self.assertEqual(
+            [(t.key, t.cardinality) for t in term.children],
+            [(('equal', 'catalog1', 'f1', 'a'), 3),
+             (('equal', 'catalog1', 'f2', 'b'), 3)])
+
+    def test_profile_cached(self):
+        eq = query.Eq(f1, 'a')
+        results = self.searchResults(
+            query.Or(eq, query.And(eq, query.Eq(f2, 'b'))), profile=True)
+        [term] = results.profile.terms
+        self.assertEqual(
+            [t.cached for t in results.profile.walk()],
+            [False, False, False, True, False])
+        self.assertEqual(
+            [t.key[0] for t in results.profile.walk()],
+            ['or', 'equal', 'and', 'equal', 'equal'])
+
+    def test_profile_candidates(self):
+        with mock.patch.object(query, 'CANDIDATES_RATIO', 1):
+            results = self.searchResults(
+                query.And(query.Eq(f1, 'X'), query.NotEq(f2, 'b')),
+                profile=True)
+        [term] = results.profile.terms
+        self.assertEqual(
+            [(t.key[0], t.cardinality) for t in term.children],
+            [('equal', 2), ('not equal', 1)])
+        self.assertTrue(all(t.total is not None for t in term.children))
+
+    def test_profile_no_results(self):
+        results = self.searchResults(query.Eq(f1, 'foo'), profile=True)
+        self.assertIsNot(results, no_results)
+        self.assertEqual(len(results), 0)
+        self.assertEqual(results.profile.cardinality, 0)
+        self.assertEqual(results.profile.post, None)
+
+    def test_profile_and_timing(self):
+        with LogCapture() as logged:
+            results = self.searchResults(
+                query.All(f1), profile=True, timing=.00000001)
+            records = logged.records
+        self.assertEqual(len(records), 2)
+        self.assertEqual(results.profile.cardinality, 6)
+
+    def test_as_dict(self):
+        results = self.searchResults(query.And(query.All(f1)), profile=True)
+        profile = results.profile.as_dict()
+        self.assertEqual(
+            sorted(profile), ['elapsed', 'post', 'terms'])
+        [term] = profile['terms']
+        self.assertEqual(term['key'], ('and', ('all', 'catalog1', 'f1')))
+        self.assertEqual(term['cardinality'], 6)
+        self.assertEqual(term['cached'], False)
+        self.assertEqual(
+            [child['key'] for child in term['children']],
+            [('all', 'catalog1', 'f1')])
+
+    def test_empty_profile(self):
+        profile = Profile([])
+        self.assertEqual(profile.total, 0)
+        self.assertEqual(profile.cardinality, None)
+
+
+class SinkTest(QueryTestBase):
+
+    def test_collector(self):
+        collector = ProfileCollector(size=2)
+        for value in ('a', 'X', 'Y'):
+            results = self.searchResults(
+                query.Eq(f1, value), profile=collector)
+        self.assertEqual(len(collector.profiles), 2)
+        self.assertIs(collector.profiles[-1], results.profile)
+        collector.clear()
+        self.assertEqual(len(collector.profiles), 0)
+
+    def test_callback(self):
+        profiles = []
+        self.searchResults(
+            query.Eq(f1, 'foo'), profile=CallbackSink(profiles.append))
+        self.assertEqual(len(profiles), 1)
+
+    def test_stats(self):
+        client = FakeStatsClient()
+        eq = query.Eq(f1, 'a')
+        self.searchResults(
+            query.Or(eq, query.And(eq)), profile=StatsSink(client, prefix='q'))
+        self.assertEqual(client.timings, [
+            'q.total', 'q.post', 'q.term.or', 'q.term.equal.catalog1.f1',
+            'q.term.and'])
+        self.assertEqual(client.counters, [
+            'q.miss.or', 'q.miss.equal.catalog1.f1', 'q.miss.and',
+            'q.hit.equal.catalog1.f1'])
+
+    def test_stats_no_post(self):
+        client = FakeStatsClient()
+        self.searchResults(query.Eq(f1, 'foo'), profile=StatsSink(client))
+        self.assertEqual(client.timings, [
+            'hurry.query.total', 'hurry.query.term.equal.catalog1.f1'])
+
+
+class ExplainTest(QueryTestBase):
+
+    def explain(self, q, **kw):
+        return self.query.explain(q, **kw)
+
+    def setUp(self):
+        super().setUp()
+        self.query = query.Query()
+
+    def summary(self, explanation):
+        return [
+            (e.key[0], e.operation, e.estimate, e.cardinality, e.evaluated,
+             e.cached, e.short_circuit)
+            for e in explanation.walk()]
+
+    def test_explain(self):
+        explanation = self.explain(query.And(
+            query.Not(query.Eq(f3, 'e')),
+            query.Or(query.Eq(f2, 'b'), query.Eq(f2, 'c')),
+            query.Eq(f1, 'X')))
+        self.assertIsInstance(explanation, Explanation)
+        self.assertGreater(explanation.elapsed, 0)
+        # Terms are in the order they are evaluated.
+        self.assertEqual(self.summary(explanation), [
+            ('and', 'intersection', 2, 1, True, False, False),
+            ('equal', None, 2, 2, True, False, False),
+            ('or', 'union', 5, 5, True, False, False),
+            ('equal', None, 3, 3, True, False, False),
+            ('equal', None, 2, 2, True, False, False),
+            ('not', 'difference', None, 1, True, False, False),
+            ('equal', None, 2, 2, True, False, False)])
+
+    def test_short_circuit(self):
+        explanation = self.explain(query.And(
+            query.Eq(f1, 'foo'), query.Eq(f2, 'b'), weighted=True))
+        self.assertEqual(self.summary(explanation), [
+            ('weighted and', 'weighted intersection', 0, 0, True, False,
+             True),
+            ('equal', None, 0, 0, True, False, False),
+            ('equal', None, 3, None, False, False, False)])
+        explanation = self.explain(query.Difference(
+            query.Eq(f1, 'X'), query.Eq(f2, 'b'), query.Eq(f2, 'c'),
+            query.All(f3)))
+        self.assertEqual(
+            [(e.key[0], e.evaluated) for e in explanation.walk()],
+            [('difference', True), ('equal', True), ('equal', True),
+             ('equal', True), ('all', False)])
+        self.assertTrue(explanation.short_circuit)
+
+    def test_cached(self):
+        eq = query.Eq(f1, 'a')
+        explanation = self.explain(
+            query.Or(eq, query.Eq(f2, 'b'), weighted=True),
+            caching={eq.key(): IFSet([1])})
+        self.assertEqual(self.summary(explanation), [
+            ('weighted or', 'weighted union', 6, 4, True, False, False),
+            ('equal', None, 3, 1, True, True, False),
+            ('equal', None, 3, 3, True, False, False)])
+        explanation = self.explain(
+            eq, caching={eq.key(): IFSet([1])})
+        self.assertEqual(self.summary(explanation), [
+            ('equal', None, 3, 1, True, True, False)])
+
+    def test_universe(self):
+        explanation = self.explain(query.Not(query.Eq(f1, 'X')))
+        self.assertEqual(
+            [(e.key[0], e.estimate, e.cardinality)
+             for e in explanation.walk()],
+            [('not', None, 4), ('universe', None, 6), ('equal', 2, 2)])
+        explanation = self.explain(
+            query.Not(query.Eq(f1, 'X'), query.All(f2)))
+        self.assertEqual(
+            [e.key[0] for e in explanation.walk()],
+            ['not', 'all', 'equal'])
+
+    def test_without_key(self):
+
+        class Keyless(query.Term):
+            __slots__ = ('term',)
+
+            def __init__(self, term):
+                self.term = term
+
+            def children(self, context=None):
+                return (self.term,)
+
+            def apply(self, cache, context=None):
+                return self.term.cached_apply(cache, context)
+
+        explanation = self.explain(Keyless(query.Eq(f1, 'a')))
+        self.assertEqual(explanation.key, None)
+        self.assertTrue(explanation.evaluated)
+        self.assertEqual(explanation.cardinality, 3)
+        self.assertEqual(
+            [(e.key, e.evaluated) for e in explanation.children],
+            [(('equal', 'catalog1', 'f1', 'a'), True)])
+
+    def test_parameters(self):
+        plan = self.query.compile(
+            query.Eq(f1, query.Parameter('value')))
+        explanation = self.explain(plan, parameters={'value': 'X'})
+        self.assertEqual(explanation.key, ('equal', 'catalog1', 'f1', 'X'))
+        self.assertEqual(explanation.cardinality, 2)
+
+    def test_as_dict(self):
+        explanation = self.explain(
+            query.And(query.Eq(f1, 'foo'), query.Eq(f2, 'b'))).as_dict()
+        self.assertEqual(sorted(explanation), [
+            'cached', 'cardinality', 'children', 'elapsed', 'estimate',
+            'evaluated', 'key', 'operation', 'short_circuit'])
+        self.assertEqual(
+            [(child['key'], child['evaluated'])
+             for child in explanation['children']],
+            [(('equal', 'catalog1', 'f1', 'foo'), True),
+             (('equal', 'catalog1', 'f2', 'b'), False)])
+
+    def test_format(self):
+        explanation = self.explain(
+            query.And(query.Eq(f1, 'foo'), query.Eq(f2, 'b')),
+            caching={('equal', 'catalog1', 'f1', 'foo'): IFSet()})
+        explanation.elapsed = 0.0012
+        explanation.children[0].elapsed = 0
+        self.assertEqual(explanation.format().splitlines(), [
+            'and (intersection): estimate 0, actual 0, 1.200ms, '
+            'short-circuited',
+            "  ('equal', 'catalog1', 'f1', 'foo'): estimate 0, actual 0, "
+            '0.000ms, cached',
+            "  ('equal', 'catalog1', 'f2', 'b'): estimate 3, "
+            'not evaluated'])
+
+
+class MetricNameTest(unittest.TestCase):
+
+    def test_metric_name(self):
+        self.assertEqual(metric_name(('all', 'catalog1', 'f1')),
+                         'all.catalog1.f1')
+        self.assertEqual(metric_name(('not equal', '', 'f.1', 'a')),
+                         'not_equal._.f_1')
+        self.assertEqual(metric_name(('and', ('all', 'catalog1', 'f1'))),
+                         'and')
+        self.assertEqual(metric_name(('ids', (1, 2))), 'ids')
+        self.assertEqual(metric_name('foo'), 'unknown')
+        self.assertEqual(metric_name(()), 'unknown')
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def test_index(self):
+        self.assertEqual(
+            fingerprint(query.Eq(f1, 'a').key()),
+            ('equal', 'catalog1', 'f1', '?'))
+        self.assertEqual(
+            fingerprint(query.In(f1, ['a', 'b']).key()),
+            fingerprint(query.In(f1, ['c']).key()))
+        self.assertEqual(
+            fingerprint(value_query.In(f1, ('a', 'b')).key()),
+            ('in', 'catalog1', 'f1', '?'))
+        self.assertEqual(
+            fingerprint(query.All(f1).key()), ('all', 'catalog1', 'f1'))
+
+    def test_composite(self):
+        self.assertEqual(
+            fingerprint(query.And(
+                query.Eq(f1, 'a'),
+                query.Not(query.Between(f2, 1, 2), query.All(f1))).key()),
+            ('and', ('equal', 'catalog1', 'f1', '?'),
+             ('not', ('between', 'catalog1', 'f2', '?'),
+              ('all', 'catalog1', 'f1'))))
+        self.assertEqual(
+            fingerprint(query.Ids(1, 2).key()), ('ids', '?'))
+        self.assertEqual(fingerprint(('universe',)), ('universe',))
+        self.assertEqual(fingerprint('foo'), '?')
+        self.assertEqual(fingerprint(()), '?')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, .5), 50)
+        self.assertEqual(percentile(values, .99), 99)
+        self.assertEqual(percentile([3], .95), 3)
+        self.assertEqual(percentile([1, 2], 0), 1)
+
+
+class SlowQueryRecorderTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.query = query.Query()
+
+    def test_record(self):
+        recorder = SlowQueryRecorder()
+        for value in ('a', 'X', 'Y', 'foo'):
+            self.query.searchResults(
+                query.Eq(f1, value), profile=recorder)
+        self.query.searchResults(query.All(f1), profile=recorder)
+        shapes = {stats['shape']: stats for stats in recorder.dump()}
+        self.assertEqual(sorted(shapes, key=str), [
+            ('all', 'catalog1', 'f1'), ('equal', 'catalog1', 'f1', '?')])
+        stats = shapes[('equal', 'catalog1', 'f1', '?')]
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(stats['mean_results'], 1.5)
+        self.assertLessEqual(stats['p50'], stats['p95'])
+        self.assertLessEqual(stats['p95'], stats['p99'])
+        self.assertGreater(stats['total'], 0)
+        self.assertEqual(
+            [stats['shape'] for stats in recorder.dump()],
+            sorted(shapes, key=lambda shape: -shapes[shape]['total']))
+        recorder.reset()
+        self.assertEqual(recorder.dump(), [])
+
+    def test_threshold(self):
+        recorder = SlowQueryRecorder(threshold=60)
+        self.query.searchResults(query.All(f1), profile=recorder)
+        self.assertEqual(recorder.dump(), [])
+
+    def test_size(self):
+        recorder = SlowQueryRecorder(size=2, window=2)
+        for term in (query.All(f1), query.All(f2), query.All(f1),
+                     query.All(f1), query.All(f1), query.All(f3)):
+            self.query.searchResults(term, profile=recorder)
+        # The least recently seen shape is forgotten.
+        self.assertEqual(
+            sorted(stats['shape'][2] for stats in recorder.dump()),
+            ['f1', 'f3'])
+        [stats] = [s for s in recorder.dump() if s['shape'][2] == 'f1']
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(len(recorder.shapes[stats['shape']].durations), 2)
+
+    def test_recorder(self):
+        recorder = self.query.recorder = SlowQueryRecorder()
+        results = self.query.searchResults(query.Eq(f1, 'a'))
+        # Results are not profiled for the caller.
+        self.assertEqual(results.profile, None)
+        self.assertIs(self.query.searchResults(query.Eq(f1, 'foo')),
+                      no_results)
+        # Queries profiled by the caller are not recorded.
+        self.query.searchResults(query.All(f1), profile=True)
+        self.assertEqual(
+            [(stats['shape'], stats['count']) for stats in recorder.dump()],
+            [(('equal', 'catalog1', 'f1', '?'), 2)])
+
+    def test_sample(self):
+        recorder = self.query.recorder = SlowQueryRecorder(sample=.5)
+        with mock.patch('random.random', side_effect=[.2, .7]):
+            self.query.searchResults(query.Eq(f1, 'a'))
+            self.query.searchResults(query.Eq(f1, 'X'))
+        [stats] = recorder.dump()
+        self.assertEqual(stats['count'], 1)
+        recorder.sample = 0
+        self.query.searchResults(query.Eq(f1, 'a'))
+        self.assertEqual(recorder.dump()[0]['count'], 1)
+
+    def test_without_key(self):
+        recorder = SlowQueryRecorder()
+
+        class Keyless(query.Or):
+            __slots__ = ()
+
+            def key(self, context=None):
+                raise NotImplementedError()
+
+        self.query.searchResults(
+            Keyless(query.Eq(f1, 'a'), query.Eq(f2, 'b')), profile=recorder)
+        self.query.searchResults(Keyless(), profile=recorder)
+        self.assertEqual(
+            [stats['shape'] for stats in recorder.dump()],
+            [(('equal', 'catalog1', 'f1', '?'),
+              ('equal', 'catalog1', 'f2', '?'))])
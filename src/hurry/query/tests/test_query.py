@@ -1,23 +1,42 @@
+import asyncio
+import concurrent.futures
 import functools
+import threading
 import time
 import unittest
+from unittest import mock
 
+import transaction
 import zope.component.testing
 import zope.intid.interfaces
+from BTrees.IFBTree import IFSet
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
 from testfixtures import LogCapture
+from zc.catalog.catalogindex import SetIndex
+from zc.catalog.catalogindex import ValueIndex
+from zc.catalog.extentcatalog import FilterExtent
 from zope.catalog.catalog import Catalog
 from zope.catalog.field import FieldIndex
 from zope.catalog.interfaces import ICatalog
 from zope.catalog.text import TextIndex
+from zope.component import getSiteManager
 from zope.component import getUtility
 from zope.component import provideUtility
 from zope.container.contained import Contained
+from zope.index.interfaces import IIndexSort
 from zope.interface import Attribute
 from zope.interface import Interface
+from zope.interface import alsoProvides
 from zope.interface import implementer
 
 from hurry.query import query
+from hurry.query import set as set_query
+from hurry.query import value as value_query
+from hurry.query.cache import SharedCache
+from hurry.query.cache import transaction_cache
 from hurry.query.interfaces import IQuery
+from hurry.query.query import no_results
 
 
 """Bring `query` testcoverage to 100% without polluting the doctest"""
@@ -83,6 +102,8 @@ class DummyIntId:
 
 
 f1 = ('catalog1', 'f1')
+f2 = ('catalog1', 'f2')
+f3 = ('catalog1', 'f3')
 
 
 class QueryTestBase(unittest.TestCase):
@@ -365,6 +386,55 @@ class QueryTest(QueryTestBase):
         self.assertEqual(len(records), 3)
 
 
+class TransactionCachingTest(QueryTestBase):
+
+    def tearDown(self):
+        transaction.abort()
+        super().tearDown()
+
+    def test_caching_true(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=True)
+        self.assertIn(('equal', 'catalog1', 'f1', 'a'), transaction_cache)
+        # The cached result is reused by the next query.
+        transaction_cache[('equal', 'catalog1', 'f1', 'X')] = \
+            transaction_cache[('equal', 'catalog1', 'f1', 'a')]
+        self.assertEqual(
+            self.displayQuery(query.Eq(f1, 'X'), caching=True),
+            [1, 2, 4])
+
+    def test_caching_false(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=False)
+        self.searchResults(query.Eq(f1, 'a'))
+        self.assertEqual(len(transaction_cache), 0)
+
+    def test_cleared_on_commit(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=True)
+        self.assertEqual(len(transaction_cache), 1)
+        transaction.commit()
+        self.assertEqual(len(transaction_cache), 0)
+
+    def test_cleared_on_abort(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=True)
+        self.assertEqual(len(transaction_cache), 1)
+        transaction.abort()
+        self.assertEqual(len(transaction_cache), 0)
+
+    def test_cleared_on_begin(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=True)
+        transaction.begin()
+        self.assertEqual(len(transaction_cache), 0)
+
+    def test_thread_local(self):
+        self.searchResults(query.Eq(f1, 'a'), caching=True)
+        seen = []
+        thread = threading.Thread(
+            target=lambda: seen.append(len(transaction_cache)))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [0])
+        self.assertEqual(len(transaction_cache), 1)
+
+
 class TermsTest(QueryTestBase):
 
     def test_Term_apply(self):
@@ -449,3 +519,1801 @@ class TermsTest(QueryTestBase):
         self.assertEqual(self.displayQuery(
             query.In(f1, ['Y', 'Z'])),
             [6])
+
+    def test_In_without_forward_index(self):
+        with mock.patch.object(
+                query.FieldTerm, 'getForwardIndex', return_value=None):
+            self.assertEqual(self.displayQuery(
+                query.In(f1, ['Y', 'X', 'foo'])),
+                [3, 5, 6])
+            self.assertEqual(self.displayQuery(query.In(f1, ['Y'])), [6])
+            self.assertEqual(self.displayQuery(query.In(f1, ['Z'])), [])
+
+
+class CountingTerm(query.Term):
+    """Term recording its evaluation."""
+
+    def __init__(self, term, applied):
+        self.term = term
+        self.applied = applied
+
+    def apply(self, cache, context=None):
+        self.applied.append(self.term.key(context))
+        return self.term.apply(cache, context)
+
+    def estimate(self, context=None):
+        return self.term.estimate(context)
+
+    def key(self, context=None):
+        return self.term.key(context)
+
+
+class PlanTest(QueryTestBase):
+
+    def test_estimate(self):
+        self.assertEqual(query.Term().estimate(), None)
+        self.assertEqual(query.All(f1).estimate(), 6)
+        self.assertEqual(query.Eq(f1, 'a').estimate(), 3)
+        self.assertEqual(query.Eq(f1, 'foo').estimate(), 0)
+        self.assertEqual(query.Eq(f1, 1).estimate(), 0)
+        self.assertEqual(query.NotEq(f1, 'a').estimate(), 3)
+        self.assertEqual(query.In(f1, ['a', 'X']).estimate(), 5)
+        self.assertEqual(query.Between(f1).estimate(), 6)
+        # 'X' and 'Y' are two of the three values.
+        self.assertEqual(query.Between(f1, 'X', 'Y').estimate(), 4)
+        self.assertEqual(query.Between(f1, 1, 2).estimate(), 0)
+        self.assertEqual(query.Text(('catalog1', 't1'), 'foo').estimate(),
+                         None)
+        self.assertEqual(query.Ids(1, 2).estimate(), 2)
+        self.assertEqual(query.Objects([]).estimate(), 0)
+
+    def test_estimate_empty_index(self):
+        self.catalog.clear()
+        self.assertEqual(query.Between(f1, 'X', 'Y').estimate(), 0)
+
+    def test_estimate_without_forward_index(self):
+        index = self.catalog['f1']
+        tree = index._fwd_index
+        del index._fwd_index
+        try:
+            self.assertEqual(query.Eq(f1, 'a').estimate(), None)
+            self.assertEqual(query.NotEq(f1, 'a').estimate(), None)
+            self.assertEqual(query.In(f1, ['a']).estimate(), None)
+            self.assertEqual(query.Between(f1, 'a').estimate(), None)
+        finally:
+            index._fwd_index = tree
+
+    def test_estimate_composite(self):
+        text = query.Text(('catalog1', 't1'), 'foo')
+        self.assertEqual(
+            query.And(query.All(f1), query.Eq(f1, 'a')).estimate(), 3)
+        self.assertEqual(query.And(text).estimate(), None)
+        self.assertEqual(
+            query.Or(query.Eq(f1, 'X'), query.Eq(f1, 'a')).estimate(), 5)
+        self.assertEqual(query.Or(query.Eq(f1, 'X'), text).estimate(), None)
+        self.assertEqual(
+            query.Difference(query.Eq(f1, 'a'), query.All(f1)).estimate(), 3)
+
+    def test_plan(self):
+        text = query.Text(('catalog1', 't1'), 'foo')
+        all_ = query.All(f1)
+        eq = query.Eq(f1, 'X')
+        self.assertEqual(
+            query.And(text, all_, eq).plan(), [eq, all_, text])
+
+    def test_And_evaluates_cheapest_first(self):
+        applied = []
+        self.assertEqual(self.displayQuery(query.And(
+            CountingTerm(query.All(f1), applied),
+            CountingTerm(query.Eq(f1, 'X'), applied))),
+            [3, 5])
+        self.assertEqual(applied, [
+            ('equal', 'catalog1', 'f1', 'X'),
+            ('all', 'catalog1', 'f1')])
+
+    def test_And_short_circuit(self):
+        applied = []
+        self.assertEqual(self.displayQuery(query.And(
+            CountingTerm(query.All(f1), applied),
+            CountingTerm(query.Eq(f1, 'a'), applied),
+            CountingTerm(query.Eq(f2, 'c'), applied))),
+            [2])
+        del applied[:]
+        self.assertEqual(self.displayQuery(query.And(
+            CountingTerm(query.All(f1), applied),
+            CountingTerm(query.Eq(f1, 'X'), applied),
+            CountingTerm(query.Eq(f1, 'a'), applied))),
+            [])
+        # All is never evaluated since the intersection of the
+        # selective terms is already empty.
+        self.assertNotIn(('all', 'catalog1', 'f1'), applied)
+
+    def test_And_no_terms(self):
+        self.assertEqual(self.displayQuery(query.And()), [])
+
+    def test_Difference_short_circuit(self):
+        applied = []
+        self.assertEqual(self.displayQuery(query.Difference(
+            query.Eq(f1, 'X'),
+            query.All(f1),
+            CountingTerm(query.Eq(f2, 'b'), applied))),
+            [])
+        self.assertEqual(applied, [])
+
+
+class IndexEstimateTest(unittest.TestCase):
+
+    tearDown = zope.component.testing.tearDown
+
+    def setUp(self):
+        self.catalog = Catalog()
+        provideUtility(self.catalog, ICatalog, 'catalog1')
+        self.catalog['value'] = ValueIndex('f1', IContent)
+        self.catalog['set'] = SetIndex('f2', IContent)
+        content = [
+            Content(1, 'a', ['a', 'b']),
+            Content(2, 'a', ['a']),
+            Content(3, 'b', ['b', 'c']),
+            Content(4, 'c', ['c'])]
+        for uid, entry in enumerate(content):
+            self.catalog.index_doc(uid, entry)
+
+    def test_value(self):
+        index_id = ('catalog1', 'value')
+        self.assertEqual(value_query.All(index_id).estimate(), 4)
+        self.assertEqual(value_query.Eq(index_id, 'a').estimate(), 2)
+        self.assertEqual(value_query.NotEq(index_id, 'a').estimate(), 2)
+        self.assertEqual(value_query.In(index_id, ['a', 'c']).estimate(), 3)
+        self.assertEqual(value_query.Ge(index_id, 'b').estimate(), 2)
+        self.assertEqual(
+            value_query.ExtentAny(index_id, None).estimate(), None)
+
+    def test_set(self):
+        index_id = ('catalog1', 'set')
+        self.assertEqual(set_query.All(index_id).estimate(), 4)
+        self.assertEqual(set_query.AnyOf(index_id, ['a', 'b']).estimate(), 4)
+        self.assertEqual(set_query.AnyOf(index_id, ['a']).estimate(), 2)
+        self.assertEqual(set_query.AllOf(index_id, ['a', 'b']).estimate(), 2)
+        self.assertEqual(set_query.AllOf(index_id, []).estimate(), None)
+        self.assertEqual(
+            set_query.SetBetween(index_id, 'b', 'c').estimate(), 2)
+
+    def test_without_forward_index(self):
+        value_index = self.catalog['value']
+        set_index = self.catalog['set']
+        del value_index.values_to_documents
+        del set_index.values_to_documents
+        self.assertEqual(
+            value_query.Eq(('catalog1', 'value'), 'a').estimate(), None)
+        self.assertEqual(
+            value_query.NotEq(('catalog1', 'value'), 'a').estimate(), None)
+        self.assertEqual(
+            value_query.In(('catalog1', 'value'), ['a']).estimate(), None)
+        self.assertEqual(
+            value_query.Le(('catalog1', 'value'), 'a').estimate(), None)
+        self.assertEqual(
+            set_query.AnyOf(('catalog1', 'set'), ['a']).estimate(), None)
+        self.assertEqual(
+            set_query.AllOf(('catalog1', 'set'), ['a']).estimate(), None)
+        self.assertEqual(
+            set_query.SetBetween(('catalog1', 'set'), 'a').estimate(), None)
+
+
+class CandidatesTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(query, 'CANDIDATES_RATIO', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def apply(self, term, candidates):
+        return list(term.cached_apply({}, None, IFSet(candidates)))
+
+    def test_use_candidates(self):
+        index = self.catalog['f1']
+        self.assertFalse(query.use_candidates(None, index))
+        self.assertTrue(query.use_candidates(IFSet([0]), index))
+        self.assertFalse(query.use_candidates(IFSet(range(6)), index))
+
+    def test_NotEq(self):
+        # Documents 1, 2 and 4 (intids 0, 1, 3) have 'a'.
+        self.assertEqual(self.apply(query.NotEq(f1, 'a'), [0, 2, 7]), [2])
+        self.assertEqual(self.apply(query.NotEq(f1, 'foo'), [0, 2]), [0, 2])
+
+    def test_NotEq_None(self):
+        # Like without candidates, nothing matches.
+        self.assertEqual(self.apply(query.NotEq(f1, None), [0, 5]), [])
+        self.assertEqual(
+            self.displayQuery(query.And(
+                query.Eq(f1, 'Y'), query.NotEq(f1, None))), [])
+
+    def test_Between(self):
+        self.assertEqual(
+            self.apply(query.Between(f1, 'X', 'Y'), [0, 2, 5, 7]), [2, 5])
+        self.assertEqual(self.apply(query.Ge(f1, 'Y'), [0, 2, 5]), [0, 5])
+        self.assertEqual(self.apply(query.Le(f1, 'X'), [0, 2, 5]), [2])
+
+    def test_too_many_candidates(self):
+        # The whole index is used.
+        self.assertEqual(
+            self.apply(query.NotEq(f1, 'a'), range(10)), [2, 4, 5])
+        self.assertEqual(
+            self.apply(query.Between(f1, 'X', 'Y'), range(10)), [2, 4, 5])
+
+    def test_not_cached(self):
+        cache = {}
+        term = query.NotEq(f1, 'a')
+        self.assertEqual(list(term.cached_apply(cache, None, IFSet([2]))), [2])
+        self.assertEqual(cache, {})
+        self.assertEqual(list(term.cached_apply(cache)), [2, 4, 5])
+        self.assertIn(term.key(), cache)
+        # Complete cached results are used.
+        self.assertEqual(
+            list(term.cached_apply(cache, None, IFSet([2]))), [2, 4, 5])
+
+    def test_ignored_if_not_supported(self):
+        self.assertEqual(
+            self.apply(query.Eq(f1, 'a'), [0]), [0, 1, 3])
+
+    def test_And(self):
+        applied = []
+
+        class NotEq(query.NotEq):
+
+            def apply(self, cache, context=None, candidates=None):
+                applied.append(candidates)
+                return super().apply(cache, context, candidates)
+
+        self.assertEqual(self.displayQuery(query.And(
+            NotEq(f2, 'b'), query.Eq(f1, 'X'))),
+            [3])
+        self.assertEqual([list(c) for c in applied], [[2, 4]])
+
+    def test_Or(self):
+        # Eq does not use the candidates, 4 is not one of them but it
+        # is correct to return it.
+        self.assertEqual(self.apply(query.Or(
+            query.NotEq(f1, 'a'), query.Eq(f1, 'X')), [0, 2, 5]), [2, 4, 5])
+
+    def test_Difference(self):
+        applied = []
+
+        class Between(query.Between):
+
+            def apply(self, cache, context=None, candidates=None):
+                applied.append(candidates)
+                return super().apply(cache, context, candidates)
+
+        self.assertEqual(self.displayQuery(query.Difference(
+            query.Eq(f1, 'X'), Between(f2, 'b', 'b'))),
+            [3])
+        self.assertEqual([list(c) for c in applied], [[2, 4]])
+
+    def test_Not(self):
+        with mock.patch.object(
+                query.Universe, 'apply', side_effect=AssertionError):
+            self.assertEqual(self.displayQuery(query.And(
+                query.Eq(f1, 'X'), query.Not(query.Eq(f2, 'b')))),
+                [3])
+
+
+class ExtentCandidatesTest(unittest.TestCase):
+
+    tearDown = zope.component.testing.tearDown
+
+    def setUp(self):
+        patcher = mock.patch.object(query, 'CANDIDATES_RATIO', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.catalog = Catalog()
+        provideUtility(self.catalog, ICatalog, 'catalog1')
+        self.catalog['value'] = ValueIndex('f1', IContent)
+        self.catalog['set'] = SetIndex('f2', IContent)
+        content = [
+            Content(1, 'a', ['a']),
+            Content(2, 'b', ['b']),
+            Content(3, None, None),
+            Content(4, 'c', ['c']),
+            Content(5, 'd', ['d']),
+            Content(6, 'e', ['e'])]
+        for uid, entry in enumerate(content):
+            self.catalog.index_doc(uid, entry)
+        self.extent = FilterExtent(lambda extent, uid, obj: True)
+        for uid in range(4):
+            self.extent.add(uid, uid)
+
+    def apply(self, term, candidates):
+        return list(term.cached_apply({}, None, IFSet(candidates)))
+
+    def test_ExtentAny(self):
+        for module, index_id in ((set_query, ('catalog1', 'set')),
+                                 (value_query, ('catalog1', 'value'))):
+            self.assertEqual(
+                self.apply(module.ExtentAny(index_id, None), [1, 2]), [1])
+            self.assertEqual(
+                self.apply(module.ExtentAny(index_id, self.extent), [1, 5]),
+                [1])
+            self.assertEqual(
+                self.apply(module.ExtentAny(index_id, self.extent),
+                           range(6)),
+                [0, 1, 3])
+
+    def test_ExtentNone(self):
+        for module, index_id in ((set_query, ('catalog1', 'set')),
+                                 (value_query, ('catalog1', 'value'))):
+            self.assertEqual(
+                self.apply(module.ExtentNone(index_id, self.extent), [1, 2]),
+                [2])
+            self.assertEqual(
+                list(module.ExtentNone(index_id, self.extent).apply({})),
+                [2])
+
+    def test_value_NotEq(self):
+        index_id = ('catalog1', 'value')
+        # Document 2 is not indexed and does not match.
+        self.assertEqual(
+            self.apply(value_query.NotEq(index_id, 'a'), [0, 1, 2]), [1])
+        self.assertEqual(
+            self.apply(value_query.NotEq(index_id, 'a'), range(6)),
+            [1, 3, 4, 5])
+
+    def test_value_NotEq_shares_cache(self):
+        index_id = ('catalog1', 'value')
+        cache = {}
+        # Like for field indexes, the forward index is used if there is
+        # one, otherwise the cached results of All and Eq.
+        self.assertEqual(
+            list(value_query.NotEq(index_id, 'b').cached_apply(cache)),
+            [0, 3, 4, 5])
+        self.assertEqual(
+            list(cache), [('not equal', 'catalog1', 'value', 'b')])
+        cache = {}
+        with mock.patch.object(
+                value_query.ValueTerm, 'getForwardIndex', return_value=None):
+            self.assertEqual(
+                list(value_query.NotEq(index_id, 'b').cached_apply(cache)),
+                [0, 3, 4, 5])
+        self.assertIn(('all', 'catalog1', 'value'), cache)
+        self.assertIn(('equal', 'catalog1', 'value', 'b'), cache)
+        self.assertEqual(
+            list(value_query.NotEq(index_id, None).cached_apply(cache)),
+            [0, 1, 3, 4, 5])
+
+
+class NotTest(QueryTestBase):
+
+    def test_Universe(self):
+        self.assertEqual(list(query.Universe().apply({})), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(query.Universe().key(), ('universe',))
+
+    def test_Universe_refs(self):
+        # zope.intid's IntIds keep their ids in a BTree.
+        self.intid.refs = IOBTree(self.intid.data)
+        self.intid.data = {}
+        self.assertEqual(list(query.Universe().apply({})), [0, 1, 2, 3, 4, 5])
+
+    def test_Not(self):
+        cache = {}
+        self.assertEqual(
+            list(query.Not(query.Eq(f1, 'a')).cached_apply(cache)),
+            [2, 4, 5])
+        # The universe is cached.
+        self.assertIn(('universe',), cache)
+
+    def test_Not_universe(self):
+        term = query.Not(query.Eq(f1, 'a'), universe=query.Eq(f2, 'b'))
+        self.assertEqual(term.key(), (
+            'not', ('equal', 'catalog1', 'f1', 'a'),
+            ('equal', 'catalog1', 'f2', 'b')))
+        self.assertEqual(self.displayQuery(term), [5])
+        self.assertEqual(self.displayQuery(
+            query.And(query.Eq(f1, 'X'), term)), [5])
+
+    def test_Not_planned_last(self):
+        text = query.Text(('catalog1', 't1'), 'foo')
+        negated = query.Not(query.Eq(f1, 'X'))
+        eq = query.Eq(f2, 'b')
+        self.assertEqual(
+            query.And(negated, text, eq).plan(), [eq, text, negated])
+
+    def test_And_Not_does_not_use_universe(self):
+        with mock.patch.object(
+                query.Universe, 'apply', side_effect=AssertionError):
+            self.assertEqual(self.displayQuery(query.And(
+                query.Not(query.Eq(f1, 'a')),
+                query.Not(query.Eq(f2, 'b')),
+                query.All(f1))),
+                [3, 6])
+
+    def test_NotEq_forward_index(self):
+        cache = {}
+        self.assertEqual(
+            list(query.NotEq(f1, 'a').cached_apply(cache)), [2, 4, 5])
+        self.assertEqual(list(cache), [('not equal', 'catalog1', 'f1', 'a')])
+        self.assertEqual(
+            list(query.NotEq(f1, 1).cached_apply(cache)), [0, 1, 2, 3, 4, 5])
+
+    def test_NotEq_shares_cache(self):
+        cache = {}
+        with mock.patch.object(
+                query.FieldTerm, 'getForwardIndex', return_value=None):
+            self.assertEqual(
+                list(query.NotEq(f1, 'a').cached_apply(cache)), [2, 4, 5])
+        self.assertIn(('all', 'catalog1', 'f1'), cache)
+        self.assertIn(('equal', 'catalog1', 'f1', 'a'), cache)
+
+    def test_NotEq_None(self):
+        self.assertEqual(self.displayQuery(query.NotEq(f1, None)), [])
+
+
+class ForwardDocumentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = OOBTree(
+            {value: IFSet([value]) for value in range(0, 200, 2)})
+
+    def documents(self, values):
+        return sorted(
+            uid for documents in query.forward_documents(self.tree, values)
+            for uid in documents)
+
+    def test_dense(self):
+        self.assertEqual(
+            self.documents([2, 4, 5, 8, 4, 300]), [2, 4, 8])
+
+    def test_sparse(self):
+        with mock.patch.object(query, 'WALK_RATIO', 1):
+            self.assertEqual(
+                self.documents([0, 1, 100, 198]), [0, 100, 198])
+
+    def test_empty(self):
+        self.assertEqual(self.documents([]), [])
+        self.assertEqual(self.documents([1, 3]), [])
+
+    def test_unorderable(self):
+        self.assertEqual(self.documents([2, 'a']), [2])
+        self.assertEqual(self.documents([(2,), (4,)]), [])
+
+    def test_other_documents(self):
+        self.assertEqual(
+            len(query.other_documents(self.tree, 2)), 99)
+        self.assertEqual(
+            len(query.other_documents(self.tree, 'a')), 100)
+
+
+class ThreadTerm(CountingTerm):
+    """Term recording the thread evaluating it."""
+
+    def apply(self, cache, context=None):
+        self.applied.append(threading.get_ident())
+        return self.term.apply(cache, context)
+
+
+class ExecutorTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(self.executor.shutdown)
+
+    def tearDown(self):
+        transaction.abort()
+        super().tearDown()
+
+    def displayQuery(self, q, **kw):
+        serial = super().displayQuery(q, **kw)
+        concurrent = super().displayQuery(q, executor=self.executor, **kw)
+        self.assertEqual(concurrent, serial)
+        return concurrent
+
+    def test_And(self):
+        threads = []
+        self.assertEqual(self.displayQuery(query.And(
+            ThreadTerm(query.Eq(f1, 'a'), threads),
+            ThreadTerm(query.Eq(f2, 'b'), threads),
+            query.NotEq(f3, 'd'))),
+            [4])
+        # Once in this thread, then in this thread and a worker.
+        self.assertEqual(len(threads), 4)
+        self.assertEqual(len(set(threads)), 2)
+
+    def test_And_weighted(self):
+        self.assertEqual(self.displayQuery(query.And(
+            query.Text(('catalog1', 't1'), 'foo'),
+            query.Eq(f1, 'a'), weighted=True)),
+            [])
+        self.assertEqual(self.displayQuery(query.And(query.Eq(f1, 'a'))),
+                         [1, 2, 4])
+
+    def test_Or(self):
+        threads = []
+        self.assertEqual(self.displayQuery(query.Or(
+            ThreadTerm(query.Eq(f1, 'Y'), threads),
+            ThreadTerm(query.Eq(f1, 'foo'), threads),
+            query.And(query.Eq(f1, 'X'), query.Eq(f2, 'c')))),
+            [3, 6])
+        self.assertEqual(len(threads), 4)
+        self.assertIn(threading.get_ident(), threads)
+
+    def test_Difference(self):
+        self.assertEqual(self.displayQuery(query.Difference(
+            query.All(f1), query.Eq(f1, 'a'), query.NotEq(f2, 'b'))),
+            [5])
+        self.assertEqual(self.displayQuery(query.Difference(
+            query.Eq(f1, 'foo'), query.Eq(f1, 'a'))),
+            [])
+
+    def test_nested(self):
+        # Terms of terms evaluated by a worker are evaluated by that
+        # worker, which cannot wait on the others.
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        threads = []
+        self.assertEqual(super().displayQuery(query.Or(
+            query.Eq(f1, 'Y'),
+            query.Or(
+                ThreadTerm(query.Eq(f1, 'X'), threads),
+                ThreadTerm(query.Eq(f1, 'foo'), threads))),
+            executor=executor),
+            [3, 5, 6])
+        self.assertEqual(len(set(threads)), 1)
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_transaction_cache(self):
+        eq1 = query.Eq(f1, 'a')
+        eq2 = query.Eq(f1, 'X')
+        self.assertEqual(super().displayQuery(
+            query.Or(eq1, eq2), caching=True, executor=self.executor),
+            [1, 2, 3, 4, 5])
+        # The results of the workers are cached in this thread.
+        self.assertIn(eq1.key(), transaction_cache)
+        self.assertIn(eq2.key(), transaction_cache)
+        cache = query.ConcurrentCache(transaction_cache, self.executor)
+        self.assertEqual(len(cache.get(eq2.key())), 2)
+        self.assertEqual(
+            self.executor.submit(cache.get, eq2.key(), 42).result(), 42)
+        cache[('ids', 1)] = IFSet([1])
+        self.assertEqual(
+            len(self.executor.submit(cache.get, ('ids', 1)).result()), 1)
+
+    def test_cache_hits(self):
+        applied = []
+        a = CountingTerm(query.Eq(f1, 'a'), applied)
+        b = CountingTerm(query.Eq(f1, 'X'), applied)
+        y = CountingTerm(query.Eq(f1, 'Y'), applied)
+        cache = {a.key(): a.term.apply({}), b.key(): b.term.apply({})}
+        self.assertEqual(super().displayQuery(
+            query.Or(a, b, y), caching=cache, executor=self.executor),
+            [1, 2, 3, 4, 5, 6])
+        # Only the term missing from the cache is evaluated.
+        self.assertEqual(applied, [('equal', 'catalog1', 'f1', 'Y')])
+        del applied[:]
+        super().displayQuery(
+            query.Or(a, b, y), caching=True, executor=self.executor)
+        super().displayQuery(
+            query.Or(y, a, b), caching=True, executor=self.executor)
+        self.assertEqual(len(applied), 3)
+        transaction.abort()
+
+    def test_error(self):
+
+        class Error(query.Term):
+
+            def apply(self, cache, context=None):
+                raise ValueError(self)
+
+            def key(self, context=None):
+                return ('error',)
+
+        with self.assertRaises(ValueError):
+            self.searchResults(
+                query.Or(query.Eq(f1, 'a'), Error()), executor=self.executor)
+
+    def test_timing(self):
+        threads = []
+        self.assertEqual(super().displayQuery(query.Or(
+            ThreadTerm(query.Eq(f1, 'Y'), threads),
+            ThreadTerm(query.Eq(f1, 'X'), threads)),
+            executor=self.executor, profile=True),
+            [3, 5, 6])
+        self.assertEqual(set(threads), {threading.get_ident()})
+
+    def test_default_executor(self):
+        self.assertEqual(query.default_executor(), None)
+        with mock.patch.object(query, 'HURRY_QUERY_THREADS', 2), \
+                mock.patch.object(query, '_executor', None):
+            executor = query.default_executor()
+            self.addCleanup(executor.shutdown)
+            self.assertIs(query.default_executor(), executor)
+            threads = []
+            self.assertEqual(super().displayQuery(query.Or(
+                ThreadTerm(query.Eq(f1, 'Y'), threads),
+                ThreadTerm(query.Eq(f1, 'X'), threads))),
+                [3, 5, 6])
+            self.assertEqual(len(set(threads)), 2)
+            del threads[:]
+            self.assertEqual(super().displayQuery(query.Or(
+                ThreadTerm(query.Eq(f1, 'Y'), threads),
+                ThreadTerm(query.Eq(f1, 'X'), threads)),
+                executor=False),
+                [3, 5, 6])
+            self.assertEqual(set(threads), {threading.get_ident()})
+
+
+class CompiledTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.query = getUtility(IQuery)
+
+    def test_parameters(self):
+        plan = self.query.compile(query.And(
+            query.Eq(f1, query.Parameter('f1')),
+            query.Between(f2, query.Parameter('minimum'), 'c')))
+        for f1_value, minimum, expected in (
+                ('a', 'b', [1, 2, 4]), ('a', 'c', [2]), ('X', 'b', [3, 5])):
+            self.assertEqual(
+                self.displayQuery(
+                    plan, parameters={'f1': f1_value, 'minimum': minimum}),
+                expected)
+        self.assertEqual(len(plan.sites), 1)
+        plan.clear()
+        self.assertEqual(len(plan.sites), 0)
+
+    def test_term_attributes(self):
+        term = CountingTerm(query.Eq(f1, 'a'), [])
+        self.assertEqual(
+            sorted(query.term_attributes(term)), ['applied', 'term'])
+        term.compiled_key = 'key'
+        self.assertEqual(
+            sorted(query.term_attributes(term)),
+            ['_compiled_key', 'applied', 'term'])
+        self.assertEqual(
+            query.term_attributes(query.Objects([])),
+            {'objects': [], '_ids': None})
+
+        class Extra(query.Eq):
+            __slots__ = 'extra'
+
+        term = Extra(f1, 'a')
+        term.extra = 42
+        self.assertEqual(
+            query.term_attributes(term),
+            {'catalog_name': 'catalog1', 'index_name': 'f1', 'value': 'a',
+             'extra': 42})
+
+    def test_sequence_parameters(self):
+        self.catalog['value'] = ValueIndex('f1', IContent)
+        self.catalog['set'] = SetIndex('f2', IContent)
+        for entry in self.intid.data.values():
+            self.catalog.index_doc(self.intid.getId(entry), entry)
+        values = query.Parameter('values')
+        for term, expected in (
+                (query.In(f1, values), [3, 5, 6]),
+                (value_query.In(('catalog1', 'value'), values), [3, 5, 6]),
+                (set_query.AnyOf(('catalog1', 'set'), values), []),
+                (set_query.AllOf(('catalog1', 'set'), values), [])):
+            plan = self.query.compile(term)
+            self.assertEqual(
+                self.displayQuery(plan, parameters={'values': {'X', 'Y'}}),
+                expected)
+            bound = plan.bind(getSiteManager(), {'values': ['X']})
+            self.assertEqual(bound.values, ('X',))
+            self.assertEqual(bound.compiled_key, bound.key())
+
+    def test_missing_parameter(self):
+        plan = self.query.compile(query.Eq(f1, query.Parameter('value')))
+        with self.assertRaises(KeyError):
+            self.searchResults(plan)
+        self.assertEqual(
+            repr(query.Parameter('value')), "<Parameter 'value'>")
+
+    def test_indexes_looked_up_once(self):
+        plan = self.query.compile(query.Or(
+            query.Eq(f1, query.Parameter('value')), query.All(f2)))
+        with mock.patch.object(
+                query, 'getUtility', wraps=query.getUtility) as lookup:
+            self.assertEqual(
+                self.displayQuery(plan, parameters={'value': 'Y'}),
+                [1, 2, 3, 4, 5, 6])
+            self.assertEqual(lookup.call_count, 3)
+            self.displayQuery(plan, parameters={'value': 'X'})
+            # Only the intids to load the objects.
+            self.assertEqual(lookup.call_count, 4)
+
+    def test_keys(self):
+        term = query.And(
+            query.Eq(f1, query.Parameter('value')), query.All(f2))
+        plan = self.query.compile(term)
+        compiled = plan.compile(getSiteManager())
+        self.assertIsNot(compiled, term)
+        self.assertEqual(compiled.compiled_key, None)
+        self.assertEqual(
+            compiled.terms[1].compiled_key, ('all', 'catalog1', 'f2'))
+        bound = plan.bind(getSiteManager(), {'value': 'a'})
+        # Terms without parameters are shared.
+        self.assertIs(bound.terms[1], compiled.terms[1])
+        self.assertEqual(
+            bound.compiled_key,
+            query.And(query.Eq(f1, 'a'), query.All(f2)).key())
+        self.assertEqual(term.compiled_key, None)
+
+    def test_order_fixed(self):
+        plan = self.query.compile(query.And(
+            query.Eq(f1, query.Parameter('f1')),
+            query.Eq(f2, query.Parameter('f2'))))
+        with mock.patch.object(
+                query.Eq, 'estimate', side_effect=[3, 1]) as estimate:
+            self.assertEqual(
+                self.displayQuery(plan, parameters={'f1': 'a', 'f2': 'b'}),
+                [1, 4])
+            self.assertEqual(
+                self.displayQuery(plan, parameters={'f1': 'X', 'f2': 'c'}),
+                [3])
+        self.assertEqual(estimate.call_count, 2)
+        self.assertEqual(plan.compile(getSiteManager()).compiled_order, [1, 0])
+
+
+class NormalizeTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.catalog['value'] = ValueIndex('f1', IContent)
+        for uid, obj in self.intid.data.items():
+            self.catalog['value'].index_doc(uid, obj)
+
+    def assertNormalized(self, term, expected):
+        normalized = term.normalize()
+        self.assertEqual(normalized.key(), expected.key())
+        self.assertEqual(
+            self.displayQuery(normalized), self.displayQuery(expected))
+
+    def test_flatten(self):
+        a, b, c = query.Eq(f1, 'a'), query.Eq(f2, 'b'), query.Eq(f3, 'd')
+        self.assertNormalized(
+            query.And(query.And(a, b), query.And(b, c)), query.And(a, b, c))
+        self.assertNormalized(
+            query.Or(query.Or(a, b), query.Or(b, c)), query.Or(a, b, c))
+        self.assertNormalized(query.Or(a, a), query.Or(a))
+        weighted = query.And(a, b, weighted=True)
+        self.assertNormalized(query.And(weighted, c), query.And(weighted, c))
+        self.assertNormalized(
+            query.Difference(query.Difference(a, b), c, b),
+            query.Difference(a, b, c))
+        self.assertNormalized(
+            query.Not(query.And(a, a), query.Or(b, b)),
+            query.Not(query.And(a), query.Or(b)))
+
+    def test_unchanged(self):
+        for term in (query.And(query.Eq(f1, 'a'), query.Eq(f2, 'b')),
+                     query.Or(query.Eq(f1, 'a')),
+                     query.Difference(query.Eq(f1, 'a'), query.All(f2)),
+                     query.Not(query.Eq(f1, 'a'), query.All(f1)),
+                     query.Not(query.Eq(f1, 'a')),
+                     query.In(f1, ['a', 'X']),
+                     query.In(f1, query.Parameter('values')),
+                     query.Ge(f1, 'a'),
+                     query.Ids(1, 2)):
+            self.assertIs(term.normalize(), term)
+
+    def test_fold(self):
+        index_id = ('catalog1', 'value')
+        self.assertNormalized(query.In(f1, ['a']), query.Eq(f1, 'a'))
+        self.assertNormalized(
+            value_query.In(index_id, ['a']), value_query.Eq(index_id, 'a'))
+        self.assertNormalized(
+            value_query.In(index_id, ['a', 'b']),
+            value_query.In(index_id, ['a', 'b']))
+        self.assertNormalized(query.Between(f1), query.All(f1))
+        self.assertNormalized(
+            value_query.Between(index_id), value_query.All(index_id))
+
+    def test_merge_ranges(self):
+        index_id = ('catalog1', 'value')
+        self.assertNormalized(
+            query.And(query.Between(f1, 'X', 'b'), query.Ge(f1, 'Y'),
+                      query.Eq(f2, 'Z')),
+            query.And(query.Between(f1, 'Y', 'b'), query.Eq(f2, 'Z')))
+        self.assertNormalized(
+            query.Or(query.Le(f1, 'X'), query.Between(f1, 'X', 'Y')),
+            query.Or(query.Le(f1, 'Y')))
+        self.assertNormalized(
+            query.Or(query.Le(f1, 'X'), query.Ge(f1, 'Y')),
+            query.Or(query.Le(f1, 'X'), query.Ge(f1, 'Y')))
+        self.assertNormalized(
+            query.Or(query.Le(f1, 'Y'), query.Ge(f1, 'X')),
+            query.Or(query.All(f1)))
+        self.assertNormalized(
+            query.And(query.Between(f1, 'X', 'b'), query.Between(f2, 'a')),
+            query.And(query.Between(f1, 'X', 'b'), query.Between(f2, 'a')))
+        self.assertNormalized(
+            query.And(value_query.Between(index_id, 'X', 'a'),
+                      value_query.Between(index_id, 'X', 'a',
+                                          exclude_min=True)),
+            query.And(value_query.Between(
+                index_id, 'X', 'a', exclude_min=True)))
+        self.assertNormalized(
+            query.Or(value_query.Le(index_id, 'X'),
+                     value_query.Between(index_id, 'X', 'a',
+                                         exclude_min=True)),
+            query.Or(value_query.Le(index_id, 'a')))
+        # There is a gap at 'X'.
+        self.assertNormalized(
+            query.Or(value_query.Between(index_id, None, 'X',
+                                         exclude_max=True),
+                     value_query.Between(index_id, 'X', 'a',
+                                         exclude_min=True)),
+            query.Or(value_query.Between(index_id, None, 'X',
+                                         exclude_max=True),
+                     value_query.Between(index_id, 'X', 'a',
+                                         exclude_min=True)))
+        self.assertNormalized(
+            query.And(value_query.Ge(index_id, 'X'), query.Ge(f1, 'Y')),
+            query.And(value_query.Ge(index_id, 'X'), query.Ge(f1, 'Y')))
+
+    def test_merge_not_possible(self):
+        term = query.And(query.Ge(f1, 1), query.Ge(f1, 'a'))
+        self.assertIs(term.normalize(), term)
+        term = query.Or(
+            query.Ge(f1, query.Parameter('minimum')), query.Ge(f1, 'a'))
+        self.assertIs(term.normalize(), term)
+        self.assertEqual(
+            query.merge_ranges((1, None, False, False), ('a', 2, True, True)),
+            None)
+
+    def test_merge_ranges_bounds(self):
+        merge = query.merge_ranges
+        self.assertEqual(
+            merge((1, 5, False, False), (3, None, True, False)),
+            (3, 5, True, False))
+        self.assertEqual(
+            merge((1, 5, False, True), (3, 5, True, False)),
+            (3, 5, True, True))
+        self.assertEqual(
+            merge((1, 5, True, True), (1, 3, False, False), union=True),
+            (1, 5, False, True))
+        self.assertEqual(
+            merge((1, 3, False, False), (4, 5, False, False), union=True),
+            None)
+        self.assertEqual(
+            merge((None, 3, False, True), (3, 5, False, False), union=True),
+            (None, 5, False, False))
+        self.assertEqual(
+            merge((6, None, False, False), (3, 5, False, False), union=True),
+            None)
+
+    def test_unique_without_key(self):
+        applied = []
+        term = CountingTerm(query.Eq(f1, 'a'), applied)
+        with mock.patch.object(
+                CountingTerm, 'key', side_effect=NotImplementedError):
+            self.assertEqual(
+                query.unique_terms([term, term]), [term, term])
+        unhashable = query.Eq(f1, ['a'])
+        self.assertEqual(
+            query.unique_terms([unhashable, unhashable]),
+            [unhashable, unhashable])
+
+    def test_search(self):
+        with mock.patch.object(
+                self.catalog['f1'], 'apply',
+                wraps=self.catalog['f1'].apply) as apply:
+            self.assertEqual(
+                self.displayQuery(query.And(
+                    query.Ge(f1, 'X'), query.Le(f1, 'Y'),
+                    query.In(f2, ['b']))),
+                [5])
+        apply.assert_called_once_with(('X', 'Y'))
+
+    def test_plan(self):
+        plan = getUtility(IQuery).compile(query.And(
+            query.Eq(f1, query.Parameter('value')), query.In(f2, ['b']),
+            query.In(f2, ['b'])))
+        compiled = plan.compile(getSiteManager())
+        self.assertEqual(
+            compiled.terms[1].key(), ('equal', 'catalog1', 'f2', 'b'))
+        self.assertEqual(len(compiled.terms), 2)
+        self.assertEqual(
+            self.displayQuery(plan, parameters={'value': 'X'}), [5])
+
+    def test_key_computed_once(self):
+        term = query.And(query.Eq(f1, 'a'), query.All(f2))
+        with mock.patch.object(query.Eq, 'key', wraps=term.terms[0].key):
+            self.displayQuery(term)
+            self.displayQuery(term, caching=True)
+            self.assertEqual(query.Eq.key.call_count, 1)
+        transaction.abort()
+
+
+class ManyTest(QueryTestBase):
+
+    def searchResultsMany(self, queries, **kw):
+        return getUtility(IQuery).searchResultsMany(queries, **kw)
+
+    def test_results(self):
+        queries = [
+            query.Eq(f1, 'a'),
+            query.And(query.Eq(f1, 'a'), query.Eq(f2, 'b')),
+            query.Eq(f1, 'foo')]
+        self.assertEqual(
+            [[e.id for e in results]
+             for results in self.searchResultsMany(queries, sort_field=f2)],
+            [[e.id for e in self.searchResults(q, sort_field=f2)]
+             for q in queries])
+        self.assertEqual(self.searchResultsMany([]), [])
+
+    def test_shared_terms(self):
+        applied = []
+        eq = CountingTerm(query.Eq(f1, 'a'), applied)
+        other = CountingTerm(query.Eq(f2, 'b'), applied)
+        many = self.searchResultsMany([
+            query.And(eq, other),
+            query.Or(CountingTerm(query.Eq(f1, 'a'), applied), other),
+            eq])
+        self.assertEqual([len(results) for results in many], [2, 4, 3])
+        self.assertEqual(applied, [
+            ('equal', 'catalog1', 'f1', 'a'),
+            ('equal', 'catalog1', 'f2', 'b')])
+
+    def test_shared_candidates(self):
+        applied = []
+
+        class CountingBetween(query.Between):
+            __slots__ = ()
+
+            def apply(self, cache, context=None, candidates=None):
+                applied.append(candidates)
+                return super().apply(cache, context, candidates)
+
+        shared = CountingBetween(f2, 'b', 'c')
+        many = self.searchResultsMany([
+            query.And(query.Eq(f1, 'a'), shared),
+            query.And(query.Eq(f1, 'a'), shared, query.Eq(f2, 'b')),
+            query.Eq(f1, 'X')])
+        self.assertEqual([len(results) for results in many], [3, 2, 2])
+        # Evaluated once without candidates, to be cached.
+        self.assertEqual(applied, [None])
+
+    def test_shared_terms_found(self):
+        between = query.Between(f2, 'b', 'c')
+        # Terms without a key cannot be shared.
+        no_key = query.Not(query.Term())
+        self.assertEqual(query.shared_terms([
+            query.Or(between, query.And(between, query.Eq(f1, 'a'))),
+            query.And(between, no_key),
+            no_key]), [between])
+
+    def test_caching(self):
+        applied = []
+        eq = CountingTerm(query.Eq(f1, 'a'), applied)
+        cache = {}
+        self.searchResultsMany([eq, eq], caching=cache)
+        self.assertEqual(list(cache), [('equal', 'catalog1', 'f1', 'a')])
+        self.searchResultsMany([eq], caching=True)
+        self.searchResultsMany([eq], caching=True)
+        self.assertEqual(len(applied), 2)
+        transaction.abort()
+
+    def test_index_lookups(self):
+        queries = [
+            query.Eq(f1, 'a'),
+            query.And(query.Eq(f1, 'X'), query.Eq(f2, 'b'))]
+        with mock.patch.object(
+                query, 'getUtility', wraps=query.getUtility) as lookup:
+            self.searchResultsMany(queries, sort_field=f1)
+        # Once for f1, used to sort as well, and once for f2.
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_profile(self):
+        eq = query.Eq(f1, 'a')
+        first, second = self.searchResultsMany(
+            [eq, query.And(eq, query.Eq(f2, 'b'))], profile=True)
+        self.assertEqual(
+            [t.cached for t in second.profile.walk()], [False, True, False])
+
+
+class AsyncTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.addCleanup(self.executor.shutdown)
+        self.addCleanup(query.shutdown_async_executor)
+
+    def run_async(self, coroutine):
+        return asyncio.run(coroutine)
+
+    def asearchResults(self, q, **kw):
+        return self.run_async(getUtility(IQuery).asearchResults(
+            q, async_executor=self.executor, **kw))
+
+    def test_search(self):
+        results = self.asearchResults(
+            query.Or(query.Eq(f1, 'a'), query.Eq(f1, 'X')),
+            sort_field=f2, limit=3)
+        self.assertEqual([e.id for e in results], [1, 4, 5])
+        self.assertIs(self.asearchResults(query.Eq(f1, 'foo')), no_results)
+
+    def test_thread(self):
+        threads = []
+
+        class ThreadEq(query.Eq):
+            __slots__ = ()
+
+            def apply(self, cache, context=None):
+                threads.append(threading.get_ident())
+                return super().apply(cache, context)
+
+        self.asearchResults(ThreadEq(f1, 'a'))
+        self.assertNotEqual(threads, [threading.get_ident()])
+
+    def test_caching(self):
+        eq = query.Eq(f1, 'a')
+        cache = {eq.key(): IFSet([1])}
+        # The thread evaluating the query reads a copy of the cache,
+        # that is given the results once the query is done.
+        results = self.asearchResults(
+            query.And(eq, query.All(f2)), caching=cache)
+        self.assertEqual(len(results), 1)
+        eq2 = query.Eq(f1, 'X')
+        self.asearchResults(eq2, caching=cache)
+        self.assertEqual(len(cache[eq2.key()]), 2)
+        self.asearchResults(eq, caching=True)
+        self.assertIn(eq.key(), transaction_cache)
+        transaction.abort()
+
+    def test_caching_transaction(self):
+        eq = query.Eq(f1, 'a')
+        transaction_cache[eq.key()] = IFSet([1])
+        self.addCleanup(transaction.abort)
+        self.assertEqual(len(self.asearchResults(eq, caching=True)), 1)
+
+    def test_caching_shared(self):
+        eq = query.Eq(f1, 'a')
+        cache = SharedCache()
+        cache[eq.key()] = IFSet([1])
+        self.addCleanup(transaction.abort)
+        self.assertEqual(len(self.asearchResults(eq, caching=cache)), 1)
+        # The changes of the transaction of the caller are seen.
+        cache.changed({('catalog1', 'f1')})
+        self.assertEqual(len(self.asearchResults(eq, caching=cache)), 3)
+
+    def test_caching_custom(self):
+        eq = query.Eq(f1, 'a')
+        owner = threading.get_ident()
+
+        class Cache:
+            # Bound to the thread of the caller, it is not read.
+
+            def __init__(self):
+                self.data = {eq.key(): IFSet([1])}
+
+            def get(self, key, default=None):
+                assert threading.get_ident() == owner
+                return self.data.get(key, default)
+
+            def __setitem__(self, key, value):
+                self.data[key] = value
+
+        cache = Cache()
+        results = self.asearchResults(
+            query.Or(eq, query.And(eq, query.All(f2))), caching=cache)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(cache.data[eq.key()]), 3)
+
+    def test_shutdown(self):
+        executor = query.default_async_executor()
+        query.shutdown_async_executor()
+        self.assertIsNot(query.default_async_executor(), executor)
+        query.shutdown_async_executor()
+        query.shutdown_async_executor()
+
+    def test_default_executor(self):
+        self.assertEqual(len(self.run_async(
+            getUtility(IQuery).asearchResults(query.Eq(f1, 'a')))), 3)
+        self.assertIs(
+            query.default_async_executor(), query.default_async_executor())
+
+    def test_iterate(self):
+        results = self.searchResults(
+            query.All(f1), sort_field=f1, batch_size=4)
+
+        async def iterate():
+            return [e.id async for e in results]
+
+        async def batches():
+            return [[e.id for e in batch]
+                    async for batch in results.abatches(self.executor)]
+
+        self.assertEqual(self.run_async(iterate()), [3, 5, 6, 1, 2, 4])
+        self.assertEqual(
+            self.run_async(batches()), [[3, 5, 6, 1], [2, 4]])
+
+        async def nothing():
+            return [e async for e in no_results]
+
+        self.assertEqual(self.run_async(nothing()), [])
+
+
+class IndexLookupTest(QueryTestBase):
+
+    def lookups(self, q, **kw):
+        with mock.patch.object(
+                query, 'getUtility', wraps=query.getUtility) as lookup:
+            self.searchResults(q, **kw)
+        return [call.args[0] for call in lookup.call_args_list]
+
+    def test_once_per_query(self):
+        q = query.And(
+            query.In(f1, ['a', 'X']), query.NotEq(f1, 'X'),
+            query.Or(query.Eq(f2, 'b'), query.Eq(f2, 'c')))
+        self.assertEqual(self.lookups(q), [ICatalog, ICatalog])
+        # Each query looks them up again.
+        self.assertEqual(self.lookups(q), [ICatalog, ICatalog])
+
+    def test_executor(self):
+        executor = concurrent.futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        q = query.Or(query.Eq(f1, 'a'), query.Eq(f1, 'X'))
+        self.assertEqual(
+            self.lookups(q, executor=executor, caching=False), [ICatalog])
+
+    def test_outside_query(self):
+        term = query.Eq(f1, 'a')
+        self.assertIs(term.getIndex(None), term.getIndex(None))
+        with mock.patch.object(
+                query, 'getUtility', wraps=query.getUtility) as lookup:
+            term.getIndex(None)
+            term.getIndex(None)
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_other_context(self):
+        other = Catalog()
+        other['f1'] = FieldIndex('f1', IContent)
+
+        class OtherContextEq(query.Eq):
+
+            def apply(self, cache, context=None):
+                registry = zope.component.globalregistry.BaseGlobalComponents()
+                registry.registerUtility(other, ICatalog, 'catalog1')
+                return super().apply(cache, registry)
+
+        # The index of the query context is not used for the other.
+        self.assertEqual(self.displayQuery(query.Or(
+            query.Eq(f1, 'a'), OtherContextEq(f1, 'X'))), [1, 2, 4])
+
+    def test_interface(self):
+        with self.assertRaises(AssertionError):
+            self.searchResults(query.Text(f1, 'foo'))
+        with self.assertRaises(AssertionError):
+            self.searchResults(value_query.Eq(f1, 'foo'))
+
+
+class FakeJar:
+
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, objects):
+        self.prefetched.append([obj.id for obj in objects])
+        for obj in objects:
+            obj._p_changed = False
+
+
+class CountTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.catalog['value'] = ValueIndex('f1', IContent)
+        self.catalog['set'] = SetIndex('f2', IContent)
+        for uid, obj in self.intid.data.items():
+            self.catalog['value'].index_doc(uid, obj)
+            self.catalog['set'].index_doc(uid, obj)
+        self.query = getUtility(IQuery)
+
+    def assertCount(self, term, expected):
+        self.assertEqual(self.query.count(term), expected)
+        self.assertEqual(self.query.exists(term), expected > 0)
+
+    def test_field(self):
+        with mock.patch.object(
+                self.catalog['f1'], 'apply',
+                side_effect=AssertionError('no results needed')):
+            self.assertCount(query.Eq(f1, 'a'), 3)
+            self.assertCount(query.Eq(f1, 'foo'), 0)
+            self.assertCount(query.NotEq(f1, 'a'), 3)
+            self.assertCount(query.All(f1), 6)
+            self.assertCount(query.Between(f1, 'X', 'Y'), 3)
+            self.assertCount(query.Between(f1, 1, 2), 0)
+            self.assertCount(query.In(f1, ['a', 'X', 'a', 'foo']), 5)
+        self.assertEqual(self.query.count(query.NotEq(f1, None)), 0)
+
+    def test_field_without_forward_index(self):
+        with mock.patch.object(
+                query.FieldTerm, 'getForwardIndex', return_value=None):
+            self.assertCount(query.Eq(f1, 'a'), 3)
+            self.assertCount(query.NotEq(f1, 'a'), 3)
+            self.assertCount(query.Between(f1, 'X', 'Y'), 3)
+            self.assertCount(query.In(f1, ['a', 'X']), 5)
+
+    def test_value(self):
+        index_id = ('catalog1', 'value')
+        with mock.patch.object(
+                self.catalog['value'], 'apply',
+                side_effect=AssertionError('no results needed')):
+            self.assertCount(value_query.Eq(index_id, 'a'), 3)
+            self.assertCount(value_query.NotEq(index_id, 'a'), 3)
+            self.assertCount(value_query.NotEq(index_id, None), 6)
+            self.assertCount(value_query.All(index_id), 6)
+            self.assertCount(value_query.Between(index_id, 'X', 'Y'), 3)
+            self.assertCount(
+                value_query.Between(index_id, 'X', 'Y', exclude_max=True), 2)
+            self.assertCount(value_query.In(index_id, ['a', 'Y']), 4)
+        self.assertCount(set_query.All(('catalog1', 'set')), 6)
+        with mock.patch.object(
+                value_query.ValueTerm, 'getForwardIndex', return_value=None):
+            self.assertCount(value_query.Eq(index_id, 'a'), 3)
+            self.assertCount(value_query.NotEq(index_id, 'a'), 3)
+            self.assertCount(value_query.Between(index_id, 'X', 'Y'), 3)
+            self.assertCount(value_query.In(index_id, ['a', 'Y']), 4)
+
+    def test_composite(self):
+        self.assertCount(query.And(query.Eq(f1, 'a'), query.Eq(f2, 'b')), 2)
+        self.assertCount(query.And(query.Eq(f1, 'X'), query.Eq(f2, 'Z')), 0)
+        self.assertCount(query.And(query.Eq(f1, 'a'), query.Eq(f2, 'Z')), 0)
+        self.assertCount(query.And(query.Eq(f1, 'foo'), query.All(f2)), 0)
+        self.assertCount(query.And(), 0)
+        self.assertCount(query.Or(query.Eq(f1, 'foo'), query.Eq(f2, 'Z')), 1)
+        self.assertCount(query.Or(query.Eq(f1, 'foo')), 0)
+        self.assertCount(
+            query.Difference(query.Eq(f1, 'a'), query.Eq(f2, 'b')), 1)
+        self.assertCount(
+            query.Difference(query.Eq(f1, 'a'), query.All(f2)), 0)
+        self.assertCount(
+            query.Difference(query.Eq(f1, 'foo'), query.All(f2)), 0)
+        self.assertCount(query.Not(query.Eq(f1, 'a')), 3)
+
+    def test_exists_stops_early(self):
+        applied = []
+        self.assertTrue(self.query.exists(query.Or(
+            CountingTerm(query.Eq(f1, 'a'), applied),
+            CountingTerm(query.Eq(f2, 'b'), applied))))
+        self.assertEqual(applied, [('equal', 'catalog1', 'f1', 'a')])
+
+    def test_exists_candidates(self):
+        # Only the documents of the first results are checked.
+        with mock.patch.object(query, 'CANDIDATES_RATIO', 1):
+            self.assertTrue(self.query.exists(
+                query.And(query.Eq(f1, 'X'), query.NotEq(f2, 'b'))))
+            self.assertFalse(self.query.exists(
+                query.Difference(query.Eq(f1, 'X'), query.NotEq(f1, 'Y'))))
+
+    def test_cache(self):
+        term = query.Eq(f2, 'b')
+        cache = {}
+        self.assertTrue(self.query.exists(
+            query.And(query.Eq(f1, 'a'), term), caching=cache))
+        self.assertIn(term.key(), cache)
+        with mock.patch.object(
+                self.catalog['f1'], 'documentCount', return_value=42):
+            self.assertEqual(
+                self.query.count(query.All(f1), caching=cache), 42)
+
+    def test_plan(self):
+        plan = self.query.compile(query.In(f1, query.Parameter('values')))
+        self.assertEqual(
+            self.query.count(plan, parameters={'values': ['a']}), 3)
+        self.assertTrue(
+            self.query.exists(plan, parameters={'values': ['Y']}))
+
+
+class FacetTest(QueryTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.catalog['value'] = ValueIndex('f1', IContent)
+        self.catalog['set'] = SetIndex('f2', IContent)
+        tags = [['a', 'b'], ['b'], [], ['a', 'b', 'c'], ['c'], None]
+        for uid, obj in self.intid.data.items():
+            self.catalog['value'].index_doc(uid, obj)
+            self.catalog['set'].index_doc(uid, Content(uid, f2=tags[uid]))
+        self.query = getUtility(IQuery)
+
+    def facets(self, q, fields, **kw):
+        facets = self.query.facets(q, fields, **kw)
+        # Small results are counted from the values of the documents.
+        with mock.patch.object(query, 'CANDIDATES_RATIO', 0):
+            self.assertEqual(self.query.facets(q, fields, **kw), facets)
+        return {field: list(counts.items())
+                for field, counts in facets.items()}
+
+    def test_field(self):
+        self.assertEqual(
+            self.facets(query.All(f1), [f1, f2]),
+            {f1: [('a', 3), ('X', 2), ('Y', 1)],
+             f2: [('b', 3), ('c', 2), ('Z', 1)]})
+        self.assertEqual(
+            self.facets(query.Eq(f2, 'c'), [f1]),
+            {f1: [('X', 1), ('a', 1)]})
+
+    def test_value(self):
+        self.assertEqual(
+            self.facets(query.Eq(f2, 'b'), [('catalog1', 'value')]),
+            {('catalog1', 'value'): [('a', 2), ('X', 1)]})
+
+    def test_set(self):
+        index = self.catalog['set']
+        self.assertEqual(
+            self.facets(query.All(f1), [index]),
+            {index: [('b', 3), ('a', 2), ('c', 2)]})
+
+    def test_limit(self):
+        self.assertEqual(
+            self.facets(query.All(f1), [f1, ('catalog1', 'set')], limit=2),
+            {f1: [('a', 3), ('X', 2)],
+             ('catalog1', 'set'): [('b', 3), ('a', 2)]})
+
+    def test_results(self):
+        results = self.searchResults(
+            query.Eq(f1, 'a'), sort_field=f2, limit=1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(
+            results.facets([f2, ('catalog1', 'set')], limit=1),
+            {f2: {'b': 2}, ('catalog1', 'set'): {'b': 3}})
+        self.assertEqual(
+            self.searchResults(query.Eq(f1, 'foo')).facets([f2]), {f2: {}})
+
+    def test_not_supported(self):
+        with self.assertRaises(ValueError):
+            self.query.facets(query.All(f1), [('catalog1', 't1')])
+
+
+class ResultsTest(QueryTestBase):
+
+    def test_getitem(self):
+        results = self.searchResults(query.All(f1), sort_field=f2)
+        # f2 sorted: b: 1, 4, 5, c: 2, 3, Z: 6
+        self.assertEqual(results[0].id, 6)
+        self.assertEqual(results[-1].id, 3)
+        self.assertEqual([e.id for e in results[1:3]], [1, 4])
+        self.assertEqual([e.id for e in results[::-2]], [3, 5, 1])
+        self.assertEqual(results[10:], [])
+        with self.assertRaises(IndexError):
+            results[6]
+        with self.assertRaises(IndexError):
+            results[-7]
+
+    def test_getitem_no_results(self):
+        results = self.searchResults(query.Eq(f1, 'foo'))
+        self.assertEqual(results[:10], [])
+        with self.assertRaises(IndexError):
+            results[0]
+
+    def test_batches(self):
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, batch_size=4)
+        self.assertEqual(
+            [[e.id for e in batch] for batch in results.batches()],
+            [[6, 1, 4, 5], [2, 3]])
+        self.assertEqual([e.id for e in results], [6, 1, 4, 5, 2, 3])
+
+    def test_prefetch(self):
+        jar = FakeJar()
+        for uid, obj in self.intid.data.items():
+            if uid % 2:
+                # Loaded objects.
+                obj._p_changed = False
+            else:
+                obj._p_changed = None
+            obj._p_jar = jar
+        results = self.searchResults(query.All(f1), batch_size=4)
+        self.assertEqual([e.id for e in results], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(jar.prefetched, [[1, 3], [5]])
+        self.assertEqual([e.id for e in results[1:4]], [2, 3, 4])
+        self.assertEqual(jar.prefetched, [[1, 3], [5]])
+
+    def test_prefetch_not_supported(self):
+        obj = Content(1)
+        obj._p_jar = object()
+        obj._p_changed = None
+        query.prefetch([obj])
+
+    def test_load_wrapped(self):
+        parent = Content('parent')
+        results = self.searchResults(
+            query.Eq(f1, 'a'), wrapper=lambda obj: obj, locate_to=parent)
+        located = results[0:2]
+        self.assertEqual(located, [Content(1), Content(2)])
+        self.assertEqual(located[0].__parent__, parent)
+        self.assertEqual(results.first().__parent__, parent)
+
+    def test_compact(self):
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, limit=3, start=1, compact=True)
+        self.assertEqual(results.total, 6)
+        self.assertEqual([e.id for e in results], [1, 4, 5])
+        self.assertEqual(results.continuation, ('b', 4))
+        with self.assertRaises(ValueError):
+            results.facets([f1])
+        results = self.searchResults(query.All(f1), reverse=True, compact=True)
+        self.assertEqual([e.id for e in results], [6, 5, 4, 3, 2, 1])
+        self.assertEqual(results[-2].id, 2)
+        results = self.searchResults(query.All(f1), compact=True)
+        self.assertEqual(len(results), 6)
+
+    def test_selected_array(self):
+        results = self.searchResults(query.All(f1), sort_field=f2, limit=3)
+        self.assertEqual(
+            results._Results__selected, query.array('i', [5, 0, 3]))
+        self.assertEqual(results.facets([f2], limit=1), {f2: {'b': 3}})
+
+    def test_slots(self):
+        results = self.searchResults(query.All(f1))
+        for obj in (results, query.Timing(), query.Eq(f1, 'a'),
+                    value_query.In(('catalog1', 'value'), ['a']),
+                    set_query.AnyOf(('catalog1', 'set'), ['a'])):
+            self.assertFalse(hasattr(obj, '__dict__'), obj)
+
+    def test_stream(self):
+        with mock.patch.object(
+                query, '_select', wraps=query._select) as select:
+            results = self.searchResults(
+                query.All(f1), reverse=True, start=1, limit=3)
+            self.assertEqual(len(results), 3)
+            self.assertEqual(results.count, 3)
+            self.assertEqual(results.total, 6)
+            self.assertEqual(select.call_count, 0)
+            self.assertEqual([e.id for e in results], [5, 4, 3])
+            self.assertEqual([e.id for e in results], [5, 4, 3])
+            self.assertEqual(results[-1].id, 3)
+            self.assertEqual(select.call_count, 3)
+        results = self.searchResults(query.All(f1), start=4, limit=3)
+        self.assertEqual([e.id for e in results], [5, 6])
+        self.assertEqual(len(results), 2)
+        results = self.searchResults(query.All(f1), start=10)
+        self.assertEqual(len(results), 0)
+        self.assertEqual(list(results), [])
+
+    def test_stream_sorted(self):
+        content = Content(7, 'a', None)
+        self.catalog.index_doc(self.intid.register(content), content)
+        results = self.searchResults(
+            query.Eq(f1, 'a'), sort_field=f2, stream=True)
+        self.assertEqual([e.id for e in results], [1, 4, 2])
+        self.assertEqual(len(results), 3)
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, reverse=True, start=1, stream=True)
+        # Equal values are ordered on the id, like without stream.
+        self.assertEqual([e.id for e in results], [3, 1, 4, 5, 6])
+        self.assertEqual(results.count, 5)
+        self.assertEqual([e.id for e in results[1:3]], [1, 4])
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, start=10, stream=True)
+        self.assertEqual(len(results), 0)
+
+    def test_stream_limit(self):
+        # Limited results are already sorted in a heap.
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, limit=2, stream=True)
+        self.assertEqual([e.id for e in results], [6, 1])
+        self.assertEqual(results.continuation, ('b', 0))
+
+
+class RankedTest(QueryTestBase):
+
+    def setup_content(self):
+        content = [
+            Content(1, 'a', t1='apple'),
+            Content(2, 'a', t1='apple apple apple pear'),
+            Content(3, 'X', t1='pear'),
+            Content(4, 'a', t1='apple apple pear pear'),
+            Content(5, 'X', t1='apple pear apple'),
+            Content(6, 'Y', t1='banana')]
+        for entry in content:
+            self.catalog.index_doc(self.intid.register(entry), entry)
+
+    def displayRanked(self, q, **kw):
+        return [e.id for e in self.searchResults(q, ranked=True, **kw)]
+
+    def test_text(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+        self.assertEqual(self.displayRanked(apple), [2, 1, 5, 4])
+        self.assertEqual(self.displayRanked(apple, limit=2), [2, 1])
+        self.assertEqual(
+            self.displayRanked(apple, start=1, limit=2), [1, 5])
+        self.assertEqual(self.displayRanked(apple, start=3), [4])
+        self.assertEqual(
+            self.displayRanked(apple, reverse=True), [4, 5, 1, 2])
+        self.assertEqual(
+            self.displayRanked(apple, reverse=True, limit=2), [4, 5])
+
+    def test_weighted(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+        pear = query.Text(('catalog1', 't1'), 'pear')
+        # Documents of field terms all count as 1.
+        self.assertEqual(
+            self.displayRanked(
+                query.And(apple, query.Eq(f1, 'a'), weighted=True)),
+            [2, 1, 4])
+        # Equal scores are ordered on the document id.
+        self.assertEqual(
+            self.displayRanked(query.Or(apple, pear, weighted=True)),
+            [4, 5, 2, 1, 3])
+        self.assertEqual(
+            self.displayRanked(
+                query.Or(apple, pear, query.Eq(f1, 'Y'), weighted=True),
+                limit=3),
+            [4, 6, 5])
+        self.assertEqual(
+            self.displayRanked(query.Difference(apple, query.Eq(f1, 'X'))),
+            [2, 1, 4])
+
+    def test_no_scores(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+        self.assertEqual(
+            self.displayRanked(query.And(apple, query.Eq(f1, 'a'))),
+            [1, 2, 4])
+        self.assertEqual(
+            self.displayRanked(query.Or(query.Eq(f1, 'X'), apple)),
+            [1, 2, 3, 4, 5])
+        self.assertEqual(
+            self.displayRanked(query.All(f1), limit=2, reverse=True),
+            [6, 5])
+
+    def test_score(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+        results = self.searchResults(apple, ranked=True, limit=1)
+        [uid] = list(results._Results__selected)
+        self.assertAlmostEqual(results.score(uid), 0.619, places=3)
+        self.assertEqual(self.searchResults(query.All(f1)).score(0), None)
+        self.assertEqual(no_results.score(0), None)
+        results = self.searchResults(apple, compact=True)
+        with self.assertRaises(ValueError):
+            results.score(uid)
+
+    def test_score_not(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+
+        def scores(q):
+            results = self.searchResults(q, ranked=True)
+            return {
+                e.id: round(results.score(self.intid.getId(e)), 3)
+                for e in results}
+
+        # Like other terms, what Not leaves of the candidates counts as
+        # 1: the scores of the candidates are not added twice.
+        expected = {
+            uid: round(score + 1, 3)
+            for uid, score in scores(apple).items() if uid != 5}
+        self.assertEqual(
+            scores(query.And(
+                apple, query.Not(query.Eq(f1, 'X')), weighted=True)),
+            expected)
+        self.assertEqual(
+            scores(query.And(apple, query.NotEq(f1, 'X'), weighted=True)),
+            expected)
+        self.assertEqual(
+            scores(query.And(
+                apple, query.Or(query.Not(query.Eq(f1, 'X'))),
+                weighted=True)),
+            expected)
+
+    def test_sort_field(self):
+        with self.assertRaises(ValueError):
+            self.searchResults(
+                query.Text(('catalog1', 't1'), 'apple'), ranked=True,
+                sort_field=f1)
+
+    def test_key(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+        eq = query.Eq(f1, 'a')
+        self.assertEqual(query.And(apple, eq, weighted=True).key()[0],
+                         'weighted and')
+        self.assertEqual(query.Or(apple, eq, weighted=True).key()[0],
+                         'weighted or')
+        # Weighted results are cached apart from the others.
+        self.searchResults(query.And(apple, eq), caching=True)
+        results = self.searchResults(
+            query.And(apple, eq, weighted=True), caching=True)
+        self.assertIsNotNone(results.score(0))
+        transaction.abort()
+
+    def test_normalize(self):
+        apple = query.Text(('catalog1', 't1'), 'apple')
+        eq = query.Eq(f1, 'a')
+        # Repeated terms add to the scores.
+        term = query.Or(apple, apple, weighted=True)
+        self.assertIs(term.normalize(), term)
+        term = query.Or(
+            query.Or(apple, eq, weighted=True), query.Or(apple, eq), eq,
+            weighted=True)
+        self.assertEqual(
+            term.normalize().key(),
+            query.Or(apple, eq, query.Or(apple, eq), eq,
+                     weighted=True).key())
+
+    def test_rank(self):
+        scores = {1: 0.5, 2: 1.0, 3: 0.5, 4: 0.1}
+        self.assertEqual(query.rank(scores), [2, 1, 3, 4])
+        self.assertEqual(query.rank(scores, 3), [2, 1, 3])
+        self.assertEqual(query.rank(scores, reverse=True), [4, 3, 1, 2])
+        self.assertEqual(query.rank(scores, 2, reverse=True), [4, 3])
+
+
+class KeysetTest(QueryTestBase):
+    # Sorted on f2, then on their id, intids are:
+    # ('Z', 5), ('b', 0), ('b', 3), ('b', 4), ('c', 1), ('c', 2)
+
+    def pages(self, q, **kw):
+        pages = []
+        after = None
+        while True:
+            results = self.searchResults(
+                q, sort_field=f2, limit=2, after=after, **kw)
+            page = [self.intid.getId(e) for e in results]
+            if not page:
+                self.assertEqual(results.continuation, None)
+                return pages
+            pages.append(page)
+            after = results.continuation
+
+    def test_pages(self):
+        self.assertEqual(
+            self.pages(query.All(f1)), [[5, 0], [3, 4], [1, 2]])
+
+    def test_pages_reverse(self):
+        self.assertEqual(
+            self.pages(query.All(f1), reverse=True), [[1, 2], [0, 3], [4, 5]])
+
+    def test_pages_full_sort(self):
+        # Pages are slices of the results sorted without a limit, equal
+        # values being ordered on the id in both directions.
+        q = query.All(f1)
+        for reverse in (False, True):
+            expected = [e.id for e in self.searchResults(
+                q, sort_field=f2, reverse=reverse)]
+            for start in range(6):
+                self.assertEqual(
+                    [e.id for e in self.searchResults(
+                        q, sort_field=f2, reverse=reverse, limit=3,
+                        start=start)],
+                    expected[start:start + 3])
+            self.assertEqual(
+                [e.id for e in self.searchResults(
+                    q, sort_field=f2, reverse=reverse, stream=True)],
+                expected)
+
+    def test_continuation(self):
+        results = self.searchResults(query.All(f1), sort_field=f2, limit=3)
+        self.assertEqual(results.continuation, ('b', 3))
+        self.assertEqual(results.total, 6)
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, limit=3, after=['b', 3])
+        self.assertEqual([e.id for e in results], [5, 2, 3])
+        self.assertEqual(results.total, 6)
+        self.assertEqual(no_results.continuation, None)
+
+    def test_start(self):
+        results = self.searchResults(
+            query.All(f1), sort_field=f2, limit=2, start=1, after=('b', 0))
+        self.assertEqual([self.intid.getId(e) for e in results], [4, 1])
+
+    def test_keyset_sort(self):
+        index = self.catalog['f2']
+        docids = IFSet([0, 2, 3, 5])
+        for limit in (1, 4):
+            # Walking the index or sorting the documents give the same.
+            for after in (None, ('b', 0), ('Z', 5), ('a', 1), ('d', 1)):
+                for reverse in (False, True):
+                    if reverse:
+                        # Equal values stay ordered on the id.
+                        def key(entry):
+                            return (query.Descending(entry[0]), entry[1])
+                    else:
+                        def key(entry):
+                            return entry
+                    expected = sorted(
+                        ((index._rev_index[uid], uid) for uid in docids),
+                        key=key)
+                    if after is not None:
+                        expected = [
+                            e for e in expected if key(e) > key(after)]
+                    expected = [e[1] for e in expected][:limit]
+                    self.assertEqual(list(query.keyset_sort(
+                        index, docids, limit, reverse, after)), expected)
+
+    def test_keyset_sort_walk(self):
+        index = self.catalog['f2']
+        with mock.patch.object(query, '_walk_sort') as walk:
+            walk.return_value = iter([])
+            list(query.keyset_sort(index, IFSet(range(6)), 2))
+            list(query.keyset_sort(index, IFSet([1]), 2))
+        self.assertEqual(walk.call_count, 1)
+
+    def test_unsorted(self):
+        with self.assertRaises(ValueError):
+            self.searchResults(query.All(f1), limit=2, after=('b', 0))
+        with self.assertRaises(ValueError):
+            self.searchResults(query.All(f1), sort_field=f2, after=('b', 0))
+
+    def test_no_mappings(self):
+        index = self.catalog['f2']
+        self.assertEqual(
+            query.sort_mappings(index), (index._fwd_index, index._rev_index))
+        self.assertEqual(query.sort_mappings(object()), None)
+
+
+class MultiSortTest(QueryTestBase):
+    # f1 descending then f3: ('a', ''): 2, ('a', 'd'): 1, ('a', 'e'): 4,
+    # ('Y', ''): 6, ('X', ''): 3, ('X', 'e'): 5
+
+    def sorted_ids(self, sort_field, **kw):
+        results = self.searchResults(
+            query.All(f1), sort_field=sort_field, **kw)
+        return [e.id for e in results]
+
+    def test_sort(self):
+        self.assertEqual(
+            self.sorted_ids([(f1, True), f3]), [2, 1, 4, 6, 3, 5])
+        self.assertEqual(
+            self.sorted_ids([(self.catalog['f1'], True), self.catalog['f3']]),
+            [2, 1, 4, 6, 3, 5])
+        self.assertEqual(
+            self.sorted_ids([f1, (f3, True)]), [5, 3, 6, 4, 1, 2])
+
+    def test_pair(self):
+        # A single pair is one sort field with its direction.
+        self.assertEqual(
+            self.sorted_ids((f3, True)), self.sorted_ids([(f3, True)]))
+        self.assertEqual(
+            self.sorted_ids((self.catalog['f3'], False)),
+            self.sorted_ids(f3))
+        with self.assertRaises(ValueError):
+            self.sorted_ids([(f3, 'descending')])
+
+    def test_reverse(self):
+        self.assertEqual(
+            self.sorted_ids([(f1, True), f3], reverse=True),
+            [5, 3, 6, 4, 1, 2])
+
+    def test_limit(self):
+        self.assertEqual(
+            self.sorted_ids([(f1, True), f3], limit=2), [2, 1])
+        self.assertEqual(
+            self.sorted_ids([(f1, True), f3], limit=2, start=3), [6, 3])
+        self.assertEqual(
+            self.sorted_ids([(f1, True), f3], start=4), [3, 5])
+
+    def test_continuation(self):
+        results = self.searchResults(
+            query.All(f1), sort_field=[(f1, True), f3], limit=4)
+        self.assertEqual(results.continuation, (('Y', ''), 5))
+        results = self.searchResults(
+            query.All(f1), sort_field=[(f1, True), f3], limit=4,
+            after=results.continuation)
+        self.assertEqual([e.id for e in results], [3, 5])
+        self.assertEqual(results.total, 6)
+        # Like with one sort field, continuing requires a limit.
+        with self.assertRaises(ValueError):
+            self.searchResults(
+                query.All(f1), sort_field=[(f1, True), f3],
+                after=(('Y', ''), 5))
+
+    def test_missing_values(self):
+        # Documents not in the first index are skipped, the ones not in
+        # the others come last.
+        self.catalog['f3'].unindex_doc(0)
+        self.catalog['f1'].unindex_doc(5)
+        self.assertEqual(
+            self.sorted_ids([(f1, True), f3]), [2, 4, 1, 3, 5])
+
+    def test_no_reverse_index(self):
+        index = mock.Mock(spec=['sort'])
+        alsoProvides(index, IIndexSort)
+        with self.assertRaises(ValueError):
+            self.sorted_ids([f1, index])
+
+    def test_Descending(self):
+        self.assertLess(query.Descending(2), query.Descending(1))
+        self.assertEqual(query.Descending(1), query.Descending(1))
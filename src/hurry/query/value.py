@@ -20,117 +20,108 @@ from zc.catalog.interfaces import IValueIndex
 from hurry.query import query
 
 
-class ValueTerm(query.IndexTerm):
+class ValueTerm(query.ZcIndexTerm):
+    __slots__ = ()
+    index_interface = IValueIndex
 
-    def getIndex(self, context):
-        index = super().getIndex(context)
-        assert IValueIndex.providedBy(index)
-        return index
 
-
-class Eq(ValueTerm):
-
-    def __init__(self, index_id, value):
-        assert value is not None
-        super().__init__(index_id)
-        self.value = value
+class Eq(ValueTerm, query.EqTerm):
+    __slots__ = ()
 
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'any_of': (self.value,)})
 
-    def key(self, context=None):
-        return ('equal', self.catalog_name, self.index_name, self.value)
 
+class NotEq(ValueTerm, query.NotEqTerm):
+    __slots__ = ()
 
-class NotEq(ValueTerm):
-
-    def __init__(self, index_id, value):
-        super().__init__(index_id)
-        self.value = value
+    def getComplementTerms(self):
+        index_id = (self.catalog_name, self.index_name)
+        return All(index_id), Eq(index_id, self.value)
 
-    def apply(self, cache, context=None):
-        index = self.getIndex(context)
-        values = list(index.values())
-        # the remove method produces a value error when the value to
-        # be removed is not in the list in the first place.  Having a
-        # try/except clause is more efficent than first searching the
-        # list for the value to remove.
-        try:
-            values.remove(self.value)
-        except ValueError:
-            pass
-        return index.apply({'any_of': values})
+    def apply(self, cache, context=None, candidates=None):
+        if self.value is None:
+            # No document is indexed under None.
+            return All((self.catalog_name, self.index_name)).cached_apply(
+                cache, context)
+        return super().apply(cache, context, candidates)
 
-    def key(self, context=None):
-        return ('not equal', self.catalog_name, self.index_name, self.value)
+    def count(self, cache, context=None):
+        if self.value is None:
+            return All((self.catalog_name, self.index_name)).count(
+                cache, context)
+        return super().count(cache, context)
 
 
-class All(ValueTerm):
+class All(ValueTerm, query.AllTerm):
+    __slots__ = ()
 
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'any': None})
 
-    def key(self, context=None):
-        return ('all', self.catalog_name, self.index_name)
-
 
-class Between(ValueTerm):
+class Between(ValueTerm, query.BetweenTerm):
+    __slots__ = ()
 
     def __init__(self, index_id, min_value=None, max_value=None,
                  exclude_min=False, exclude_max=False):
         super().__init__(index_id)
         self.options = (min_value, max_value, exclude_min, exclude_max)
 
+    def normalize(self, context=None):
+        if self.options[:2] == (None, None):
+            return All((self.catalog_name, self.index_name))
+        return self
+
+    def merge(self, other, union=False):
+        """Return a range matching the documents of this term and the
+        other one, or of any of them if `union`, or None.
+        """
+        if not isinstance(other, Between) or (
+                other.catalog_name, other.index_name) != (
+                    self.catalog_name, self.index_name):
+            return None
+        merged = query.merge_ranges(self.options, other.options, union)
+        if merged is None:
+            return None
+        return Between((self.catalog_name, self.index_name), *merged)
+
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'between': self.options})
 
-    def key(self, context=None):
-        return ('between', self.catalog_name, self.index_name, self.options)
-
 
 class Ge(Between):
+    __slots__ = ()
 
     def __init__(self, index_id, min_value):
         super().__init__(index_id, min_value=min_value)
 
 
 class Le(Between):
+    __slots__ = ()
 
     def __init__(self, index_id, max_value):
         super().__init__(index_id, max_value=max_value)
 
 
-class In(ValueTerm):
+class In(ValueTerm, query.InTerm):
+    __slots__ = ()
 
-    def __init__(self, index_id, values):
-        assert None not in values
-        super().__init__(index_id)
-        self.values = tuple(values)
+    def normalize(self, context=None):
+        if (not isinstance(self.values, query.Parameter) and
+                len(self.values) == 1 and self.values[0] is not None):
+            return Eq((self.catalog_name, self.index_name), self.values[0])
+        return self
 
     def apply(self, cache, context=None):
         return self.getIndex(context).apply({'any_of': self.values})
 
-    def key(self, context=None):
-        return ('in', self.catalog_name, self.index_name, self.values)
 
-
-class ExtentAny(ValueTerm):
+class ExtentAny(ValueTerm, query.ExtentAnyTerm):
     """Any ids in the extent that are indexed by this index."""
-
-    def __init__(self, index_id, extent):
-        super().__init__(index_id)
-        self.extent = extent
-
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply({'any': self.extent})
+    __slots__ = ()
 
 
-class ExtentNone(ValueTerm):
+class ExtentNone(ValueTerm, query.ExtentNoneTerm):
     """Any ids in the extent that are not indexed by this index."""
-
-    def __init__(self, index_id, extent):
-        super().__init__(index_id)
-        self.extent = extent
-
-    def apply(self, cache, context=None):
-        return self.getIndex(context).apply({'none': self.extent})
+    __slots__ = ()